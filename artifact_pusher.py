@@ -0,0 +1,269 @@
+import os
+import threading
+import time
+from typing import Optional
+
+import requests
+from box import Box
+
+from image_index import get_digest
+from logs import log
+from metrics import span
+from utils import read_json, write_json
+
+from constants import WORKER_STATE_DIR, ARTIFACT_PUSH_MAX_ATTEMPTS, \
+    ARTIFACT_PUSH_RETRY_DELAY
+
+ARTIFACT_REPO = 'deepdriveio/botleague'
+ARTIFACT_PUSH_QUEUE_PATH = f'{WORKER_STATE_DIR}/artifact_pushes.json'
+DOCKER_HUB_AUTH_URL = 'https://auth.docker.io/token'
+DOCKER_HUB_REGISTRY_URL = 'https://registry-1.docker.io'
+MANIFEST_TYPES = [
+    'application/vnd.docker.distribution.manifest.v2+json',
+    'application/vnd.docker.distribution.manifest.list.v2+json',
+    'application/vnd.oci.image.manifest.v1+json',
+    'application/vnd.oci.image.index.v1+json',
+]
+
+
+class RegistryClient:
+    def __init__(self, username, password, auth_url=DOCKER_HUB_AUTH_URL,
+                 registry_url=DOCKER_HUB_REGISTRY_URL):
+        """
+        Just enough of the Docker registry HTTP API to tag an image that's
+        already in a repo without pushing it through the daemon
+        """
+        self.username = username
+        self.password = password
+        self.auth_url = auth_url
+        self.registry_url = registry_url
+        self.session = requests.Session()
+        self.tokens = {}  # repo => token
+
+    def get_token(self, repo, refresh=False) -> str:
+        if refresh or repo not in self.tokens:
+            resp = self.session.get(
+                self.auth_url, auth=(self.username, self.password),
+                params=dict(service='registry.docker.io',
+                            scope=f'repository:{repo}:pull,push'))
+            resp.raise_for_status()
+            self.tokens[repo] = resp.json()['token']
+        return self.tokens[repo]
+
+    def request(self, method, repo, reference, **kwargs):
+        url = f'{self.registry_url}/v2/{repo}/manifests/{reference}'
+        headers = kwargs.pop('headers', {})
+        resp = None
+        for refresh in [False, True]:
+            headers['Authorization'] = \
+                f'Bearer {self.get_token(repo, refresh)}'
+            resp = self.session.request(method, url, headers=headers,
+                                        **kwargs)
+            if resp.status_code != 401:
+                break
+        return resp
+
+    def get_manifest(self, repo, digest) -> Optional[requests.Response]:
+        """
+        :return: Response with the manifest for digest in repo, or None if
+            the repo doesn't have it
+        """
+        resp = self.request('GET', repo, digest,
+                            headers={'Accept': ', '.join(MANIFEST_TYPES)})
+        if resp.status_code == 404:
+            return None
+        resp.raise_for_status()
+        return resp
+
+    def retag(self, repo, digest, tag) -> bool:
+        """
+        Tag digest as repo:tag in the registry, no layers are transferred
+
+        :return: False if the repo doesn't have digest, so it needs pushing
+        """
+        manifest = self.get_manifest(repo, digest)
+        if manifest is None:
+            return False
+        resp = self.request(
+            'PUT', repo, tag, data=manifest.content,
+            headers={'Content-Type': manifest.headers['Content-Type']})
+        resp.raise_for_status()
+        return True
+
+
+class ArtifactPusher:
+    def __init__(self, docker_client, login, registry=None,
+                 path=ARTIFACT_PUSH_QUEUE_PATH,
+                 retry_delay=ARTIFACT_PUSH_RETRY_DELAY):
+        """
+        Saves the images evals ran with to ARTIFACT_REPO in the background,
+        so the instance doesn't wait on pushes to be available for the next
+        job. Images we've pushed before, like the problem image which is
+        the same for many evals, are just retagged in the registry, using
+        the digest the daemon recorded for ARTIFACT_REPO when we pushed.
+
+        Pending pushes are persisted to `path` and resumed after restarts.
+
+        :param docker_client: docker.DockerClient
+        :param login: Logs the daemon in to Docker Hub and returns the
+            credentials, called before pushing
+        :param registry: RegistryClient, created from the login credentials
+            if None
+        :param path: Where to persist pending pushes
+        :param retry_delay: Seconds before the first retry of a failed push
+        """
+        self.docker = docker_client
+        self.login = login
+        self.registry = registry
+        self.path = path
+        self.retry_delay = retry_delay
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.pending = self.load()  # tag => push
+        self.queued = list(self.pending.values())  # in order, to push
+        self.stopping = False
+        self.thread = None
+        self.stats = Box(num_retagged=0, num_pushed=0, num_failed=0,
+                         push_lag_secs=0., max_push_lag_secs=0.)
+
+    def load(self) -> dict:
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            return {p['tag']: Box(p) for p in read_json(self.path)}
+        except Exception:
+            log.exception('Could not load pending artifact pushes')
+            return {}
+
+    def save(self):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            write_json([p.to_dict() for p in self.pending.values()],
+                       self.path)
+        except Exception:
+            log.exception('Could not save pending artifact pushes')
+
+    def start(self):
+        if self.thread is None:
+            self.stopping = False
+            self.thread = threading.Thread(target=self.run, daemon=True,
+                                           name='artifact-pusher')
+            self.thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Wait up to timeout for queued pushes, they, and pushes waiting to
+        be retried, resume on restart
+        """
+        if self.thread is not None:
+            with self.cond:
+                self.stopping = True
+                self.cond.notify_all()
+            self.thread.join(timeout)
+            self.thread = None
+
+    def push(self, image, tag):
+        """
+        Queue saving a local image as ARTIFACT_REPO:tag
+
+        :param image: docker Image
+        :param tag: Tag within ARTIFACT_REPO
+        """
+        image.tag(ARTIFACT_REPO, tag)
+        push = Box(tag=tag, queued_at=time.time(), attempts=0)
+        with self.cond:
+            self.pending[tag] = push
+            self.save()
+            self.queued.append(push)
+            self.cond.notify_all()
+
+    @property
+    def pending_tags(self) -> list:
+        """Local tags that must be kept until they're pushed"""
+        with self.lock:
+            return [f'{ARTIFACT_REPO}:{tag}' for tag in self.pending]
+
+    def run(self):
+        while True:
+            push = self.next_push()
+            if push is None:
+                return
+            try:
+                self.push_now(push)
+            except Exception:
+                push.attempts += 1
+                if push.attempts >= ARTIFACT_PUSH_MAX_ATTEMPTS:
+                    log.exception(f'Giving up pushing {push.tag}')
+                    self.stats.num_failed += 1
+                    self.finished(push)
+                else:
+                    log.exception(f'Error pushing {push.tag}, retrying')
+                    push.retry_at = time.time() + \
+                        self.retry_delay * 2 ** push.attempts
+                    with self.cond:
+                        self.queued.append(push)
+
+    def next_push(self) -> Optional[Box]:
+        """
+        Waits, without polling, for the first queued push that isn't
+        waiting to be retried
+
+        :return: The push, or None once stopping and there are none due
+        """
+        with self.cond:
+            while True:
+                now = time.time()
+                for push in self.queued:
+                    if push.get('retry_at', 0) <= now:
+                        self.queued.remove(push)
+                        return push
+                if self.stopping:
+                    return None
+                next_at = min([p.retry_at for p in self.queued], default=None)
+                self.cond.wait(None if next_at is None else next_at - now)
+
+    def get_pushed_digest(self, tag) -> Optional[str]:
+        """
+        :return: Digest of the image in ARTIFACT_REPO, which the daemon
+            records when it pushes it there, so we've pushed it before if
+            it's known
+        """
+        image = self.docker.images.get(f'{ARTIFACT_REPO}:{tag}')
+        return get_digest(image, ARTIFACT_REPO)
+
+    def push_now(self, push):
+        creds = self.login()
+        if self.registry is None:
+            self.registry = RegistryClient(creds.username, creds.password)
+        digest = self.get_pushed_digest(push.tag)
+        with span('push', method='retag'):
+            retagged = digest and self.registry.retag(
+                ARTIFACT_REPO, digest, push.tag)
+        if retagged:
+            log.info(f'Retagged {digest} as {ARTIFACT_REPO}:{push.tag}')
+            self.stats.num_retagged += 1
+        else:
+            log.info(f'Pushing {ARTIFACT_REPO}:{push.tag} ...')
+            with span('push', method='push'):
+                for status in self.docker.images.push(
+                        ARTIFACT_REPO, push.tag, stream=True, decode=True):
+                    if 'error' in status:
+                        raise RuntimeError(status['error'])
+            log.info(f'Done pushing {ARTIFACT_REPO}:{push.tag}')
+            self.stats.num_pushed += 1
+        lag = time.time() - push.queued_at
+        self.stats.push_lag_secs = lag
+        self.stats.max_push_lag_secs = max(lag,
+                                           self.stats.max_push_lag_secs)
+        log.info(f'Push lag of {ARTIFACT_REPO}:{push.tag} was {lag:.1f}s')
+        self.finished(push)
+
+    def finished(self, push):
+        with self.lock:
+            self.pending.pop(push.tag, None)
+            self.save()
+        try:
+            # Only the local tag, the image has its original tag too
+            self.docker.images.remove(f'{ARTIFACT_REPO}:{push.tag}')
+        except Exception:
+            log.warning(f'Could not untag {ARTIFACT_REPO}:{push.tag}')
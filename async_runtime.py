@@ -0,0 +1,149 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from random import random
+
+from logs import log
+
+from constants import ASYNC_IO_THREADS, IMAGE_CACHE_CHECK_INTERVAL, \
+    LEASE_RECLAIM_INTERVAL, OLD_CONTAINER_CHECK_INTERVAL
+
+
+class AsyncRuntime:
+    def __init__(self, worker, io_threads=ASYNC_IO_THREADS):
+        """
+        Runs a Worker on an asyncio event loop. Checking for jobs,
+        housekeeping like reclaiming leases and evicting images, and
+        preparing for jobs while idle are separate tasks whose blocking
+        Firestore and Docker calls run on a pool of I/O threads, and jobs
+        run on the worker's job executor. So unlike in Worker.loop(), a
+        slow step in one doesn't hold up the others, and each housekeeping
+        task runs on its own interval rather than every loop.
+
+        :param worker: Worker to run
+        :param io_threads: Threads for blocking calls
+        """
+        self.worker = worker
+        self.io_executor = ThreadPoolExecutor(
+            max_workers=io_threads, thread_name_prefix='worker-io')
+        self.running = {}  # job id => future of the running job
+        self.preparing = None  # task preparing for jobs while idle
+
+    async def call(self, fn, *args):
+        """Runs a blocking call on an I/O thread"""
+        return await asyncio.get_running_loop().run_in_executor(
+            self.io_executor, functools.partial(fn, *args))
+
+    async def call_logged(self, fn):
+        """Like call(), but logs errors rather than raising them"""
+        try:
+            await self.call(fn)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception(f'Error in {fn.__name__}')
+
+    async def run(self, max_iters=None):
+        """
+        :param max_iters: Checks for jobs before stopping, for tests
+        :return: The last job checked for, once it's finished
+        """
+        worker = self.worker
+        await self.call(worker.start_services)
+        housekeeping = [asyncio.ensure_future(self.every(*args)) for args in (
+            (worker.evict_images, IMAGE_CACHE_CHECK_INTERVAL),
+            (worker.stop_old_containers_if_running,
+             OLD_CONTAINER_CHECK_INTERVAL),
+            # Requeue jobs of workers that died, with splay so workers
+            # don't all query at once
+            (worker.lease_keeper.reclaim_expired, LEASE_RECLAIM_INTERVAL,
+             0.5),
+        )]
+        try:
+            return await self.take_jobs(max_iters)
+        finally:
+            for task in housekeeping:
+                task.cancel()
+            await asyncio.gather(*housekeeping, return_exceptions=True)
+            if self.preparing is not None:
+                await self.preparing
+            await self.wait_for_jobs()
+            await self.call(worker.stop)
+            self.io_executor.shutdown(wait=True)
+
+    async def every(self, fn, interval, splay=0.):
+        """
+        :param interval: Seconds between calls
+        :param splay: Fraction of the interval to randomly vary it by
+        """
+        while True:
+            await self.call_logged(fn)
+            await asyncio.sleep(interval * (1 + splay * (2 * random() - 1)))
+
+    async def take_jobs(self, max_iters=None):
+        worker = self.worker
+        iters = 0
+        job = None
+        while not worker.should_stop():
+            if worker.pending_jobs:
+                job = worker.pending_jobs.popleft()
+            else:
+                job = await self.call(worker.check_for_jobs)
+            if job and not self.start_job(job):
+                # Wait for a running job to free up resources
+                worker.pending_jobs.appendleft(job)
+                await self.wait_for_jobs(timeout=1)
+            elif not job and not self.running:
+                self.prepare_for_jobs()
+
+            iters += 1
+            if max_iters is not None and iters >= max_iters:
+                # Used for testing
+                await self.wait_for_jobs()
+                return job
+
+            if not worker.job_intake.watching:
+                # Sleep with random splay to avoid thundering herd
+                await asyncio.sleep(0.5 + random())
+
+    def start_job(self, job) -> bool:
+        """
+        Runs the job on the worker's job executor if there are enough free
+        resources
+
+        :return: Whether the job was started
+        """
+        slot = self.worker.scheduler.reserve(job)
+        if slot is None:
+            return False
+        future = asyncio.get_running_loop().run_in_executor(
+            self.worker.job_executor, self.worker.run_job, job, slot)
+        self.running[job.id] = future
+        future.add_done_callback(functools.partial(self.on_job_done, job.id))
+        return True
+
+    def on_job_done(self, job_id, future):
+        self.running.pop(job_id, None)
+        if not future.cancelled() and future.exception() is not None:
+            log.opt(exception=future.exception()).error(
+                f'Error running job {job_id}')
+
+    async def wait_for_jobs(self, timeout=None):
+        """
+        :param timeout: Seconds to wait for the first running job to
+            finish, otherwise waits for all of them
+        """
+        if not self.running:
+            if timeout is not None:
+                await asyncio.sleep(timeout)
+            return
+        await asyncio.wait(
+            list(self.running.values()), timeout=timeout,
+            return_when=asyncio.ALL_COMPLETED if timeout is None else
+            asyncio.FIRST_COMPLETED)
+
+    def prepare_for_jobs(self):
+        """Prefetches images and fills the warm pool, unless already doing so"""
+        if self.preparing is None or self.preparing.done():
+            self.preparing = asyncio.ensure_future(
+                self.call_logged(self.worker.prepare_for_jobs))
@@ -1,70 +1,127 @@
 import os
+import threading
 import time
+from random import random
 
-import git
 from logs import log
 
+from constants import AUTO_UPDATE_CHECK_INTERVAL, AUTO_UPDATE_CHECK_JITTER
+
 ROOT_DIR = os.path.dirname(os.path.realpath(__file__))
 
 
 class AutoUpdater:
-    def __init__(self, is_on_gcp=False):
+    def __init__(self, is_on_gcp=False, repo_dir=ROOT_DIR,
+                 remote_branch='production',
+                 check_interval=AUTO_UPDATE_CHECK_INTERVAL):
+        """
+        Checks for new commits on the remote branch from a background
+        thread, getting just the remote ref's SHA with ls-remote, and only
+        pulls when it isn't already in our history. So local commits, or
+        merge commits made by pulling, don't cause a pull every check.
+
+        :param is_on_gcp: Only update on GCP, assume we're in dev otherwise
+        :param repo_dir: Local clone to update
+        :param remote_branch: Branch of origin to follow
+        :param check_interval: Seconds between checks
+        """
         self.is_on_gcp = is_on_gcp
+        self.repo_dir = repo_dir
+        self.remote_branch = remote_branch
+        self.check_interval = check_interval
         self.last_update_check_time = None
+        self.update_ready = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
         if not self.is_on_gcp:
             log.info('Not pulling latest on non-gcp machines, assuming you are '
                      'in dev')
 
     def updated(self) -> bool:
         """
+        Doesn't block on git, so can be called every loop
+
         :return: Whether or not we updated our local repo
         """
-        now = time.time()
         if not self.is_on_gcp:
-            ret = False
-        elif self.last_update_check_time is not None:
-            log.debug('Checking for source changes')
-            if now - self.last_update_check_time > 3:
-                ret = self.pull_latest(now)
-                self.last_update_check_time = time.time()
-            else:
-                ret = False
-        else:
-            ret = self.pull_latest(now)
-            self.last_update_check_time = time.time()
-        return ret
-
-    def pull_latest(self, now):
-        log.debug('Pulling latest from github..')
-        self.last_update_check_time = now
-        if pull_latest():
+            return False
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True,
+                                           name='auto-updater')
+            self.thread.start()
+        return self.update_ready.is_set()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                if self.check():
+                    return
+            except Exception:
+                log.exception('Error checking for source changes')
+            jitter = AUTO_UPDATE_CHECK_JITTER * (2 * random() - 1)
+            self.stopped.wait(self.check_interval * (1 + jitter))
+
+    def check(self) -> bool:
+        """
+        :return: Whether there were changes, which have now been pulled
+        """
+        log.debug('Checking for source changes')
+        self.last_update_check_time = time.time()
+        import git  # Slow to import, so not until we're up and running
+        repo = git.Repo(self.repo_dir)
+        remote_sha = get_remote_sha(repo, self.remote_branch)
+        if remote_sha is None or has_commit(repo, remote_sha):
+            return False
+        log.info(f'{self.remote_branch} is now at {remote_sha}, pulling')
+        if pull_latest(repo_dir=self.repo_dir,
+                       remote_branch=self.remote_branch):
             log.success('Pulled new changes')
-            ret = True
-        else:
-            ret = False
-        return ret
+            self.update_ready.set()
+            return True
+        return False
 
 
-def pull_latest(check_first=False, remote_branch='production'):
-    ret = False
-    repo = git.Repo(ROOT_DIR)
-    if check_first:
-        origin = [r for r in repo.remotes if r.name == 'origin'][0]
+def get_remote_sha(repo, remote_branch='production'):
+    """
+    :return: SHA of origin's branch, just asking the remote for its refs
+        rather than fetching
+    """
+    out = repo.git.ls_remote('origin', f'refs/heads/{remote_branch}')
+    return out.split()[0] if out else None
+
 
-        # Fetch all origin changes
-        origin.update()
+def has_commit(repo, sha) -> bool:
+    """
+    :return: Whether HEAD is at or already contains the commit
+    """
+    import git
+    if sha == repo.head.commit.hexsha:
+        return True
+    try:
+        return repo.is_ancestor(sha, 'HEAD')
+    except (git.GitCommandError, ValueError):
+        # Commit we haven't fetched yet
+        return False
 
-        head = repo.head.commit.hexsha
-        prod = [b for b in origin.refs
-                if b.name == f'origin/{remote_branch}'][0]
 
-        prod_head = prod.commit.hexsha
-        should_pull = head != prod_head
+def pull_latest(check_first=False, remote_branch='production',
+                repo_dir=ROOT_DIR):
+    import git
+    ret = False
+    repo = git.Repo(repo_dir)
+    if check_first:
+        remote_sha = get_remote_sha(repo, remote_branch)
+        should_pull = remote_sha is not None and \
+            not has_commit(repo, remote_sha)
     else:
         should_pull = True
 
     if should_pull:
-        pull_result = repo.git.pull('origin', remote_branch)
+        # Merge into local commits, newer git won't pick without being told
+        pull_result = repo.git.pull('--no-rebase', 'origin', remote_branch)
         if pull_result != 'Already up to date.':
             ret = True
             log.info(pull_result)
@@ -0,0 +1,667 @@
+"""
+Offline benchmarks against the in-process fakes in fakes.py.
+
+python bench.py                    # Run all benchmarks
+python bench.py bench_job_intake   # Run one
+"""
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from random import random, Random
+
+from box import Box
+from loguru import logger as log
+
+from problem_constants.constants import JOB_STATUS_ASSIGNED, \
+    JOB_STATUS_RUNNING, JOB_STATUS_FINISHED, JOB_TYPE_EVAL, \
+    JOB_TYPE_SIM_BUILD, JOB_TYPE_DEEPDRIVE_BUILD, INSTANCE_STATUS_AVAILABLE, \
+    INSTANCE_STATUS_USED, BOTLEAGUE_INNER_RESULTS_DIR_NAME
+
+from common import is_json
+from constants import CONTAINER_LOG_FLUSH_INTERVAL, SIM_PACKAGE_IMAGE_TAG, \
+    DEEPDRIVE_BUILD_IMAGE_TAG
+from container_monitor import ContainerMonitor, DockerEvents
+from fakes import FakeClient, FakeDB, FakeDocker, FakeGCSServer, \
+    FakeLiaisonServer, FakeRegistryClient, get_size, get_offline_worker
+from image_cache import ImageCache
+from image_index import ImageIndex
+from image_puller import ImagePuller
+from job_intake import JobIntake
+from job_model import Job
+from log_follower import LogFollower
+from problem_containers import WarmPool, make_mount_dir, get_volumes, \
+    get_static_env, get_eval_env, write_eval_spec
+from results_collector import ResultsCollector, get_results_path, \
+    read_results, summarize
+from utils import write_json, dbox
+
+
+def bench_job_intake(num_jobs=10, idle_secs=20):
+    """Pickup latency and Firestore reads per idle hour, polling vs watching
+    """
+    for use_watch in [False, True]:
+        mode = 'watch' if use_watch else 'poll'
+        jobs_db = FakeDB()
+        intake = JobIntake(jobs_db, 'bench-instance', use_watch=use_watch)
+        assigned_at = {}
+        latencies = []
+        stop = threading.Event()
+
+        def worker_loop():
+            # Same intake cadence as Worker.loop
+            while not stop.is_set():
+                job = intake.check(timeout=0.5 + random())
+                if job:
+                    latencies.append(time.time() - assigned_at[job.id])
+                    job.status = JOB_STATUS_RUNNING
+                    jobs_db.set(job.id, job)
+                if not intake.watching:
+                    time.sleep(0.5 + random())
+
+        intake.start()
+        thread = threading.Thread(target=worker_loop, daemon=True)
+        thread.start()
+
+        reads_before = jobs_db.collection.reads
+        time.sleep(idle_secs)
+        idle_reads = jobs_db.collection.reads - reads_before
+
+        for i in range(num_jobs):
+            job_id = f'bench_job_{i}'
+            assigned_at[job_id] = time.time()
+            jobs_db.set(job_id, dict(id=job_id, instance_id='bench-instance',
+                                     status=JOB_STATUS_ASSIGNED))
+            while len(latencies) <= i:
+                time.sleep(0.001)
+        stop.set()
+        thread.join()
+        intake.stop()
+
+        log.info(f'{mode}: '
+                 f'pickup latency avg {1000 * mean(latencies):.1f}ms '
+                 f'max {1000 * max(latencies):.1f}ms, '
+                 f'reads per idle hour '
+                 f'{idle_reads * 3600 / idle_secs:.0f}')
+
+
+def bench_container_monitor(num_containers=2, duration=10):
+    """Docker API calls per container-hour, polling vs events"""
+    for use_events in [False, True]:
+        mode = 'events' if use_events else 'poll'
+        docker = FakeDocker()
+        docker.behaviors['bench/problem'] = dict(duration=duration)
+        events = DockerEvents(docker) if use_events else None
+        if events:
+            events.start()
+        containers = [docker.containers.run('bench/problem')
+                      for _ in range(num_containers)]
+        calls_before = docker.api_calls
+        start = time.time()
+        followers = [LogFollower(c, level=None) for c in containers]
+        for follower in followers:
+            follower.start()
+
+        def flush_logs(_containers):
+            for _follower in followers:
+                _follower.flush()
+
+        _, success = ContainerMonitor(docker, events).run(
+            containers, on_wake=flush_logs,
+            wake_interval=CONTAINER_LOG_FLUSH_INTERVAL)
+        for follower in followers:
+            follower.join()
+        elapsed = time.time() - start
+        calls = docker.api_calls - calls_before
+        assert success
+        if events:
+            events.stop()
+        log.info(f'{mode}: {calls} API calls in {elapsed:.1f}s, '
+                 f'{calls * 3600 / elapsed / num_containers:.0f} '
+                 f'per container-hour')
+
+
+def bench_log_follower(lines_per_min=200000, duration=10):
+    """Throughput of following a chatty container's logs"""
+    docker = FakeDocker()
+    docker.behaviors['bench/chatty'] = dict(
+        duration=duration, lines_per_sec=lines_per_min / 60)
+    container = docker.containers.run('bench/chatty')
+    lines = []
+    max_batch = 0
+    follower = LogFollower(container, line_handlers=[lines.append])
+    start = time.time()
+    follower.start()
+    while container.state == 'running':
+        max_batch = max(max_batch, len(follower.batch))
+        follower.flush()
+        time.sleep(CONTAINER_LOG_FLUSH_INTERVAL)
+    follower.join()
+    elapsed = time.time() - start
+    produced = len(container.log_lines)
+    assert len(lines) == produced, 'Lines dropped'
+    assert len(set(lines)) == produced, 'Lines duplicated'
+    log.info(f'Followed {produced} lines in {elapsed:.1f}s '
+             f'({60 * produced / elapsed:.0f} lines/min), '
+             f'max batch {max_batch} lines')
+
+
+def bench_image_prefetch(problem_pull_secs=4, bot_pull_secs=2):
+    """Time to first container: sequential pulls vs concurrent vs prefetched
+    """
+    problem_tag = 'deepdriveio/deepdrive:problem_bench'
+    bot_tag = 'deepdriveio/deepdrive:bot_bench'
+    for mode in ['sequential', 'concurrent', 'prefetched']:
+        docker = FakeDocker()
+        docker.registry[problem_tag] = ('sha256:' + '1' * 64, 10 * 1024 ** 3)
+        docker.registry[bot_tag] = ('sha256:' + '2' * 64, 5 * 1024 ** 3)
+        docker.pull_secs = {problem_tag: problem_pull_secs,
+                            bot_tag: bot_pull_secs}
+        with tempfile.TemporaryDirectory() as state_dir:
+            puller = ImagePuller(
+                docker, history_path=f'{state_dir}/image_history.json',
+                index=ImageIndex(f'{state_dir}/image_index.json'))
+            if mode == 'prefetched':
+                # Problem was used by a previous job, then we were idle
+                puller.record_use([problem_tag])
+                puller.prefetch()
+                puller.pull(problem_tag).result()
+            start = time.time()
+            if mode == 'sequential':
+                images = [puller.pull_image(t) for t in [problem_tag, bot_tag]]
+            else:
+                images = puller.get_images([problem_tag, bot_tag])
+            assert None not in images
+            docker.containers.run(problem_tag)
+            log.info(f'{mode}: time to first container '
+                     f'{time.time() - start:.2f}s')
+
+
+def bench_image_freshness(num_jobs=20):
+    """Pulls, bandwidth and time spent getting images for repeat jobs"""
+    problem_tag = 'deepdriveio/deepdrive:problem_bench'
+    bot_tag = 'deepdriveio/deepdrive:bot_bench'
+    for use_index in [False, True]:
+        mode = 'digest index' if use_index else 'always pull'
+        docker = FakeDocker()
+        docker.registry[problem_tag] = ('sha256:' + '1' * 64, 10 * 1024 ** 3)
+        docker.registry[bot_tag] = ('sha256:' + '2' * 64, 5 * 1024 ** 3)
+        with tempfile.TemporaryDirectory() as state_dir:
+            puller = ImagePuller(
+                docker, history_path=f'{state_dir}/image_history.json',
+                index=ImageIndex(f'{state_dir}/image_index.json'))
+            start = time.time()
+            for i in range(num_jobs):
+                if i == num_jobs // 2:
+                    # Bot is re-pushed half way through
+                    docker.registry[bot_tag] = ('sha256:' + '3' * 64,
+                                                5 * 1024 ** 3)
+                for tag in [problem_tag, bot_tag]:
+                    if use_index:
+                        puller.pull_image(tag)
+                    else:
+                        docker.images.pull(tag)
+            log.info(f'{mode}: {docker.num_pulls} layer downloads, '
+                     f'{docker.bytes_pulled / 1024 ** 3:.0f}GB, '
+                     f'{docker.registry_checks} manifest checks, '
+                     f'{time.time() - start:.1f}s for {num_jobs} jobs')
+
+
+def get_job_trace(num_jobs, num_problems=5, num_bots=150, seed=0) -> list:
+    """
+    Image tags used by a sequence of eval jobs, 10 minutes apart. A few
+    problems get most of the jobs and bots are mostly run once.
+    """
+    rand = Random(seed)
+    trace = []
+    for i in range(num_jobs):
+        problem = int(rand.paretovariate(1.5)) % num_problems
+        bot = rand.randrange(num_bots)
+        trace.append((i * 10 * 60, [f'deepdriveio/deepdrive:problem_{problem}',
+                                    f'deepdriveio/deepdrive:bot_{bot}']))
+    return trace
+
+
+def bench_image_cache(num_jobs=500, problem_gb=10, bot_gb=5):
+    """Hit rate vs bytes re-pulled replaying a job trace, prune vs LRU"""
+    gb = 1024 ** 3
+    trace = get_job_trace(num_jobs)
+    for disk_gb in [None, 50, 100, 200]:
+        mode = 'prune every job' if disk_gb is None else f'LRU {disk_gb}GB'
+        docker = FakeDocker()
+        docker.default_pull_secs = docker.up_to_date_pull_secs = 0
+        for _, tags in trace:
+            for tag in tags:
+                size = problem_gb if 'problem_' in tag else bot_gb
+                digest = 'sha256:' + hashlib.sha256(tag.encode()).hexdigest()
+                docker.registry[tag] = (digest, size * gb)
+        now = [0.]
+        hits = requests = 0
+        seen = set()
+        bytes_repulled = 0
+        with tempfile.TemporaryDirectory() as state_dir:
+            cache = ImageCache(docker, path=f'{state_dir}/image_cache.json',
+                               disk_bytes=(disk_gb or 1) * gb,
+                               clock=lambda: now[0])
+            for job_time, tags in trace:
+                now[0] = job_time
+                cache.record_use(tags)
+                for tag in tags:
+                    requests += 1
+                    if tag in docker.local_images:
+                        hits += 1
+                    elif tag in seen:
+                        bytes_repulled += docker.registry[tag][1]
+                    seen.add(tag)
+                    docker.images.pull(tag)
+                if disk_gb is None:
+                    for image in docker.images.list():
+                        docker.images.remove(image.id, force=True)
+                else:
+                    cache.evict()
+        log.info(f'{mode}: {hits / requests:.0%} hit rate, '
+                 f'{docker.bytes_pulled / gb:.0f}GB pulled, '
+                 f'{bytes_repulled / gb:.0f}GB re-pulled over {num_jobs} jobs')
+
+
+def bench_warm_pool(num_evals=3, startup_secs=3):
+    """Time to first result line of evals, cold vs warm started problems"""
+    tag = 'deepdriveio/deepdrive:problem_bench'
+    for warm in [False, True]:
+        docker = FakeDocker()
+        docker.registry[tag] = ('sha256:' + '1' * 64, 10 * 1024 ** 3)
+        docker.images.pull(tag)
+        docker.behaviors[tag] = dict(startup_secs=startup_secs, duration=1)
+
+        def start_container(docker_tag, env, volumes, name):
+            return docker.containers.run(docker_tag, environment=env,
+                                         volumes=volumes, name=name)
+
+        times = []
+        with tempfile.TemporaryDirectory() as mount_base:
+            pool = WarmPool(docker, start_container, tags=[tag] if warm
+                            else [], size=1, mount_base=mount_base)
+            for i in range(num_evals):
+                # Idle between evals
+                pool.fill()
+                time.sleep(startup_secs + 0.5)
+
+                eval_spec = Box(eval_id=f'eval_{i}', eval_key='key', seed=i,
+                                problem='bench', problem_def={})
+                name = f'problem_eval_id_{eval_spec.eval_id}'
+                start = time.time()
+                entry = pool.claim(tag, name, eval_spec,
+                                   docker.images.get(tag).id)
+                if entry is not None:
+                    container = entry.container
+                else:
+                    results_mount = make_mount_dir(f'{mount_base}/{i}')
+                    spec_mount = make_mount_dir(f'{mount_base}/{i}_spec')
+                    write_eval_spec(spec_mount, eval_spec)
+                    env = get_static_env()
+                    env.update(get_eval_env(eval_spec))
+                    container = start_container(
+                        tag, env.to_dict(),
+                        get_volumes(results_mount, spec_mount), name)
+                while not container.log_lines:
+                    time.sleep(0.01)
+                times.append(time.time() - start)
+            pool.stop()
+        log.info(f'{"warm" if warm else "cold"}: time to first result '
+                 f'{mean(times):.2f}s average over {num_evals} evals')
+
+
+def get_job_mix(num_jobs, liaison_url, num_bots=5, seed=0) -> list:
+    """Mostly evals, with the odd sim and deepdrive build"""
+    rand = Random(seed)
+    jobs = []
+    for i in range(num_jobs):
+        job = Box(id=f'bench_job_{i}', status=JOB_STATUS_ASSIGNED,
+                  botleague_liaison_host=liaison_url)
+        r = rand.random()
+        if r < 0.8:
+            job.job_type = JOB_TYPE_EVAL
+            job.eval_spec = Box(
+                problem='bench', eval_id=f'eval_{i}', eval_key=f'key_{i}',
+                seed=i, problem_def={},
+                docker_tag=f'deepdriveio/deepdrive:bot_'
+                           f'{rand.randrange(num_bots)}',
+                full_eval_request=dict(problem_id='deepdrive/bench',
+                                       username='bench', botname='bench'))
+        else:
+            job.job_type = JOB_TYPE_SIM_BUILD if r < 0.9 else \
+                JOB_TYPE_DEEPDRIVE_BUILD
+            job.commit = f'{i:040x}'
+            job.branch = 'master'
+            job.build_id = f'build_{i}'
+        jobs.append(job)
+    return jobs
+
+
+def get_job_tags(job) -> list:
+    if job.job_type == JOB_TYPE_EVAL:
+        return ['deepdriveio/deepdrive:problem_bench', job.eval_spec.docker_tag]
+    elif job.job_type == JOB_TYPE_SIM_BUILD:
+        return [SIM_PACKAGE_IMAGE_TAG]
+    else:
+        return [DEEPDRIVE_BUILD_IMAGE_TAG]
+
+
+def bench_worker(num_jobs=20, idle_secs=10, container_secs=1.,
+                 num_episodes=1000, use_async=False, reclaim_secs=0.):
+    """
+    Jobs per hour, pickup latency, idle CPU, and API calls and bytes written
+    per job, running
+    the Worker loop against fakes with a job mix handed out like the
+    coordinator does, i.e. one at a time once the instance is available
+
+    :param use_async: Run the worker with run_async() rather than loop()
+    :param reclaim_secs: Seconds each check for expired leases takes, as if
+        Firestore were slow
+    """
+    instance_id = 'bench_instance'
+    gcs = FakeGCSServer()
+    liaison = FakeLiaisonServer()
+    docker = FakeDocker()
+    docker.default_pull_secs = 0.5
+    docker.up_to_date_pull_secs = docker.manifest_secs = 0.01
+    client = FakeClient()
+    jobs_db = FakeDB(use_boxes=True, client=client)
+    instances_db = FakeDB(use_boxes=True, client=client)
+    job_results_db = FakeDB(use_boxes=True, client=client)
+    dbs = [jobs_db, instances_db, job_results_db]
+    instances_db.set(instance_id, dict(status=INSTANCE_STATUS_AVAILABLE))
+    jobs = get_job_mix(num_jobs, liaison.url)
+    results = dict(score=1, episodes=[dict(score=1., steps=1000)
+                                      for _ in range(num_episodes)])
+    for job in jobs:
+        for tag in get_job_tags(job):
+            digest = 'sha256:' + hashlib.sha256(tag.encode()).hexdigest()
+            docker.registry[tag] = (digest, 1024 ** 3)
+            docker.behaviors[tag] = dict(duration=container_secs,
+                                         lines_per_sec=100,
+                                         results=results)
+
+    def get_status(db, key):
+        # Straight from the fake so we don't count our own reads
+        with db.collection.lock:
+            return (db.collection.docs.get(key) or {}).get('status')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        worker = get_offline_worker(
+            tmp, docker, jobs_db, instances_db, instance_id,
+            log_bucket=gcs.client().bucket('bench_logs'),
+            job_results_db=job_results_db)
+        if reclaim_secs:
+            worker.lease_keeper.maybe_reclaim = \
+                worker.lease_keeper.reclaim_expired = \
+                lambda: time.sleep(reclaim_secs)
+        thread = threading.Thread(
+            target=worker.run_async if use_async else worker.loop,
+            daemon=True)
+        thread.start()
+        try:
+            time.sleep(1)  # Start up
+            cpu_start = time.process_time()
+            time.sleep(idle_secs)
+            idle_cpu = (time.process_time() - cpu_start) / idle_secs
+
+            api_calls = docker.api_calls
+            ops = sum(db.collection.reads + db.collection.writes
+                      for db in dbs)
+            bytes_written = sum(db.collection.bytes_written for db in dbs)
+            job_bytes_written = jobs_db.collection.bytes_written
+            handout_bytes = 0
+            pickup_secs = []
+            start = time.time()
+            for job in jobs:
+                while get_status(instances_db, instance_id) != \
+                        INSTANCE_STATUS_AVAILABLE:
+                    time.sleep(0.005)
+                job.instance_id = instance_id
+                instances_db.set(instance_id,
+                                 dict(status=INSTANCE_STATUS_USED))
+                jobs_db.set(job.id, job)
+                handout_bytes += get_size(job.to_dict())
+                assigned_at = time.time()
+                while get_status(jobs_db, job.id) == JOB_STATUS_ASSIGNED:
+                    time.sleep(0.005)
+                pickup_secs.append(time.time() - assigned_at)
+            while get_status(jobs_db, jobs[-1].id) != JOB_STATUS_FINISHED:
+                time.sleep(0.005)
+            elapsed = time.time() - start
+            api_calls = docker.api_calls - api_calls
+            # Less our two writes to hand out each job
+            ops = sum(db.collection.reads + db.collection.writes
+                      for db in dbs) - ops - 2 * num_jobs
+            bytes_written = sum(db.collection.bytes_written for db in dbs) - \
+                bytes_written - handout_bytes - \
+                num_jobs * get_size(dict(status=INSTANCE_STATUS_USED))
+            job_bytes_written = jobs_db.collection.bytes_written - \
+                job_bytes_written - handout_bytes
+        finally:
+            worker.stop_requested.set()
+            thread.join()
+            gcs.stop()
+            liaison.stop()
+    finished = [jobs_db.get(j.id) for j in jobs]
+    num_errors = sum(1 for j in finished
+                     if j.get('worker_error') or j.results.errors)
+    container_time = sum(container_secs for _ in jobs)
+    log.info(f'{"Async" if use_async else "Sync"} worker: '
+             f'{num_jobs} jobs ({num_errors} errored) in {elapsed:.1f}s, '
+             f'{3600 * num_jobs / elapsed:.0f} jobs/hour, '
+             f'{(elapsed - container_time) / num_jobs:.2f}s overhead/job')
+    log.info(f'Pickup latency {mean(pickup_secs) * 1000:.0f}ms average, '
+             f'{max(pickup_secs) * 1000:.0f}ms max')
+    log.info(f'Idle CPU {idle_cpu:.1%}, {api_calls / num_jobs:.0f} Docker '
+             f'API calls/job, {ops / num_jobs:.0f} Firestore ops/job, '
+             f'{bytes_written / num_jobs / 1024:.1f}KB written/job, '
+             f'{job_bytes_written / num_jobs / 1024:.1f}KB of it to the job')
+
+
+def bench_async_runtime(num_jobs=10, reclaim_secs=2.):
+    """
+    bench_worker with the synchronous loop vs the asyncio runtime, where
+    checking for expired leases is slow and so holds up picking up jobs
+    in the synchronous loop
+    """
+    for use_async in [False, True]:
+        bench_worker(num_jobs=num_jobs, idle_secs=1, use_async=use_async,
+                     reclaim_secs=reclaim_secs)
+
+
+def bench_startup(runs=5, num_slowest=10):
+    """
+    Seconds to import the worker in a fresh interpreter, the modules that
+    take longest to import, and seconds from then until we're watching for
+    jobs. Startup is job pickup downtime after every auto update.
+    """
+    import_secs = []
+    module_secs = {}
+    for _ in range(runs):
+        out = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c',
+             'import time; start = time.time(); import worker; '
+             'print(time.time() - start)'],
+            capture_output=True, text=True, check=True)
+        import_secs.append(float(out.stdout.split()[-1]))
+        for line in out.stderr.splitlines():
+            # import time: self [us] | cumulative | imported package
+            parts = line.split('|')
+            if len(parts) == 3 and parts[0].split(':')[-1].strip().isdigit():
+                # By package, e.g. google.cloud.firestore_v1, git
+                name = parts[2].strip().split('.')
+                name = '.'.join(name[:3] if name[0] == 'google' else name[:1])
+                module_secs[name] = module_secs.get(name, 0) + \
+                    int(parts[0].split(':')[-1]) / 1e6 / runs
+    log.info(f'Import worker: {mean(import_secs):.2f}s average, '
+             f'{min(import_secs):.2f}s min over {runs} runs')
+    slowest = sorted(module_secs.items(), key=lambda m: -m[1])[:num_slowest]
+    log.info('Slowest packages to import: ' +
+             ', '.join(f'{name} {secs * 1000:.0f}ms'
+                       for name, secs in slowest))
+
+    instance_id = 'bench_instance'
+    client = FakeClient()
+    jobs_db = FakeDB(use_boxes=True, client=client)
+    instances_db = FakeDB(use_boxes=True, client=client)
+    instances_db.set(instance_id, dict(status=INSTANCE_STATUS_AVAILABLE))
+    with tempfile.TemporaryDirectory() as tmp:
+        start = time.time()
+        worker = get_offline_worker(tmp, FakeDocker(), jobs_db, instances_db,
+                                    instance_id)
+        init_secs = time.time() - start
+        thread = threading.Thread(target=worker.loop, daemon=True)
+        thread.start()
+        while not worker.job_intake.watching:
+            time.sleep(0.001)
+        ready_secs = time.time() - start
+        worker.stop_requested.set()
+        thread.join()
+    log.info(f'Worker init {init_secs * 1000:.0f}ms, watching for jobs '
+             f'after {ready_secs * 1000:.0f}ms')
+
+
+def bench_results_ingest(num_evals=20, num_episodes=100000):
+    """
+    Milliseconds per eval to make the results mount and read results.json
+    with the old chmod subprocess and double parse, vs the results collector
+    """
+    results = dict(score=1, episodes=[dict(score=random(), steps=1000)
+                                      for _ in range(num_episodes)])
+    with tempfile.TemporaryDirectory() as tmp:
+        old_secs = []
+        new_secs = []
+        for i in range(num_evals):
+            start = time.time()
+            os.makedirs(f'{tmp}/old_{i}')
+            os.system(f'chmod -R 777 {tmp}/old_{i}')
+            old_secs.append(time.time() - start)
+            start = time.time()
+            make_mount_dir(f'{tmp}/new_{i}')
+            new_secs.append(time.time() - start)
+        log.info(f'Results mount: chmod -R {mean(old_secs) * 1000:.1f}ms, '
+                 f'make_writable {mean(new_secs) * 1000:.1f}ms')
+
+        results_dir = f'{tmp}/new_0'
+        os.makedirs(f'{results_dir}/{BOTLEAGUE_INNER_RESULTS_DIR_NAME}')
+        write_json(results, get_results_path(results_dir))
+        start = time.time()
+        for _ in range(num_evals):
+            result_str = open(get_results_path(results_dir)).read()
+            if is_json(result_str):
+                json.loads(result_str)
+        old_secs = (time.time() - start) / num_evals
+        start = time.time()
+        for _ in range(num_evals):
+            read_results(get_results_path(results_dir))
+        new_secs = (time.time() - start) / num_evals
+
+        # Already parsed by the watcher while the container ran
+        collector = ResultsCollector(results_dir)
+        collector.collect()
+        start = time.time()
+        collector.get_results()
+        final_secs = time.time() - start
+    log.info(f'Parse {num_episodes} episode results: read and parse twice '
+             f'{old_secs * 1000:.0f}ms, parse once {new_secs * 1000:.0f}ms, '
+             f'already watched {final_secs * 1000:.1f}ms')
+    log.info(f'Logged results {len(json.dumps(results, indent=2)) // 1024}'
+             f'KB, summarized '
+             f'{len(json.dumps(summarize(results), indent=2)) // 1024}KB')
+
+
+def bench_job_model(num_jobs=20, num_episodes=10000):
+    """
+    Milliseconds per job spent copying, updating and logging a large job
+    document with big results, as Box, vs Job
+    """
+    from copy import deepcopy
+    problem_def = dict(container_postfix='', problem_ci_replace_sim_url=None,
+                       config={f'param_{i}': i for i in range(1000)})
+    doc = dict(
+        id='bench_job', status=JOB_STATUS_ASSIGNED, job_type=JOB_TYPE_EVAL,
+        instance_id='bench-instance', botleague_liaison_host='http://liaison',
+        eval_spec=dict(eval_id='eval', eval_key='key', seed=1,
+                       problem='bench', docker_tag='bench/bot',
+                       problem_def=problem_def,
+                       full_eval_request=dict(problem_id='deepdrive/bench',
+                                              username='bench',
+                                              botname='bench')))
+    results = dict(score=1, episodes=[dict(score=random(), steps=1000)
+                                      for _ in range(num_episodes)])
+
+    def box2json(box):
+        return json.dumps(box.to_dict(), indent=2, default=str)
+
+    start = time.time()
+    log_bytes = 0
+    for _ in range(num_jobs):
+        job = Box(doc)
+        deepcopy(job)  # set_job_atomic
+        log_bytes += len(box2json(job))  # Running job
+        job = Box({**job.to_dict(), **dict(status=JOB_STATUS_RUNNING)})
+        for _ in range(3):
+            dbox(job.eval_spec.problem_def).problem_ci_replace_sim_url
+        job.results = Box(results)
+        job = Box({**job.to_dict(), **dict(status=JOB_STATUS_FINISHED)})
+        log_bytes += len(box2json(job))  # Finished job
+    box_secs = (time.time() - start) / num_jobs
+    box_log_bytes = log_bytes / num_jobs
+
+    start = time.time()
+    log_bytes = 0
+    for _ in range(num_jobs):
+        job = Job.from_dict(doc)
+        log_bytes += len(job.to_json())
+        job = job.replace(status=JOB_STATUS_RUNNING)
+        for _ in range(3):
+            (job.eval_spec.problem_def or {}).get('problem_ci_replace_sim_url')
+        job.update(dict(results=results, status=JOB_STATUS_FINISHED))
+        log_bytes += len(job.to_json())
+    job_secs = (time.time() - start) / num_jobs
+    job_log_bytes = log_bytes / num_jobs
+
+    log.info(f'Job with {num_episodes} episode results: Box '
+             f'{box_secs * 1000:.1f}ms, {box_log_bytes / 1024:.0f}KB logged, '
+             f'Job {job_secs * 1000:.1f}ms, {job_log_bytes / 1024:.0f}KB '
+             f'logged, per job')
+
+
+def mean(values):
+    return sum(values) / len(values) if values else 0
+
+
+def run_all(current_module):
+    log.info('Running all benchmarks')
+    num = 0
+    for attr in dir(current_module):
+        if attr.startswith('bench_'):
+            num += 1
+            log.info('Running ' + attr)
+            getattr(current_module, attr)()
+    return num
+
+
+def main():
+    # Don't print container output
+    log.remove(0)
+    log.add(sys.stderr, level='INFO')
+
+    bench_module = sys.modules[__name__]
+    if len(sys.argv) > 1:
+        bench_name = sys.argv[1]
+        log.info('Running ' + bench_name)
+        getattr(bench_module, bench_name)()
+    else:
+        num = run_all(bench_module)
+        log.success(f'{num} benchmarks ran')
+
+
+if __name__ == '__main__':
+    main()
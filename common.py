@@ -1,5 +1,6 @@
 import json
 import os
+from functools import lru_cache
 from typing import Tuple
 
 import requests
@@ -11,6 +12,8 @@ from botleague_helpers.db import get_db
 from problem_constants.constants import JOBS_COLLECTION_NAME, METADATA_URL, \
     WORKER_INSTANCES_COLLECTION_NAME
 
+from constants import JOB_RESULTS_COLLECTION_NAME
+
 
 def is_json(string: str):
     try:
@@ -27,6 +30,13 @@ def get_jobs_db():
     )
 
 
+def get_job_results_db():
+    return get_db(
+        JOB_RESULTS_COLLECTION_NAME,
+        force_firestore_db=should_force_firestore_db()
+    )
+
+
 def get_worker_instances_db():
     return get_db(
         WORKER_INSTANCES_COLLECTION_NAME,
@@ -34,12 +44,21 @@ def get_worker_instances_db():
     )
 
 
+@lru_cache()
 def get_secrets_db():
+    # Cached so the client and its connections are reused across jobs
     return get_db(
         'secrets',
         force_firestore_db=should_force_firestore_db()
     )
 
+
+@lru_cache()
+def get_storage_client():
+    # Auth is by virtue of VM access level
+    from google.cloud import storage
+    return storage.Client()
+
 def fetch_instance_id() -> Tuple[str, bool]:
     if in_test() or 'INSTANCE_ID' in os.environ:
         ret = os.environ['INSTANCE_ID']
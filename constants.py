@@ -3,3 +3,160 @@ import os
 SIM_PACKAGE_IMAGE_TAG = 'deepdriveio/private:deepdrive-sim-package'
 DEEPDRIVE_BUILD_IMAGE_TAG = 'deepdriveio/deepdrive:ci'
 STACKDRIVER_LOG_NAME = 'deepdrive-worker'
+
+# Have jobs pushed to us via a Firestore watch instead of polling
+JOB_WATCH = os.environ.get('JOB_WATCH', 'true') == 'true'
+JOB_WATCH_FIRST_SNAPSHOT_TIMEOUT = 10
+JOB_WATCH_RETRY_INTERVAL = 60
+
+# Seconds between container inspects when the Docker events stream is down
+CONTAINER_POLL_INTERVAL = 0.1
+
+# Inspect all containers at least this often, even with the events stream up
+CONTAINER_SAFETY_POLL_INTERVAL = 30
+
+# Seconds between logging batches of followed container log lines
+CONTAINER_LOG_FLUSH_INTERVAL = 1
+CONTAINER_LOG_MAX_BATCH_LINES = 1000
+CONTAINER_LOG_MAX_LINE_BYTES = 64 * 1024
+
+# Times to reconnect to a running container's log stream if it drops, and
+# seconds to wait before each reconnect
+CONTAINER_LOG_MAX_RECONNECTS = 5
+CONTAINER_LOG_RECONNECT_DELAY = 1
+
+# Container output logged to the main log sinks, after which only every
+# CONTAINER_LOG_SAMPLE_EVERY'th line is. Full logs go to GCS, and to a file
+# in the worker state dir until uploaded, see log_capture.py
+CONTAINER_LOG_MAX_LOGGED_BYTES = int(
+    os.environ.get('CONTAINER_LOG_MAX_LOGGED_BYTES', 1024 * 1024))
+CONTAINER_LOG_SAMPLE_EVERY = 100
+CONTAINER_LOG_FILE_MAX_AGE = 24 * 60 * 60
+
+# Recent log records kept per job, e.g. for a job's worker_error
+JOB_LOG_MAX_CHARS = 64 * 1024
+JOB_LOG_MAX_RECORD_CHARS = 4 * 1024
+
+# Size of each part of the resumable log upload, must be a multiple of 256KB
+LOG_UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Jobs to run at once, resources permitting. See scheduler.py
+WORKER_MAX_JOBS = int(os.environ.get('WORKER_MAX_JOBS', 1))
+
+# Run the worker on an asyncio event loop rather than the synchronous loop,
+# see async_runtime.py
+WORKER_ASYNC = os.environ.get('WORKER_ASYNC', 'false') == 'true'
+
+# Threads for blocking Firestore, Docker, etc... calls made from the event
+# loop
+ASYNC_IO_THREADS = 8
+
+# Seconds between checks for containers left running by old jobs, when
+# running on the event loop
+OLD_CONTAINER_CHECK_INTERVAL = 10
+
+# Local state that should survive worker restarts
+WORKER_STATE_DIR = os.environ.get(
+    'WORKER_STATE_DIR',
+    os.path.join(os.path.dirname(os.path.realpath(__file__)), 'worker_state'))
+
+IMAGE_PULL_CONCURRENCY = 4
+
+# Seconds between prefetching the same image while idle
+IMAGE_PREFETCH_INTERVAL = 10 * 60
+IMAGE_PREFETCH_MAX_TAGS = 3
+
+# Seconds a tag's local image is trusted without checking the registry's
+# digest, after which we do a cheap manifest check and only pull if it
+# changed. Bot tags are checked every job in case they were re-pushed.
+IMAGE_FRESHNESS_SECS = dict(
+    bot=float(os.environ.get('IMAGE_FRESHNESS_SECS_BOT', 0)),
+    problem=float(os.environ.get('IMAGE_FRESHNESS_SECS_PROBLEM', 10 * 60)),
+    build=float(os.environ.get('IMAGE_FRESHNESS_SECS_BUILD', 0)),
+)
+
+# Seconds between checking disk usage and evicting images. See image_cache.py
+IMAGE_CACHE_CHECK_INTERVAL = 60
+
+# Fractions of the Docker disk. Above the high water mark, images are
+# evicted least recently used first until usage is below the low water mark.
+IMAGE_CACHE_HIGH_WATER = float(os.environ.get('IMAGE_CACHE_HIGH_WATER', 0.85))
+IMAGE_CACHE_LOW_WATER = float(os.environ.get('IMAGE_CACHE_LOW_WATER', 0.7))
+
+# Disk space for Docker images. If not set, usage is measured on the Docker
+# root filesystem, which must be mounted in the worker's container, see
+# RUN_ARGS in the Makefile
+IMAGE_CACHE_DISK_BYTES = \
+    float(os.environ['IMAGE_CACHE_DISK_GB']) * 1024 ** 3 \
+    if os.environ.get('IMAGE_CACHE_DISK_GB') else None
+
+# Problem and sim images used this recently are never evicted
+IMAGE_CACHE_PIN_SECS = 7 * 24 * 60 * 60
+
+# Images used this recently may be about to run, so are never evicted
+IMAGE_CACHE_MIN_IDLE_SECS = 10 * 60
+
+# Eval artifact pushes to deepdriveio/botleague, see artifact_pusher.py.
+# Retries back off exponentially from ARTIFACT_PUSH_RETRY_DELAY seconds.
+ARTIFACT_PUSH_MAX_ATTEMPTS = 5
+ARTIFACT_PUSH_RETRY_DELAY = 30
+
+# Results delivery to the liaison, see results_outbox.py. Retries back off
+# exponentially from RESULTS_RETRY_DELAY up to RESULTS_RETRY_MAX_DELAY
+# seconds, results that can't be delivered for RESULTS_MAX_AGE are dropped.
+RESULTS_RETRY_DELAY = 1
+RESULTS_RETRY_MAX_DELAY = 5 * 60
+RESULTS_MAX_AGE = 24 * 60 * 60
+RESULTS_POST_TIMEOUT = 60
+
+# Workers renew leases on their instance and running jobs every
+# LEASE_RENEW_INTERVAL seconds. Running jobs whose lease is LEASE_DURATION
+# seconds old are requeued by other workers, up to LEASE_MAX_RECLAIMS times.
+LEASE_RENEW_INTERVAL = float(os.environ.get('LEASE_RENEW_INTERVAL', 10))
+LEASE_DURATION = float(os.environ.get('LEASE_DURATION', 60))
+LEASE_RECLAIM_INTERVAL = 30
+LEASE_MAX_RECLAIMS = 3
+
+# Seconds that workers' clocks may differ by, which leases are given on top
+# of LEASE_DURATION before they're reclaimed
+LEASE_CLOCK_SKEW = float(os.environ.get('LEASE_CLOCK_SKEW', 30))
+
+# Seconds between checking the production branch for changes, +/- jitter
+# fraction so the fleet doesn't hit GitHub at once
+AUTO_UPDATE_CHECK_INTERVAL = float(
+    os.environ.get('AUTO_UPDATE_CHECK_INTERVAL', 30))
+AUTO_UPDATE_CHECK_JITTER = 0.2
+
+# Docker label on the containers workers start, set to the instance id
+WORKER_CONTAINER_LABEL = 'io.deepdrive.botleague.worker'
+
+# Problem image tags to keep warm containers running for, comma separated,
+# see problem_containers.WarmPool. Only used when running one job at a time.
+WARM_POOL_TAGS = [t for t in os.environ.get('WARM_POOL_TAGS', '').split(',')
+                  if t]
+WARM_POOL_SIZE = int(os.environ.get('WARM_POOL_SIZE', 1))
+
+# Local port to serve Prometheus metrics on, see metrics.py. 0 to disable.
+# Only served on loopback unless METRICS_HOST is set, e.g. to 0.0.0.0 for a
+# scraper on another host, as metrics include job and instance details.
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 9101))
+METRICS_HOST = os.environ.get('METRICS_HOST', '127.0.0.1')
+
+# Seconds to keep decrypted secrets in memory, and how far through that
+# they're refreshed in the background. See secrets_cache.py
+SECRETS_TTL = 60 * 60
+SECRETS_REFRESH_FRACTION = 0.75
+
+# Seconds between checks for a problem container's results.json, when
+# inotify isn't available, and the least seconds between forwarding partial
+# results to the job. See results_collector.py
+RESULTS_WATCH_POLL_INTERVAL = 0.5
+PARTIAL_RESULTS_INTERVAL = float(
+    os.environ.get('PARTIAL_RESULTS_INTERVAL', 30))
+
+# Lists in results longer than this are cut short when logged
+RESULTS_LOG_MAX_LIST_LEN = 10
+
+# Full results of jobs whose results are summarized in the job document,
+# see job_store.py
+JOB_RESULTS_COLLECTION_NAME = 'job_results'
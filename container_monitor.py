@@ -0,0 +1,256 @@
+import threading
+import time
+from queue import Queue, Empty
+
+from logs import log
+
+from constants import CONTAINER_POLL_INTERVAL, \
+    CONTAINER_SAFETY_POLL_INTERVAL, WORKER_CONTAINER_LABEL
+
+# Container state changes we need to re-inspect on
+MONITORED_EVENTS = ['die', 'oom', 'kill', 'stop', 'health_status']
+
+# Also needed to keep track of which containers are running
+TRACKED_EVENTS = MONITORED_EVENTS + ['start', 'destroy']
+
+# Put on subscriber queues when events may have been missed
+RECONNECTED = None
+
+
+class DockerEvents:
+    def __init__(self, docker_client):
+        """
+        Single reader of the Docker events stream which wakes up
+        subscribers when containers they are interested in change state,
+        and passes every event to listeners.
+        """
+        self.docker = docker_client
+        self.lock = threading.Lock()
+        self.subscribers = []  # (container ids, queue)
+        self.listeners = []
+        self.stream = None
+        self.thread = None
+        self.connected = threading.Event()
+        self.stopped = False
+
+    def start(self):
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, daemon=True,
+                                       name='docker-events')
+        self.thread.start()
+
+        # Give the stream a chance to connect so that subscribers
+        # don't start out polling
+        self.connected.wait(timeout=5)
+
+    def stop(self):
+        self.stopped = True
+        if self.stream is not None:
+            self.stream.close()
+
+    def run(self):
+        while not self.stopped:
+            try:
+                self.stream = self.docker.events(
+                    decode=True, filters={'type': 'container',
+                                          'event': TRACKED_EVENTS})
+                self.connected.set()
+                for event in self.stream:
+                    self.dispatch(event)
+            except Exception:
+                log.exception('Docker events stream failed')
+            self.connected.clear()
+            if not self.stopped:
+                # Events could have been missed while disconnected
+                self.broadcast(RECONNECTED)
+                time.sleep(1)
+
+    def subscribe(self, container_ids) -> Queue:
+        queue = Queue()
+        with self.lock:
+            self.subscribers.append((set(container_ids), queue))
+        return queue
+
+    def add_listener(self, callback):
+        """
+        :param callback: Called from the reader thread with each event, or
+            RECONNECTED when events may have been missed
+        """
+        with self.lock:
+            self.listeners.append(callback)
+
+    def unsubscribe(self, queue):
+        with self.lock:
+            self.subscribers = [s for s in self.subscribers
+                                if s[1] is not queue]
+
+    def dispatch(self, event):
+        container_id = event.get('id') or event['Actor']['ID']
+        action = event.get('status') or event.get('Action') or ''
+        with self.lock:
+            if action.split(':')[0] in MONITORED_EVENTS:
+                for container_ids, queue in self.subscribers:
+                    if container_id in container_ids:
+                        queue.put(container_id)
+            listeners = list(self.listeners)
+        for listener in listeners:
+            listener(event)
+
+    def broadcast(self, item):
+        with self.lock:
+            for _, queue in self.subscribers:
+                queue.put(item)
+            listeners = list(self.listeners)
+        for listener in listeners:
+            listener(item)
+
+
+class WorkerContainers:
+    def __init__(self, docker_client, events: DockerEvents):
+        """
+        Which containers labelled WORKER_CONTAINER_LABEL, i.e. started by a
+        worker, are running. Listed once with a label filter, then kept up
+        to date from Docker events, so checking costs no API calls.
+
+        :param docker_client: docker.DockerClient
+        :param events: Shared events stream
+        """
+        self.docker = docker_client
+        self.events = events
+        self.lock = threading.Lock()
+        self.running_ids = set()
+        self.synced = False
+        events.add_listener(self.on_event)
+
+    def sync(self):
+        containers = self.docker.containers.list(
+            filters={'label': WORKER_CONTAINER_LABEL})
+        with self.lock:
+            self.running_ids = set(c.id for c in containers)
+            self.synced = True
+
+    def on_event(self, event):
+        with self.lock:
+            if event is RECONNECTED:
+                self.synced = False
+                return
+            attributes = event.get('Actor', {}).get('Attributes') or {}
+            if WORKER_CONTAINER_LABEL not in attributes:
+                return
+            container_id = event.get('id') or event['Actor']['ID']
+            action = (event.get('status') or event.get('Action')).split(':')[0]
+            if action == 'start':
+                self.running_ids.add(container_id)
+            elif action in ['die', 'destroy']:
+                self.running_ids.discard(container_id)
+
+    def get_running_ids(self) -> set:
+        if not self.synced or not self.events.connected.is_set():
+            # List until we can rely on events
+            self.sync()
+        with self.lock:
+            return set(self.running_ids)
+
+
+class ContainerMonitor:
+    def __init__(self, docker_client, events: DockerEvents = None):
+        """
+        Waits for containers to finish, inspecting them only when the Docker
+        events stream says they've changed state. Falls back to polling
+        every CONTAINER_POLL_INTERVAL if there's no events stream.
+
+        :param docker_client: docker.DockerClient
+        :param events: Shared events stream, polls if None
+        """
+        self.docker = docker_client
+        self.events = events
+
+    def run(self, containers, on_wake=None, wake_interval=None):
+        """
+        :param containers: Started containers to monitor
+        :param on_wake: Called with the containers every time we wake up,
+            i.e. to tail logs
+        :param wake_interval: Max seconds between calls to on_wake
+        :return: Refreshed containers, whether they all succeeded
+        """
+        success = True
+        queue = None
+        if self.events is not None:
+            # Subscribe before the first inspect so we can't miss an exit
+            queue = self.events.subscribe([c.id for c in containers])
+        try:
+            containers = self.refresh(containers)
+            last_full_refresh = time.time()
+            while True:
+                running = [c for c in containers if c.status in
+                           ['created', 'running']]
+                if on_wake is not None:
+                    on_wake(containers)
+
+                # TODO: For N bots or N problems, we probably want to make a
+                #  best effort so long as at least 1 bot and one problem are
+                #  still alive.
+                dead = [c for c in containers if c.status == 'dead']
+                failed = [c for c in containers
+                          if c.attrs['State']['ExitCode'] > 0]
+
+                if dead:
+                    success = False
+                    log.error(f'Dead container(s) found: {dead}')
+
+                if failed:
+                    success = False
+                    log.error(f'Containers failed: {failed}')
+
+                if not running or dead or failed:
+                    break
+
+                if queue is None or not self.events.connected.is_set():
+                    time.sleep(CONTAINER_POLL_INTERVAL)
+                    changed = None
+                else:
+                    changed = self.wait_for_events(
+                        queue, timeout=wake_interval or
+                        CONTAINER_SAFETY_POLL_INTERVAL)
+                    if changed is not None and time.time() - \
+                            last_full_refresh > \
+                            CONTAINER_SAFETY_POLL_INTERVAL:
+                        changed = None
+                if changed is None:
+                    last_full_refresh = time.time()
+                containers = self.refresh(containers, changed)
+        finally:
+            if queue is not None:
+                self.events.unsubscribe(queue)
+        for container in running:
+            log.error(f'Stopping orphaned container: {container}')
+            container.stop(timeout=1)
+        log.info('Finished running containers %s' % containers)
+        return containers, success
+
+    @staticmethod
+    def wait_for_events(queue, timeout):
+        """
+        :return: Ids of containers that changed, or None if all containers
+            should be refreshed
+        """
+        changed = set()
+        try:
+            changed.add(queue.get(timeout=timeout))
+            while True:
+                changed.add(queue.get_nowait())
+        except Empty:
+            pass
+        if RECONNECTED in changed:
+            changed = None
+        return changed
+
+    def refresh(self, containers, changed_ids=None):
+        """
+        :param changed_ids: Only inspect these containers, all if None
+        """
+        return [self.docker.containers.get(c.short_id)
+                if changed_ids is None or c.id in changed_ids else c
+                for c in containers]
@@ -0,0 +1,908 @@
+"""
+In-process stand-ins for the cloud services the worker talks to, so that
+intake, monitoring, etc... can be exercised and benchmarked without the cloud.
+"""
+import base64
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from contextlib import contextmanager, ExitStack
+from copy import deepcopy
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Queue
+from urllib.parse import urlparse, parse_qs
+
+from box import Box
+from docker.errors import NotFound, APIError
+from docker.models.images import Image
+from google.api_core.exceptions import NotFound as DocumentNotFound, \
+    Aborted
+from google.cloud.firestore_v1 import DELETE_FIELD
+
+from problem_constants.constants import BOTLEAGUE_RESULTS_DIR, \
+    BOTLEAGUE_INNER_RESULTS_DIR_NAME
+from problem_containers import EVAL_SPEC_DIR
+from worker import Worker
+
+
+class FakeDocumentSnapshot:
+    def __init__(self, doc_id, value):
+        self.id = doc_id
+        self._value = deepcopy(value)
+        self.exists = value is not None
+
+    def to_dict(self):
+        return deepcopy(self._value)
+
+
+class FakeDocumentChange:
+    def __init__(self, change_type, document):
+        self.type = Box(name=change_type)
+        self.document = document
+
+
+class FakeWatch:
+    """Mimics google.cloud.firestore_v1.watch.Watch"""
+    def __init__(self, query, callback):
+        self.query = query
+        self.callback = callback
+        self.doc_ids = set()
+        self.is_active = True
+        self.pushed = False
+
+    def unsubscribe(self):
+        self.is_active = False
+        self.query.collection.watches.remove(self)
+
+    def drop(self):
+        """Simulate the listener stream dying, i.e. an unrecoverable RPC
+        error"""
+        self.unsubscribe()
+
+    def push(self):
+        docs = self.query.matching_docs()
+        ids = set(d.id for d in docs)
+        changes = [FakeDocumentChange('ADDED', d) for d in docs
+                   if d.id not in self.doc_ids]
+        changes += [
+            FakeDocumentChange('REMOVED', FakeDocumentSnapshot(i, None))
+            for i in self.doc_ids - ids]
+        self.doc_ids = ids
+        if not self.pushed:
+            self.pushed = True
+            # Initial snapshot is billed like a query
+            self.query.collection.reads += max(1, len(docs))
+        elif not changes:
+            return
+        else:
+            self.query.collection.reads += \
+                len([c for c in changes if c.type.name != 'REMOVED'])
+        self.callback(docs, changes, datetime.utcnow())
+
+
+QUERY_OPS = {
+    '==': lambda a, b: a == b,
+    '<': lambda a, b: a < b,
+}
+
+
+def matches(field_value, op, value):
+    if op != '==' and type(field_value) not in [type(value), int, float]:
+        # Range filters only match values of the same type in Firestore
+        return False
+    return QUERY_OPS[op](field_value, value)
+
+
+class FakeQuery:
+    def __init__(self, collection, filters=None):
+        self.collection = collection
+        self.filters = filters or []
+
+    def where(self, field, op, value):
+        if op not in QUERY_OPS:
+            raise NotImplementedError(f'Operator {op} not supported in fake')
+        return FakeQuery(self.collection,
+                         self.filters + [(field, op, value)])
+
+    def matching_docs(self):
+        with self.collection.lock:
+            items = list(self.collection.docs.items())
+        return [FakeDocumentSnapshot(k, v) for k, v in items
+                if all(matches(v.get(f), op, val)
+                       for f, op, val in self.filters)]
+
+    def stream(self):
+        docs = self.matching_docs()
+
+        # Firestore bills a minimum of one read per query
+        self.collection.reads += max(1, len(docs))
+        return iter(docs)
+
+    def on_snapshot(self, callback):
+        watch = FakeWatch(self, callback)
+        self.collection.watches.append(watch)
+        watch.push()
+        return watch
+
+
+def get_size(value) -> int:
+    """Roughly the bytes Firestore stores for a value"""
+    return len(json.dumps(value, default=str))
+
+
+class FakeDocumentReference:
+    def __init__(self, collection, doc_id):
+        self.collection = collection
+        self.id = doc_id
+
+    def get(self, transaction=None):
+        self.collection.reads += 1
+        with self.collection.lock:
+            value = self.collection.docs.get(self.id)
+        if transaction is not None:
+            transaction.reads.append((self, deepcopy(value)))
+        return FakeDocumentSnapshot(self.id, value)
+
+    def set(self, value):
+        self.collection.writes += 1
+        self.collection.bytes_written += get_size(value)
+        with self.collection.lock:
+            self.collection.docs[self.id] = deepcopy(value)
+        self.collection.notify()
+
+    def update(self, fields):
+        self.collection.writes += 1
+        self.collection.bytes_written += get_size(fields)
+        with self.collection.lock:
+            if self.id not in self.collection.docs:
+                raise DocumentNotFound(f'No document to update: {self.id}')
+            doc = self.collection.docs[self.id]
+            for field, value in fields.items():
+                if value is DELETE_FIELD:
+                    doc.pop(field, None)
+                else:
+                    doc[field] = deepcopy(value)
+        self.collection.notify()
+
+    def delete(self):
+        with self.collection.lock:
+            self.collection.docs.pop(self.id, None)
+        self.collection.notify()
+
+
+class FakeWriteBatch:
+    def __init__(self, client):
+        self.client = client
+        self.sets = []
+        self.updates = []
+
+    def set(self, reference, value):
+        self.sets.append((reference, value))
+
+    def update(self, reference, fields):
+        self.updates.append((reference, fields))
+
+    def commit(self):
+        self.client.commits += 1
+        with locked([r.collection for r, _ in self.sets + self.updates]):
+            # All or nothing
+            for reference, _ in self.updates:
+                if reference.id not in reference.collection.docs:
+                    raise DocumentNotFound(
+                        f'No document to update: {reference.id}')
+            for reference, value in self.sets:
+                reference.set(value)
+            for reference, fields in self.updates:
+                reference.update(fields)
+
+
+class FakeTransaction(FakeWriteBatch):
+    """
+    Mimics a firestore Transaction, as run by firestore_v1.transactional.
+    Commits raise Aborted, so are retried, if documents read in the
+    transaction changed before it committed.
+    """
+    _max_attempts = 5
+    _read_only = False
+
+    def __init__(self, client):
+        super().__init__(client)
+        self.reads = []
+        self._id = None
+
+    def _clean_up(self):
+        self.sets, self.updates, self.reads = [], [], []
+        self._id = None
+
+    def _begin(self, retry_id=None):
+        self._id = os.urandom(8)
+
+    def _rollback(self):
+        self._clean_up()
+
+    def _commit(self):
+        with locked([r.collection for r, _ in self.reads]):
+            for reference, value in self.reads:
+                if reference.collection.docs.get(reference.id) != value:
+                    raise Aborted(f'{reference.id} changed')
+            self.commit()
+        self._clean_up()
+
+
+@contextmanager
+def locked(collections):
+    """Holds the collections' locks, in a consistent order"""
+    with ExitStack() as stack:
+        for collection in sorted(set(collections), key=id):
+            stack.enter_context(collection.lock)
+        yield
+
+
+class FakeClient:
+    """Mimics a firestore.Client, just for batched writes and
+    transactions"""
+    def __init__(self):
+        self.commits = 0
+
+    def batch(self):
+        return FakeWriteBatch(self)
+
+    def transaction(self):
+        return FakeTransaction(self)
+
+
+class FakeCollection(FakeQuery):
+    """Mimics a Firestore CollectionReference, counting billed reads,
+    writes and bytes written. Snapshot listeners are called synchronously from the writer's
+    thread."""
+    def __init__(self):
+        super().__init__(self)
+        self.docs = {}
+        self.watches = []
+        self.lock = threading.RLock()
+        self.reads = 0
+        self.writes = 0
+        self.bytes_written = 0
+
+    def document(self, doc_id):
+        return FakeDocumentReference(self, doc_id)
+
+    def notify(self):
+        for watch in list(self.watches):
+            watch.push()
+
+
+class FakeDB:
+    """Mimics botleague_helpers.db.DBFirestore on top of a FakeCollection"""
+    def __init__(self, use_boxes=False, client=None):
+        """
+        :param client: FakeClient to share with other FakeDBs, so they can
+            be written to in the same batch
+        """
+        self.db = client or FakeClient()
+        self.collection = FakeCollection()
+        self.use_boxes = use_boxes
+
+    def get(self, key):
+        ret = self.collection.document(key).get().to_dict() or {}
+        return Box(ret) if self.use_boxes else ret
+
+    def set(self, key, value):
+        self.collection.document(key).set(self._from_box(value))
+
+    def compare_and_swap(self, key, expected_current_value, new_value) -> bool:
+        with self.collection.lock:
+            current = self.collection.docs.get(key) or {}
+            self.collection.reads += 1
+            if current != self._from_box(expected_current_value):
+                return False
+            self.set(key, new_value)
+        return True
+
+    def delete_all_test_data(self):
+        with self.collection.lock:
+            self.collection.docs.clear()
+
+    @staticmethod
+    def _from_box(value):
+        if isinstance(value, Box):
+            value = value.to_dict()
+        return value
+
+
+def docker_timestamp(dt: datetime) -> str:
+    # Docker logs have nanosecond precision
+    return dt.strftime('%Y-%m-%dT%H:%M:%S.%f') + '000Z'
+
+
+class FakeEventStream:
+    """Mimics docker.types.daemon.CancellableStream of decoded events"""
+    def __init__(self, daemon, filters=None):
+        self.daemon = daemon
+        self.filters = filters or {}
+        self.queue = Queue()
+
+    def put(self, event):
+        wanted = self.filters.get('event')
+        if wanted is None or event['status'].split(':')[0] in wanted:
+            self.queue.put(event)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        event = self.queue.get()
+        if event is None:
+            raise StopIteration
+        return event
+
+    def close(self):
+        if self in self.daemon.event_streams:
+            self.daemon.event_streams.remove(self)
+        self.queue.put(None)
+
+
+class FakeLogStream:
+    """Mimics docker.types.daemon.CancellableStream of log chunks"""
+    def __init__(self, container, timestamps, follow, since=None):
+        self.container = container
+        self.closed = False
+        self.chunks = container._stream_logs(timestamps, follow, since, self)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.chunks)
+
+    def close(self):
+        with self.container.log_cond:
+            self.closed = True
+            self.container.log_cond.notify_all()
+
+
+class FakeContainer:
+    """
+    Runs for `duration` seconds, printing `lines_per_sec` log lines, then
+    exits with `exit_code`. The first `startup_secs` are spent loading, e.g.
+    the sim, after which warm started containers wait for their eval spec.
+    Problem containers write `results` to their results mount on success.
+    The first `log_stream_errors` log streams break part way through.
+    """
+    def __init__(self, daemon, image, name=None, duration=1., exit_code=0,
+                 lines_per_sec=10., environment=None, volumes=None,
+                 labels=None, startup_secs=0., results=None,
+                 log_stream_errors=0):
+        self.daemon = daemon
+        daemon.num_containers += 1
+        self.id = f'{daemon.num_containers:012d}' + '0' * 52
+        self.short_id = self.id[:12]
+        self.name = name or f'fake_{self.short_id}'
+        self.environment = environment or {}
+        self.volumes = volumes or {}
+        self.exit_code = exit_code
+        self.duration = duration
+        self.startup_secs = startup_secs
+        self.results = results
+        self.lines_per_sec = lines_per_sec
+        self.log_stream_errors = log_stream_errors
+        self.log_lines = []
+        self.log_cond = threading.Condition()
+        self.state = 'created'
+        self.attrs = dict(Config=dict(Image=image, Labels=labels or {}),
+                          State=dict(Status=self.state, ExitCode=0))
+
+    @property
+    def status(self):
+        return self.attrs['State']['Status']
+
+    @property
+    def labels(self):
+        return self.attrs['Config']['Labels']
+
+    @property
+    def image(self):
+        image = self.attrs['Config']['Image']
+        return self.daemon.local_images.get(image) or \
+            Box(attrs=dict(RepoTags=[image]))
+
+    def start(self):
+        self.state = 'running'
+        self.daemon.emit(self, 'start')
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        self._wait_for_eval()
+        started = time.time()
+        num_lines = 0
+        while self.state == 'running':
+            elapsed = time.time() - started
+            if elapsed >= self.duration:
+                break
+            due = int(elapsed * self.lines_per_sec)
+            if due > num_lines:
+                self.write_logs([f'{self.name} line {i}'
+                                 for i in range(num_lines, due)])
+                num_lines = due
+            time.sleep(min(0.01, self.duration - elapsed))
+        if self.state == 'running':
+            if self.exit_code == 0 and self.results is not None:
+                self.write_results()
+            self.exit(self.exit_code)
+
+    def write_results(self):
+        for host, v in self.volumes.items():
+            if v['bind'] == BOTLEAGUE_RESULTS_DIR:
+                directory = f'{host}/{BOTLEAGUE_INNER_RESULTS_DIR_NAME}'
+                os.makedirs(directory, exist_ok=True)
+                with open(f'{directory}/results.json', 'w') as f:
+                    json.dump(self.results, f)
+
+    def _wait_for_eval(self):
+        loaded_at = time.time() + self.startup_secs
+        while self.state == 'running' and time.time() < loaded_at:
+            time.sleep(0.01)
+        if not self.environment.get('BOTLEAGUE_WARM_START'):
+            return
+        spec_paths = [f'{host}/eval_spec.json'
+                      for host, v in self.volumes.items()
+                      if v['bind'] == EVAL_SPEC_DIR]
+        while self.state == 'running' and \
+                not any(os.path.exists(p) for p in spec_paths):
+            time.sleep(0.01)
+
+    def rename(self, name):
+        self.daemon.api_calls += 1
+        self.name = name
+
+    def write_logs(self, lines):
+        now = docker_timestamp(datetime.utcnow())
+        with self.log_cond:
+            self.log_lines += [f'{now} {line}' for line in lines]
+            self.log_cond.notify_all()
+
+    def exit(self, exit_code, action='die'):
+        self.exit_code = exit_code
+        self.state = 'exited'
+        with self.log_cond:
+            self.log_cond.notify_all()
+        self.daemon.emit(self, action)
+
+    def inspect(self):
+        self.attrs['State'] = dict(Status=self.state,
+                                   ExitCode=self.exit_code
+                                   if self.state == 'exited' else 0)
+
+    def reload(self):
+        self.daemon.api_calls += 1
+        self.inspect()
+
+    def stop(self, timeout=10):
+        self.daemon.api_calls += 1
+        if self.state == 'running':
+            self.exit(137, action='kill')
+            self.daemon.emit(self, 'die')
+
+    def remove(self, force=False):
+        self.daemon.api_calls += 1
+        if self.state == 'running' and not force:
+            raise APIError(f'Container {self.id} is running')
+        if self.daemon.containers_by_id.pop(self.id, None) is None:
+            raise NotFound(f'No such container: {self.id}')
+        self.daemon.emit(self, 'destroy')
+
+    def logs(self, timestamps=False, since=None, stream=False,
+             follow=False):
+        self.daemon.api_calls += 1
+        if stream:
+            return FakeLogStream(self, timestamps, follow, since)
+        with self.log_cond:
+            lines = self._lines_since(since)
+        if not timestamps:
+            lines = [l.split(' ', 1)[1] for l in lines]
+        return ''.join(l + '\n' for l in lines).encode()
+
+    def _lines_since(self, since) -> list:
+        if since is None:
+            return list(self.log_lines)
+        # Docker truncates datetimes to whole seconds
+        since = docker_timestamp(since.replace(microsecond=0))
+        return [l for l in self.log_lines if l >= since]
+
+    def _stream_logs(self, timestamps, follow, since, stream):
+        with self.log_cond:
+            sent = len(self.log_lines) - len(self._lines_since(since))
+        first = True
+        while True:
+            with self.log_cond:
+                while follow and sent == len(self.log_lines) and \
+                        self.state == 'running' and not stream.closed:
+                    self.log_cond.wait()
+                if stream.closed:
+                    raise ConnectionError('Log stream closed')
+                lines = self.log_lines[sent:]
+            sent += len(lines)
+            if lines:
+                if not timestamps:
+                    lines = [l.split(' ', 1)[1] for l in lines]
+                data = ''.join(l + '\n' for l in lines).encode()
+                if self.log_stream_errors and not first:
+                    # Connection to the daemon dropped mid-line
+                    self.log_stream_errors -= 1
+                    yield data[:len(data) // 2]
+                    raise ConnectionError('Log stream broke')
+                first = False
+                yield data
+            elif not follow or self.state != 'running':
+                return
+
+
+class FakeContainers:
+    def __init__(self, daemon):
+        self.daemon = daemon
+
+    def run(self, image, command=None, detach=True, environment=None,
+            volumes=None, name=None, labels=None, **_options):
+        self.daemon.api_calls += 2  # create + start
+        behavior = self.daemon.behaviors.get(image, {})
+        container = FakeContainer(self.daemon, image, name=name,
+                                  environment=environment, volumes=volumes,
+                                  labels=labels, **behavior)
+        self.daemon.containers_by_id[container.id] = container
+        container.start()
+        return container
+
+    def get(self, container_id):
+        self.daemon.api_calls += 1
+        for container in self.daemon.containers_by_id.values():
+            if container_id in [container.id, container.short_id,
+                                container.name]:
+                container.inspect()
+                return container
+        raise NotFound(f'No such container: {container_id}')
+
+    def list(self, all=False, filters=None):
+        self.daemon.api_calls += 1
+        ret = list(self.daemon.containers_by_id.values())
+        for container in ret:
+            container.inspect()
+        if not all:
+            ret = [c for c in ret if c.status == 'running']
+        label = (filters or {}).get('label')
+        if label is not None:
+            ret = [c for c in ret if label in c.attrs['Config']['Labels']]
+        return ret
+
+
+class FakeImage(Image):
+    def __init__(self, daemon, tag, digest, size):
+        repo = tag.rsplit(':', 1)[0]
+        super().__init__(attrs=dict(
+            Id=f'sha256:{digest[7:]}', RepoTags=[tag],
+            RepoDigests=[f'{repo}@{digest}'], Size=size))
+        self.daemon = daemon
+
+    def tag(self, repository, tag=None):
+        self.daemon.api_calls += 1
+        full_tag = f'{repository}:{tag or "latest"}'
+        self.attrs['RepoTags'].append(full_tag)
+        self.daemon.local_images[full_tag] = self
+        return True
+
+
+class FakeImages:
+    def __init__(self, daemon):
+        self.daemon = daemon
+
+    def pull(self, repository, tag=None, **_kwargs):
+        """
+        Takes pull_secs[tag] (or default_pull_secs) when the registry has a
+        different digest than what's local, as the layers have to be
+        downloaded, otherwise up_to_date_pull_secs to check the manifest and
+        layers.
+        """
+        self.daemon.api_calls += 1
+        tag = f'{repository}:{tag}' if tag else repository
+        if tag not in self.daemon.registry:
+            raise NotFound(f'manifest for {tag} not found')
+        digest, size = self.daemon.registry[tag]
+        local = self.daemon.local_images.get(tag)
+        if local is None or digest not in local.attrs['RepoDigests'][0]:
+            time.sleep(self.daemon.pull_secs.get(
+                tag, self.daemon.default_pull_secs))
+            self.daemon.bytes_pulled += size
+            self.daemon.num_pulls += 1
+            local = FakeImage(self.daemon, tag, digest, size)
+            self.daemon.local_images[tag] = local
+        else:
+            time.sleep(self.daemon.up_to_date_pull_secs)
+        return local
+
+    def get_registry_data(self, name):
+        self.daemon.api_calls += 1
+        self.daemon.registry_checks += 1
+        if name not in self.daemon.registry:
+            raise NotFound(f'manifest for {name} not found')
+        time.sleep(self.daemon.manifest_secs)
+        return Box(id=self.daemon.registry[name][0])
+
+    def get(self, name):
+        self.daemon.api_calls += 1
+        if name not in self.daemon.local_images:
+            raise NotFound(f'No such image: {name}')
+        return self.daemon.local_images[name]
+
+    def list(self):
+        self.daemon.api_calls += 1
+        return list(set(self.daemon.local_images.values()))
+
+    def remove(self, image, force=False):
+        self.daemon.api_calls += 1
+        for tag, local in list(self.daemon.local_images.items()):
+            if image in [tag, local.id]:
+                del self.daemon.local_images[tag]
+                local.attrs['RepoTags'].remove(tag)
+
+    def push(self, repository, tag=None, stream=False, **_kwargs):
+        self.daemon.api_calls += 1
+        full_tag = f'{repository}:{tag}' if tag else repository
+        image = self.daemon.local_images[full_tag]
+        source_digest = image.attrs['RepoDigests'][0].split('@')[1]
+        # The manifest can be rewritten for the repo it's pushed to
+        digest = 'sha256:' + hashlib.sha256(
+            f'{repository}@{source_digest}'.encode()).hexdigest()
+        time.sleep(self.daemon.push_secs)
+        self.daemon.registry[full_tag] = (digest, image.attrs['Size'])
+        self.daemon.num_pushes += 1
+        # Recorded by the daemon, like after a pull
+        repo_digest = f'{repository}@{digest}'
+        if repo_digest not in image.attrs['RepoDigests']:
+            image.attrs['RepoDigests'].append(repo_digest)
+        status = dict(status=f'{tag}: digest: {digest}')
+        return iter([status]) if stream else json.dumps(status)
+
+
+class FakeRegistryClient:
+    """Retags in FakeDocker's registry, like artifact_pusher.RegistryClient
+    """
+    def __init__(self, daemon):
+        self.daemon = daemon
+        self.num_retags = 0
+
+    def retag(self, repo, digest, tag) -> bool:
+        for registry_tag, (registry_digest, size) in \
+                list(self.daemon.registry.items()):
+            if registry_tag.startswith(f'{repo}:') and \
+                    registry_digest == digest:
+                self.daemon.registry[f'{repo}:{tag}'] = (digest, size)
+                self.num_retags += 1
+                return True
+        return False
+
+
+class FakeDocker:
+    """
+    Mimics the docker.DockerClient, counting API calls. Set behaviors[image]
+    to kwargs for FakeContainer to control what containers run from that
+    image do. Images are pulled from registry[tag] = (digest, size).
+    """
+    def __init__(self):
+        self.api_calls = 0
+        self.behaviors = {}
+        self.containers_by_id = {}
+        self.num_containers = 0
+        self.event_streams = []
+        self.containers = FakeContainers(self)
+        self.registry = {}
+        self.local_images = {}
+        self.pull_secs = {}
+        self.default_pull_secs = 1.
+        self.up_to_date_pull_secs = 0.5
+        self.manifest_secs = 0.05
+        self.push_secs = 0
+        self.bytes_pulled = 0
+        self.registry_checks = 0
+        self.num_pulls = 0
+        self.num_pushes = 0
+        self.root_dir = tempfile.gettempdir()
+        self.images = FakeImages(self)
+
+    def login(self, username, password, **_kwargs):
+        self.api_calls += 1
+
+    def info(self):
+        self.api_calls += 1
+        return dict(DockerRootDir=self.root_dir)
+
+    def df(self):
+        self.api_calls += 1
+        images = set(self.local_images.values())
+        return dict(LayersSize=sum(i.attrs['Size'] for i in images))
+
+    def events(self, decode=True, filters=None, since=None):
+        self.api_calls += 1
+        stream = FakeEventStream(self, filters)
+        self.event_streams.append(stream)
+        return stream
+
+    def emit(self, container, action):
+        event = dict(Type='container', Action=action, status=action,
+                     id=container.id, time=int(time.time()),
+                     Actor=dict(ID=container.id,
+                                Attributes=dict(
+                                    container.attrs['Config']['Labels'],
+                                    name=container.name)))
+        for stream in list(self.event_streams):
+            stream.put(event)
+
+
+class FakeGCSHandler(BaseHTTPRequestHandler):
+    """Just enough of the GCS JSON API for simple and resumable uploads"""
+    server: 'FakeGCSServer'
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        bucket = url.path.split('/')[-2]
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.requests += 1
+        if query.get('uploadType') == ['resumable']:
+            metadata = json.loads(body or b'{}')
+            metadata['name'] = metadata.get('name') or query['name'][0]
+            session_id = str(len(self.server.sessions))
+            self.server.sessions[session_id] = dict(
+                bucket=bucket, metadata=metadata, data=b'')
+            self.send_response(200)
+            self.send_header(
+                'Location', f'{self.server.url}/upload/storage/v1/b/{bucket}'
+                f'/o?uploadType=resumable&upload_id={session_id}')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        else:
+            # Multipart: metadata part then data part
+            boundary = re.search(
+                'boundary="?([^";]+)', self.headers['Content-Type']).group(1)
+            parts = body.split(b'--' + boundary.encode())
+            metadata = json.loads(parts[1].split(b'\r\n\r\n', 1)[1])
+            data = parts[2].split(b'\r\n\r\n', 1)[1][:-2]
+            self.finish_object(bucket, metadata, data)
+
+    def do_PUT(self):
+        query = parse_qs(urlparse(self.path).query)
+        session = self.server.sessions[query['upload_id'][0]]
+        data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.requests += 1
+        self.server.parts += 1
+        session['data'] += data
+        total = self.headers['Content-Range'].split('/')[-1]
+        if total == '*':
+            self.send_response(308)
+            self.send_header('Range', f'bytes=0-{len(session["data"]) - 1}')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        else:
+            self.finish_object(session['bucket'], session['metadata'],
+                               session['data'])
+
+    def finish_object(self, bucket, metadata, data):
+        import google_crc32c
+        name = metadata['name']
+        self.server.objects[(bucket, name)] = Box(metadata=metadata, data=data)
+        crc32c = google_crc32c.value(data).to_bytes(4, 'big')
+        resource = dict(metadata, bucket=bucket, size=str(len(data)),
+                        generation='1', id=f'{bucket}/{name}/1',
+                        crc32c=base64.b64encode(crc32c).decode(),
+                        md5Hash=base64.b64encode(
+                            hashlib.md5(data).digest()).decode())
+        body = json.dumps(resource).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeGCSServer(ThreadingHTTPServer):
+    """
+    Local fake GCS server. Point a real storage client at it with
+    FakeGCSServer.client()
+    """
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), FakeGCSHandler)
+        self.url = f'http://127.0.0.1:{self.server_address[1]}'
+        self.objects = {}
+        self.sessions = {}
+        self.requests = 0
+        self.parts = 0
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def client(self):
+        from google.auth.credentials import AnonymousCredentials
+        from google.cloud import storage
+        return storage.Client(project='fake',
+                              credentials=AnonymousCredentials(),
+                              client_options=dict(api_endpoint=self.url))
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class FakeLiaisonHandler(BaseHTTPRequestHandler):
+    server: 'FakeLiaisonServer'
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        with self.server.lock:
+            self.server.requests += 1
+            if self.server.status_codes:
+                status = self.server.status_codes.pop(0)
+            else:
+                status = 200
+            if status == 200:
+                self.server.results.append(json.loads(body))
+        response = self.server.response_body or \
+            json.dumps(dict(status='ok')).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+
+class FakeLiaisonServer(ThreadingHTTPServer):
+    """
+    Local fake of the liaison's /results endpoint. Responds with each of
+    status_codes in turn, then 200s, with response_body if set.
+    """
+    def __init__(self, status_codes=None):
+        super().__init__(('127.0.0.1', 0), FakeLiaisonHandler)
+        self.url = f'http://127.0.0.1:{self.server_address[1]}'
+        self.lock = threading.Lock()
+        self.status_codes = list(status_codes or [])
+        self.results = []
+        self.requests = 0
+        self.response_body = None
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class OfflineWorker(Worker):
+    """A Worker that doesn't need cloud credentials, to run against fakes"""
+    def add_log_sinks(self):
+        pass
+
+    @staticmethod
+    def get_docker_creds() -> Box:
+        return Box(username='bench', password='bench')
+
+    @staticmethod
+    def get_aws_creds():
+        return 'bench_key_id', 'bench_secret'
+
+
+def get_offline_worker(tmp_dir, docker, jobs_db, instances_db, instance_id,
+                       log_bucket=None, job_results_db=None) -> OfflineWorker:
+    worker = OfflineWorker(
+        jobs_db=jobs_db, instances_db=instances_db, docker_client=docker,
+        instance_id=instance_id, log_bucket=log_bucket,
+        state_dir=f'{tmp_dir}/worker_state',
+        results_mount_base=f'{tmp_dir}/botleague_results',
+        job_results_db=job_results_db or FakeDB(use_boxes=True,
+                                                client=jobs_db.db))
+    worker.artifact_pusher.registry = FakeRegistryClient(docker)
+    return worker
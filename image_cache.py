@@ -0,0 +1,212 @@
+import os
+import shutil
+import threading
+import time
+from typing import Optional
+
+from docker.errors import NotFound
+
+from logs import log
+from image_index import ImageIndex, get_tag_class
+from utils import read_json, write_json
+
+from constants import WORKER_STATE_DIR, IMAGE_CACHE_CHECK_INTERVAL, \
+    IMAGE_CACHE_HIGH_WATER, IMAGE_CACHE_LOW_WATER, IMAGE_CACHE_PIN_SECS, \
+    IMAGE_CACHE_MIN_IDLE_SECS, IMAGE_CACHE_DISK_BYTES, WORKER_CONTAINER_LABEL
+
+IMAGE_CACHE_PATH = f'{WORKER_STATE_DIR}/image_cache.json'
+DEFAULT_DOCKER_ROOT = '/var/lib/docker'
+
+
+class ImageCache:
+    def __init__(self, docker_client, path=IMAGE_CACHE_PATH,
+                 index: ImageIndex = None, disk_bytes=IMAGE_CACHE_DISK_BYTES,
+                 clock=time.time):
+        """
+        Keeps the images jobs use on disk for as long as there's room,
+        evicting the least recently used ones when disk usage goes over
+        IMAGE_CACHE_HIGH_WATER. Recently used problem and sim images are
+        pinned, as they're big and shared by many jobs, whereas bot images
+        are usually only run once. Only images this cache has seen used
+        are evicted, not others on the host.
+
+        :param docker_client: docker.DockerClient
+        :param path: Where to persist last use times across restarts
+        :param index: Image digest index to forget evicted tags in
+        :param disk_bytes: Size of the Docker disk. If set, usage is the
+            size of local image layers, otherwise it's measured on the
+            Docker root filesystem.
+        :param clock: Returns the current time, for replaying job traces
+        """
+        self.docker = docker_client
+        self.path = path
+        self.index = index
+        self.disk_bytes = disk_bytes
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.last_used = self.load()  # tag => time
+        self.last_check_time = 0
+        self.docker_root = None
+        self.warned_unmeasured = False
+
+    def load(self) -> dict:
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            return read_json(self.path)
+        except Exception:
+            log.exception('Could not load image cache')
+            return {}
+
+    def save(self):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            write_json(self.last_used, self.path)
+        except Exception:
+            log.exception('Could not save image cache')
+
+    def record_use(self, tags):
+        now = self.clock()
+        with self.lock:
+            for tag in tags:
+                self.last_used[tag] = now
+            self.save()
+
+    def get_last_used(self, image) -> float:
+        with self.lock:
+            return max([self.last_used.get(t, 0) for t in get_tags(image)],
+                       default=0)
+
+    def is_tracked(self, image) -> bool:
+        with self.lock:
+            return any(t in self.last_used for t in get_tags(image))
+
+    def is_pinned(self, image) -> bool:
+        now = self.clock()
+        for tag in get_tags(image):
+            last_used = self.last_used.get(tag, 0)
+            if now - last_used < IMAGE_CACHE_MIN_IDLE_SECS:
+                return True
+            if get_tag_class(tag) != 'bot' and \
+                    now - last_used < IMAGE_CACHE_PIN_SECS:
+                return True
+        return False
+
+    def get_disk_space(self, images) -> Optional[tuple]:
+        """
+        :return: Bytes used and total bytes of the Docker disk, or None if
+            we can't tell
+        """
+        if self.disk_bytes is not None:
+            try:
+                used = self.docker.df()['LayersSize']
+            except Exception:
+                # Counts layers shared between images more than once
+                used = sum(i.attrs['Size'] for i in images)
+            return used, self.disk_bytes
+        if self.docker_root is None:
+            try:
+                self.docker_root = self.docker.info()['DockerRootDir']
+            except Exception:
+                log.warning(f'Could not get Docker root dir, assuming '
+                            f'{DEFAULT_DOCKER_ROOT}')
+                self.docker_root = DEFAULT_DOCKER_ROOT
+        try:
+            usage = shutil.disk_usage(self.docker_root)
+        except FileNotFoundError:
+            if not self.warned_unmeasured:
+                log.warning(f'Docker root {self.docker_root} is not mounted, '
+                            f'so images will not be evicted. Mount it or set '
+                            f'IMAGE_CACHE_DISK_GB.')
+                self.warned_unmeasured = True
+            return None
+        return usage.used, usage.total
+
+    def maybe_evict(self, active_container_ids=(), keep_tags=()) -> list:
+        """
+        Cleans up at most every IMAGE_CACHE_CHECK_INTERVAL seconds. Call
+        from the worker loop.
+
+        :return: Tags of evicted images
+        """
+        now = self.clock()
+        if now - self.last_check_time < IMAGE_CACHE_CHECK_INTERVAL:
+            return []
+        self.last_check_time = now
+        try:
+            return self.evict(active_container_ids, keep_tags)
+        except Exception:
+            log.exception('Error evicting images')
+            return []
+
+    def evict(self, active_container_ids=(), keep_tags=()) -> list:
+        """
+        If the disk is over IMAGE_CACHE_HIGH_WATER, removes exited
+        containers that workers started, then unpinned images that no
+        container is using, least recently used first, until it's under
+        IMAGE_CACHE_LOW_WATER.
+
+        :param active_container_ids: Containers of running jobs, which may
+            have exited but not had their logs collected yet
+        :param keep_tags: Tags of images that are needed later, i.e. for
+            pushing
+        :return: Tags of evicted images
+        """
+        images = self.docker.images.list()
+        space = self.get_disk_space(images)
+        if space is None:
+            return []
+        used, disk_bytes = space
+        usage = used / disk_bytes
+        if usage < IMAGE_CACHE_HIGH_WATER:
+            return []
+
+        in_use = set(keep_tags)
+        for container in self.docker.containers.list(all=True):
+            if container.status in ['exited', 'dead'] and \
+                    container.id not in active_container_ids and \
+                    WORKER_CONTAINER_LABEL in (container.labels or {}):
+                try:
+                    container.remove()
+                except NotFound:
+                    # Removed since we listed it
+                    pass
+            else:
+                in_use.add(container.attrs['Config']['Image'])
+        candidates = [i for i in images
+                      if self.is_tracked(i) and not self.is_pinned(i) and
+                      i.id not in in_use and not in_use & set(get_tags(i))]
+        candidates.sort(key=self.get_last_used)
+        log.info(f'Docker disk is {usage:.0%} full, evicting up to '
+                 f'{len(candidates)} images')
+        evicted = []
+        for image in candidates:
+            if usage < IMAGE_CACHE_LOW_WATER:
+                break
+            tags = list(get_tags(image))
+            try:
+                self.docker.images.remove(image.id, force=True)
+            except Exception:
+                log.exception(f'Could not remove image {image.id}')
+                continue
+            log.info(f'Evicted {tags or image.id}')
+            evicted += tags
+            with self.lock:
+                for tag in tags:
+                    self.last_used.pop(tag, None)
+            if self.index is not None:
+                for tag in tags:
+                    self.index.remove(tag)
+            # Shared layers mean this can overestimate what's freed,
+            # in which case we catch it next check
+            usage -= image.attrs['Size'] / disk_bytes
+        with self.lock:
+            self.save()
+        if usage >= IMAGE_CACHE_LOW_WATER:
+            log.warning(f'Docker disk still {usage:.0%} full after evicting '
+                        f'all unpinned images')
+        return evicted
+
+
+def get_tags(image) -> list:
+    return image.attrs.get('RepoTags') or []
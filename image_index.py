@@ -0,0 +1,97 @@
+import os
+import threading
+import time
+from typing import Optional
+
+from logs import log
+from utils import read_json, write_json
+
+from constants import SIM_PACKAGE_IMAGE_TAG, DEEPDRIVE_BUILD_IMAGE_TAG, \
+    WORKER_STATE_DIR, IMAGE_FRESHNESS_SECS
+
+IMAGE_INDEX_PATH = f'{WORKER_STATE_DIR}/image_index.json'
+
+
+def get_tag_class(tag) -> str:
+    if tag.startswith('deepdriveio/deepdrive:problem_'):
+        return 'problem'
+    elif tag in [SIM_PACKAGE_IMAGE_TAG, DEEPDRIVE_BUILD_IMAGE_TAG]:
+        return 'build'
+    else:
+        return 'bot'
+
+
+def get_digest(image, tag) -> Optional[str]:
+    """
+    :return: The registry digest, i.e. sha256:abc..., of a local image for
+        the tag's repo
+    """
+    repo = tag.rsplit(':', 1)[0] if ':' in tag.split('/')[-1] else tag
+    for repo_digest in image.attrs.get('RepoDigests') or []:
+        digest_repo, digest = repo_digest.split('@')
+        if digest_repo == repo:
+            return digest
+    return None
+
+
+class ImageIndex:
+    def __init__(self, path=IMAGE_INDEX_PATH):
+        """
+        Local index of tag => digest, image id, and when we last verified
+        the digest is what the registry has. Lets us skip pulls when the
+        local image is current. Persisted to `path` across restarts.
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = self.load()
+
+    def load(self) -> dict:
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            return read_json(self.path)
+        except Exception:
+            log.exception('Could not load image index')
+            return {}
+
+    def save(self):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            write_json(self.entries, self.path)
+        except Exception:
+            log.exception('Could not save image index')
+
+    def is_fresh(self, tag) -> bool:
+        """
+        :return: Whether the tag was verified recently enough for its
+            class that we don't need to check the registry
+        """
+        with self.lock:
+            entry = self.entries.get(tag)
+        if entry is None:
+            return False
+        max_age = IMAGE_FRESHNESS_SECS[get_tag_class(tag)]
+        return time.time() - entry['verified_at'] < max_age
+
+    def get_digest(self, tag) -> Optional[str]:
+        with self.lock:
+            entry = self.entries.get(tag)
+        return entry['digest'] if entry else None
+
+    def get_image_id(self, tag) -> Optional[str]:
+        with self.lock:
+            entry = self.entries.get(tag)
+        return entry['image_id'] if entry else None
+
+    def verified(self, tag, image):
+        """Record that image is current for tag as of now"""
+        with self.lock:
+            self.entries[tag] = dict(digest=get_digest(image, tag),
+                                     image_id=image.id,
+                                     verified_at=time.time())
+            self.save()
+
+    def remove(self, tag):
+        with self.lock:
+            if self.entries.pop(tag, None) is not None:
+                self.save()
@@ -0,0 +1,187 @@
+import os
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+
+from docker.errors import NotFound
+from docker.models.images import Image
+
+from image_index import ImageIndex, get_digest, get_tag_class
+from logs import log
+from metrics import PHASE_SECONDS
+from utils import read_json, write_json
+
+from constants import SIM_PACKAGE_IMAGE_TAG, DEEPDRIVE_BUILD_IMAGE_TAG, \
+    WORKER_STATE_DIR, IMAGE_PULL_CONCURRENCY, IMAGE_PREFETCH_INTERVAL, \
+    IMAGE_PREFETCH_MAX_TAGS
+
+IMAGE_HISTORY_PATH = f'{WORKER_STATE_DIR}/image_history.json'
+
+
+def is_prefetchable(tag):
+    # Bots are different for every job, so not worth prefetching
+    return tag.startswith('deepdriveio/deepdrive:problem_') or \
+        tag in [SIM_PACKAGE_IMAGE_TAG, DEEPDRIVE_BUILD_IMAGE_TAG]
+
+
+class ImagePuller:
+    def __init__(self, docker_client, history_size=100,
+                 history_path=IMAGE_HISTORY_PATH, index: ImageIndex = None):
+        """
+        Pulls the images a job needs concurrently, and while idle, prefetches
+        the images recent jobs have needed most.
+
+        :param docker_client: docker.DockerClient
+        :param history_size: Number of recently used tags to base prefetching
+            on
+        :param history_path: Where to persist history across restarts
+        :param index: Digests of local images, so we can skip pulls of
+            images that are already current
+        """
+        self.docker = docker_client
+        self.history_path = history_path
+        self.executor = ThreadPoolExecutor(
+            max_workers=IMAGE_PULL_CONCURRENCY, thread_name_prefix='pull')
+        self.lock = threading.Lock()
+        self.in_flight = {}  # tag => future, so a tag is only pulled once
+        self.last_prefetch_times = {}
+        self.history = deque(self.load_history(), maxlen=history_size)
+        self.index = index or ImageIndex()
+
+    def pull(self, tag):
+        """
+        :return: Future for the pulled image, shared with any pull of the
+            same tag that's already underway
+        """
+        with self.lock:
+            future = self.in_flight.get(tag)
+            if future is None:
+                future = self.executor.submit(self.pull_image, tag)
+                self.in_flight[tag] = future
+                future.add_done_callback(
+                    lambda _: self.in_flight.pop(tag, None))
+        return future
+
+    def get_images(self, tags) -> list:
+        """
+        Pull tags concurrently, recording them as used
+
+        :return: Images in the same order as tags, None where pulls failed
+        """
+        self.record_use(tags)
+        now = time.time()
+        for tag in tags:
+            self.last_prefetch_times[tag] = now
+        futures = [self.pull(tag) for tag in tags]
+        ret = []
+        for tag, future in zip(tags, futures):
+            ret.append(future.result())
+            # How long the job waited on each, less any prefetching
+            PHASE_SECONDS.observe(time.time() - now, phase='get_image',
+                                  tag_class=get_tag_class(tag))
+        return ret
+
+    def pull_image(self, tag):
+        image = self.get_current_local_image(tag)
+        if image is not None:
+            return image
+        log.info('Pulling docker image %s ...' % tag)
+        try:
+            result = self.docker.images.pull(tag)
+        except:
+            log.exception(f'Could not pull {tag}')
+            ret = None
+        else:
+            log.info('Finished pulling docker image %s' % tag)
+            if isinstance(result, list):
+                # All tags in the repo were pulled
+                ret = self.get_local_image(tag)
+                if ret is None:
+                    raise RuntimeError(
+                        f'Could not get pull latest image for {tag}. '
+                        f'tags found were: {result}')
+            elif isinstance(result, Image):
+                ret = result
+            else:
+                log.warning(f'Got unexpected result when pulling {tag} '
+                            f'of {result}')
+                ret = result
+            if isinstance(ret, Image):
+                self.index.verified(tag, ret)
+        return ret
+
+    def get_current_local_image(self, tag):
+        """
+        :return: The local image for tag if it's known to be current, either
+            because we verified it recently or because its digest matches the
+            registry's, otherwise None
+        """
+        if self.index.is_fresh(tag):
+            image = self.get_local_image(tag)
+            if image is not None and image.id == self.index.get_image_id(tag):
+                log.info(f'{tag} was verified recently, not pulling')
+                return image
+        try:
+            # Just a manifest HEAD request to the registry by the daemon
+            remote_digest = self.docker.images.get_registry_data(tag).id
+        except Exception:
+            log.warning(f'Could not get registry digest of {tag}, pulling')
+            return None
+        image = self.get_local_image(tag)
+        if image is not None and get_digest(image, tag) == remote_digest:
+            log.info(f'{tag} is up to date with {remote_digest}, not pulling')
+            self.index.verified(tag, image)
+            return image
+        return None
+
+    def get_local_image(self, tag):
+        if ':' not in tag.split('/')[-1]:
+            tag += ':latest'
+        try:
+            return self.docker.images.get(tag)
+        except NotFound:
+            return None
+
+    def record_use(self, tags):
+        tags = [t for t in tags if is_prefetchable(t)]
+        if not tags:
+            return
+        with self.lock:
+            self.history.extend(tags)
+            history = list(self.history)
+        try:
+            os.makedirs(os.path.dirname(self.history_path), exist_ok=True)
+            write_json(history, self.history_path)
+        except Exception:
+            log.exception('Could not save image history')
+
+    def load_history(self) -> list:
+        if not os.path.exists(self.history_path):
+            return []
+        try:
+            return read_json(self.history_path)
+        except Exception:
+            log.exception('Could not load image history')
+            return []
+
+    def predict(self) -> list:
+        """
+        :return: Tags most likely to be needed next, most likely first
+        """
+        with self.lock:
+            counts = Counter(self.history)
+        return [tag for tag, _ in counts.most_common(IMAGE_PREFETCH_MAX_TAGS)]
+
+    def prefetch(self):
+        """
+        Start background pulls of predicted tags that haven't been
+        pulled recently. Call when idle.
+        """
+        now = time.time()
+        for tag in self.predict():
+            if now - self.last_prefetch_times.get(tag, 0) > \
+                    IMAGE_PREFETCH_INTERVAL:
+                self.last_prefetch_times[tag] = now
+                log.info(f'Prefetching {tag}')
+                self.pull(tag)
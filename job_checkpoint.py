@@ -0,0 +1,128 @@
+import os
+import threading
+import time
+from typing import Optional
+
+from box import Box
+from docker.errors import NotFound
+
+from logs import log
+from utils import read_json, write_json_atomic
+
+from constants import WORKER_STATE_DIR
+
+JOB_CHECKPOINT_DIR = f'{WORKER_STATE_DIR}/jobs'
+
+# Job states in the order they're reached. Jobs are removed once reported.
+# Pulled jobs are run again on recovery, started jobs are re-attached to
+# their containers, and jobs whose results were sent are just finished.
+JOB_STATE_PULLED = 'pulled'
+JOB_STATE_STARTED = 'started'
+JOB_STATE_RESULTS_SENT = 'results_sent'
+JOB_STATE_REPORTED = 'reported'
+JOB_STATES = [JOB_STATE_PULLED, JOB_STATE_STARTED, JOB_STATE_RESULTS_SENT,
+              JOB_STATE_REPORTED]
+
+
+class JobCheckpoints:
+    def __init__(self, path=JOB_CHECKPOINT_DIR):
+        """
+        Where each running job has got to, persisted to a file per job so
+        that after a restart we can re-attach to its containers rather than
+        throw the work away.
+
+        :param path: Directory to keep checkpoints in
+        """
+        self.path = path
+        self.lock = threading.Lock()
+
+    def get_filename(self, job_id):
+        return f'{self.path}/{job_id}.json'
+
+    def get(self, job_id) -> Optional[Box]:
+        filename = self.get_filename(job_id)
+        if not os.path.exists(filename):
+            return None
+        try:
+            return Box(read_json(filename))
+        except Exception:
+            log.exception(f'Could not load checkpoint for job {job_id}')
+            return None
+
+    def load_all(self) -> list:
+        if not os.path.exists(self.path):
+            return []
+        job_ids = [f[:-len('.json')] for f in sorted(os.listdir(self.path))
+                   if f.endswith('.json')]
+        return [c for c in map(self.get, job_ids) if c is not None]
+
+    def save(self, job_id, state, containers=None, results=None):
+        """
+        :param job_id: Job to checkpoint
+        :param state: One of JOB_STATES
+        :param containers: The job's containers once they're started, kept
+            from previous checkpoints if None
+        :param results: The job's results once they're sent, so it can be
+            finished without running it again
+        """
+        with self.lock:
+            checkpoint = self.get(job_id) or Box(job_id=job_id,
+                                                 containers=[])
+            if state == JOB_STATE_REPORTED:
+                self.remove(job_id)
+                return
+            checkpoint.state = state
+            checkpoint.updated_at = time.time()
+            if containers is not None:
+                checkpoint.containers = [dict(id=c.id, name=c.name)
+                                         for c in containers]
+            if results is not None:
+                checkpoint.results = results
+            os.makedirs(self.path, exist_ok=True)
+            write_json_atomic(checkpoint.to_dict(),
+                              self.get_filename(job_id))
+        log.info(f'Job {job_id} {state}')
+
+    def remove(self, job_id):
+        try:
+            os.remove(self.get_filename(job_id))
+        except FileNotFoundError:
+            pass
+
+
+def find_containers(docker_client, checkpoint) -> Optional[list]:
+    """
+    Looks up a checkpointed job's containers by name, e.g.
+    problem_eval_id_*, sim_build_*, or by id for unnamed ones
+
+    :return: The containers, running or exited, or None if the job never
+        started them or any are gone
+    """
+    if checkpoint.state == JOB_STATE_PULLED or not checkpoint.containers:
+        return None
+    ret = []
+    for container in checkpoint.containers:
+        try:
+            ret.append(docker_client.containers.get(
+                container.name or container.id))
+        except NotFound:
+            log.warning(f'Container {container.name or container.id} of '
+                        f'job {checkpoint.job_id} is gone')
+            return None
+    return ret
+
+
+def remove_containers(docker_client, checkpoint):
+    """
+    Removes whatever is left of a checkpointed job's containers, so the job
+    can be run again under the same container names
+    """
+    for container in checkpoint.containers:
+        try:
+            docker_client.containers.get(
+                container.name or container.id).remove(force=True)
+        except NotFound:
+            pass
+        except Exception:
+            log.exception(f'Could not remove container '
+                          f'{container.name or container.id}')
@@ -0,0 +1,159 @@
+import threading
+import time
+from collections import deque
+from queue import Queue, Empty
+from typing import Optional
+
+from job_model import Job
+from logs import log
+from metrics import count_firestore_call
+from problem_constants.constants import JOB_STATUS_ASSIGNED
+
+from constants import JOB_WATCH_FIRST_SNAPSHOT_TIMEOUT, \
+    JOB_WATCH_RETRY_INTERVAL
+
+
+class JobIntake:
+    def __init__(self, jobs_db, instance_id, use_watch=True, max_jobs=1):
+        """
+        Gets jobs assigned to this instance, either pushed to us via a
+        Firestore watch, or by polling when the watch is disabled or has
+        dropped.
+
+        :param jobs_db: Job status, etc... in Firestore
+        :param instance_id: Our instance id, which jobs are assigned to
+        :param use_watch: If False, always poll
+        :param max_jobs: Number of jobs we can be assigned at once
+        """
+        self.jobs_db = jobs_db
+        self.instance_id = instance_id
+        self.use_watch = use_watch
+        self.max_jobs = max_jobs
+        self.watch = None
+        self.last_watch_attempt_time = None
+
+        # Jobs pushed by the watch thread, popped by the worker loop
+        self.queue = Queue()
+
+        # Only one snapshot callback should be processed at a time
+        self.lock = threading.Lock()
+        self.snapshot_ids = set()
+        self.first_snapshot = threading.Event()
+
+        # Assignments we've returned, to avoid running a job twice when
+        # switching between watching and polling. See get_assignment()
+        self.handed_out = deque(maxlen=100)
+
+    @property
+    def watching(self) -> bool:
+        return self.watch is not None and self.watch.is_active
+
+    def query(self):
+        return self.jobs_db.collection.where(
+            'instance_id', '==', self.instance_id).where(
+            'status', '==', JOB_STATUS_ASSIGNED)
+
+    def start(self):
+        if self.use_watch:
+            self.start_watch()
+
+    def stop(self):
+        if self.watch is not None:
+            self.watch.unsubscribe()
+            self.watch = None
+
+    def start_watch(self):
+        self.last_watch_attempt_time = time.time()
+        self.first_snapshot.clear()
+        try:
+            self.watch = self.query().on_snapshot(self.on_snapshot)
+        except Exception:
+            log.exception('Could not create job watch, falling back to '
+                          'polling')
+            self.watch = None
+            return
+        if not self.first_snapshot.wait(JOB_WATCH_FIRST_SNAPSHOT_TIMEOUT):
+            log.error('Timed out waiting for initial job snapshot, falling '
+                      'back to polling')
+            self.stop()
+        else:
+            log.info('Watching for jobs')
+
+    def on_snapshot(self, docs, _changes, _read_time):
+        # Called from the watch's thread
+        count_firestore_call(self.jobs_db, 'snapshot')
+        with self.lock:
+            if len(docs) > self.max_jobs:
+                # These will be run as resources free up
+                log.error(f'Got more than {self.max_jobs} job(s) for '
+                          f'instance')
+            ids = set()
+            for doc in docs:
+                ids.add(doc.id)
+                if doc.id not in self.snapshot_ids:
+                    self.queue.put(Job.from_doc(doc))
+            self.snapshot_ids = ids
+        self.first_snapshot.set()
+
+    def check(self, timeout=0) -> Optional[Job]:
+        """
+        :param timeout: Seconds to wait for a pushed job when watching
+        :return: The next job assigned to us or None
+        """
+        if self.use_watch and not self.watching:
+            self.maybe_restart_watch()
+        if self.watching:
+            ret = self.pop(timeout)
+        else:
+            ret = self.poll()
+        if ret:
+            self.handed_out.append(get_assignment(ret))
+        return ret
+
+    def maybe_restart_watch(self):
+        if self.watch is not None:
+            log.warning('Job watch dropped, polling until it is restarted')
+            self.watch = None
+            with self.lock:
+                # Polling will find anything still assigned
+                self.snapshot_ids = set()
+                self.queue = Queue()
+        elif self.last_watch_attempt_time is None or \
+                time.time() - self.last_watch_attempt_time > \
+                JOB_WATCH_RETRY_INTERVAL:
+            self.start_watch()
+
+    def pop(self, timeout) -> Optional[Job]:
+        deadline = time.time() + timeout
+        while True:
+            try:
+                job = self.queue.get(
+                    timeout=max(0, deadline - time.time()))
+            except Empty:
+                return None
+            if get_assignment(job) not in self.handed_out:
+                return job
+
+    def poll(self) -> Optional[Job]:
+        count_firestore_call(self.jobs_db, 'query')
+        jobs = list(self.query().stream())
+        ret = None
+        if len(jobs) > 1 and self.max_jobs == 1:
+            # Only one job per instance unless we're running several at once
+            raise RuntimeError('Got more than one job for instance')
+        jobs = [j for j in map(Job.from_doc, jobs)
+                if get_assignment(j) not in self.handed_out]
+        if not jobs:
+            log.debug('No job for instance in db')
+        else:
+            ret = jobs[0]
+        return ret
+
+
+def get_assignment(job) -> tuple:
+    """
+    :return: Job id and reclaim count, which goes up each time the job's
+        requeued after its lease expired, so a job that's reassigned to us
+        after a reclaim is run again
+    """
+    return job.id, job.reclaim_count or 0
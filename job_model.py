@@ -0,0 +1,135 @@
+import json
+from collections.abc import Mapping
+
+from box import Box
+
+from results_collector import summarize
+
+UNSET = object()
+
+
+class Model:
+    """
+    Fields of a Firestore document as __slots__, so reading and copying them
+    is cheap, unlike Box which converts nested dicts on each access and
+    needs to_dict() and deepcopy() to copy. Fields we don't know about are
+    kept in `extra`, so documents round trip unchanged. Known fields that
+    aren't set are None.
+    """
+    __slots__ = ('extra',)
+    FIELDS = frozenset()
+    NESTED = {}  # field => Model class, or Box, of dicts in that field
+    SUMMARY_FIELDS = ()  # Shown in repr
+
+    def __init__(self, **fields):
+        self.extra = {}
+        self.update(fields)
+
+    @classmethod
+    def from_dict(cls, value: Mapping):
+        return cls(**value)
+
+    def __getattr__(self, name):
+        # Only called for unset slots and unknown fields
+        if name in self.FIELDS:
+            return None
+        if name == 'extra':
+            raise AttributeError(name)
+        try:
+            return self.extra[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def __contains__(self, name):
+        return self.get(name, UNSET) is not UNSET
+
+    def __eq__(self, other):
+        if isinstance(other, Model):
+            other = other.to_dict()
+        return self.to_dict() == other
+
+    def __repr__(self):
+        fields = ', '.join(f'{n}={getattr(self, n)!r}'
+                           for n in self.SUMMARY_FIELDS)
+        return f'{type(self).__name__}({fields})'
+
+    def get(self, name, default=None):
+        if name in self.FIELDS:
+            try:
+                return object.__getattribute__(self, name)
+            except AttributeError:
+                return default
+        return self.extra.get(name, default)
+
+    def items(self):
+        """Set fields, then extra fields"""
+        for name in self.__slots__:
+            try:
+                yield name, object.__getattribute__(self, name)
+            except AttributeError:
+                pass
+        yield from self.extra.items()
+
+    def update(self, fields: Mapping):
+        for name, value in fields.items():
+            nested = self.NESTED.get(name)
+            if nested is not None and isinstance(value, Mapping) and \
+                    not isinstance(value, (Model, nested)):
+                value = nested.from_dict(value) \
+                    if issubclass(nested, Model) else nested(value)
+            if name in self.FIELDS:
+                object.__setattr__(self, name, value)
+            else:
+                self.extra[name] = value
+
+    def replace(self, **fields):
+        """
+        A copy with `fields` changed. Unchanged values are shared rather
+        than copied, so replace() rather than mutate nested values.
+        """
+        ret = object.__new__(type(self))
+        for name in self.__slots__:
+            try:
+                object.__setattr__(ret, name,
+                                   object.__getattribute__(self, name))
+            except AttributeError:
+                pass
+        ret.extra = dict(self.extra)
+        ret.update(fields)
+        return ret
+
+    def to_dict(self) -> dict:
+        return {name: value.to_dict() if hasattr(value, 'to_dict') else value
+                for name, value in self.items()}
+
+    def to_json(self) -> str:
+        """For logging, with long lists in results, etc... cut short"""
+        return json.dumps(summarize(self.to_dict()), default=str)
+
+
+class EvalSpec(Model):
+    __slots__ = ('eval_id', 'eval_key', 'seed', 'problem', 'docker_tag',
+                 'problem_def', 'full_eval_request', 'pull_request')
+    FIELDS = frozenset(__slots__)
+    SUMMARY_FIELDS = ('eval_id', 'problem', 'docker_tag')
+
+
+class Job(Model):
+    __slots__ = ('id', 'status', 'job_type', 'instance_id',
+                 'botleague_liaison_host', 'eval_spec', 'commit', 'branch',
+                 'build_id', 'resources', 'results', 'worker_error',
+                 'worker_log', 'started_at', 'finished_at',
+                 'lease_expires_at', 'reclaim_count',
+                 'reclaimed_from_instance_id')
+    FIELDS = frozenset(__slots__)
+    # Results are filled in as attributes while the job runs
+    NESTED = dict(eval_spec=EvalSpec, results=Box, partial_results=Box)
+    SUMMARY_FIELDS = ('id', 'job_type', 'status')
+
+    @classmethod
+    def from_doc(cls, doc):
+        """From a Firestore DocumentSnapshot, with the document's id"""
+        ret = cls.from_dict(doc.to_dict())
+        if ret.id is None:
+            ret.id = doc.id
+        return ret
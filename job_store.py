@@ -0,0 +1,105 @@
+from box import Box
+from google.api_core.exceptions import NotFound
+from google.cloud.firestore_v1 import SERVER_TIMESTAMP, DELETE_FIELD
+
+from logs import log
+from lease import batch_update, update_if
+from problem_constants.constants import JOB_STATUS_RUNNING, \
+    JOB_STATUS_FINISHED, JOB_STATUS_ASSIGNED
+from results_collector import summarize
+
+
+class JobStore:
+    def __init__(self, jobs_db, instances_db, results_db, instance_id):
+        """
+        Job and instance state transitions as updates of just the fields
+        that change, rather than writes of whole documents. Results with
+        long lists, e.g. per-episode arrays, are kept whole in their own
+        document in `results_db`, under the job's id, and summarized in
+        the job, so the job document that the coordinator and leases read
+        and write stays small.
+
+        :param jobs_db: Job status, etc... in Firestore
+        :param instances_db: Instance status, etc... in Firestore
+        :param results_db: Full results of jobs whose results are summarized
+        :param instance_id: This worker's instance
+        """
+        self.jobs_db = jobs_db
+        self.instances_db = instances_db
+        self.results_db = results_db
+        self.instance_id = instance_id
+
+    def mark_running(self, job, **fields):
+        """
+        Marks an assigned job running, as long as it's still assigned to us
+
+        :param fields: Other fields to set along with status, e.g. its lease
+        """
+        fields = dict(status=JOB_STATUS_RUNNING, started_at=SERVER_TIMESTAMP,
+                      **fields)
+        expected = dict(status=job.status, instance_id=job.instance_id)
+        if not update_if(self.jobs_db, job.id, expected, fields):
+            raise RuntimeError(
+                f'Job status transaction failed, expected {expected}, got '
+                f'{dict(self.jobs_db.get(job.id) or {})}')
+        job.update(fields)
+
+    def finish(self, job, instance_fields=None) -> bool:
+        """
+        Marks the job finished, with its results, and updates our instance
+        with `instance_fields`, e.g. to make it available, in one commit.
+        The job is only updated if it's still ours, i.e. it wasn't requeued
+        when its lease expired.
+
+        :param job: Job with results, and a worker_error and worker_log if
+            it failed
+        :param instance_fields: Fields to update on our instance, if any
+        :return: Whether the job was ours to finish
+        """
+        fields = dict(status=JOB_STATUS_FINISHED, finished_at=SERVER_TIMESTAMP,
+                      lease_expires_at=None)  # So it's not reclaimed
+        sets = []
+        for field in ('worker_error', 'worker_log'):
+            if field in job:
+                fields[field] = job.get(field)
+        # The job keeps its full results, only the document is summarized
+        job.update(fields)
+        if 'results' in job:
+            results = job.results
+            if isinstance(results, Box):
+                results = results.to_dict()
+            summary = summarize(results)
+            if summary != results:
+                sets.append((self.results_db, job.id, dict(results=results)))
+                fields['results_summarized'] = True
+            fields['results'] = summary
+        fields['partial_results'] = DELETE_FIELD
+        # Not yet running if it failed before it started
+        expected = dict(instance_id=self.instance_id,
+                        status={JOB_STATUS_ASSIGNED, JOB_STATUS_RUNNING})
+        updates = [(self.instances_db, self.instance_id, instance_fields)] \
+            if instance_fields else []
+        try:
+            ours = update_if(self.jobs_db, job.id, expected, fields,
+                             updates=updates, sets=sets)
+        except NotFound:
+            if not updates:
+                raise
+            log.warning(f'Instance {self.instance_id} does not exist, '
+                        f'perhaps it was terminated.')
+            ours = update_if(self.jobs_db, job.id, expected, fields,
+                             sets=sets)
+        if not ours:
+            log.warning(f'Not saving job {job.id}, it is no longer running '
+                        f'on this instance, perhaps its lease expired')
+        return ours
+
+    def save_partial_results(self, job_id, results):
+        batch_update([(self.jobs_db, job_id,
+                       dict(partial_results=summarize(results)))])
+
+    def get_results(self, job) -> dict:
+        """:return: The job's full results, wherever they're kept"""
+        if not job.get('results_summarized'):
+            return job.get('results')
+        return self.results_db.get(job.id).get('results')
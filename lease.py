@@ -0,0 +1,282 @@
+import threading
+import time
+from random import random
+
+from google.api_core.exceptions import NotFound
+from google.cloud.firestore_v1 import SERVER_TIMESTAMP, DELETE_FIELD, \
+    transactional
+
+from job_model import Job
+from logs import log
+from metrics import count_firestore_call
+from problem_constants.constants import JOB_STATUS_RUNNING, \
+    JOB_STATUS_CREATED, JOB_STATUS_FINISHED
+
+from constants import LEASE_RENEW_INTERVAL, LEASE_DURATION, \
+    LEASE_RECLAIM_INTERVAL, LEASE_MAX_RECLAIMS, LEASE_CLOCK_SKEW
+
+
+def batch_update(updates, sets=None):
+    """
+    Update fields of several documents with one commit per Firestore
+    client, i.e. one round trip for a worker's jobs and instance
+
+    :param updates: List of (db, key, fields). Fields set to DELETE_FIELD
+        are removed.
+    :param sets: List of (db, key, value) of whole documents to write in
+        the same commit
+    """
+    batches = {}
+
+    def get_batch(_db):
+        client = getattr(_db, 'db', None)
+        if client is None:
+            return None
+        if id(client) not in batches:
+            batches[id(client)] = client.batch()
+        return batches[id(client)]
+
+    for db, key, value in sets or []:
+        batch = get_batch(db)
+        if batch is None:
+            # Local test db, no batches
+            db.set(key, value)
+        else:
+            batch.set(db.collection.document(key), value)
+    for db, key, fields in updates:
+        batch = get_batch(db)
+        if batch is None:
+            value = db.get(key)
+            if not value:
+                raise NotFound(f'No document to update: {key}')
+            value.update(fields)
+            for field, field_value in fields.items():
+                if field_value is DELETE_FIELD:
+                    del value[field]
+            db.set(key, value)
+        else:
+            batch.update(db.collection.document(key), fields)
+    for batch in batches.values():
+        count_firestore_call(None, 'batch_commit')
+        batch.commit()
+
+
+def matches(value, expected) -> bool:
+    """
+    :param expected: Dict of field => value, or set of values, that
+        `value` must have
+    """
+    if not value:
+        return False
+    for field, expected_value in expected.items():
+        if isinstance(expected_value, (set, frozenset)):
+            if value.get(field) not in expected_value:
+                return False
+        elif value.get(field) != expected_value:
+            return False
+    return True
+
+
+def update_if(db, key, expected, fields, updates=(), sets=()) -> bool:
+    """
+    Update fields of a document in one transaction, only if it still has
+    the `expected` values
+
+    :param expected: Dict of field => value, or set of values, the
+        document must have
+    :param fields: Dict of field => value to update
+    :param updates: Other (db, key, fields) to update in the same commit,
+        whether or not the document had the expected values
+    :param sets: (db, key, value) of whole documents to write in the same
+        commit, only if it did
+    :return: Whether the document was updated
+    """
+    client = getattr(db, 'db', None)
+    if client is None:
+        # Local test db, no transactions
+        ours = matches(db.get(key), expected)
+        if ours:
+            batch_update([(db, key, fields)], sets)
+        if updates:
+            batch_update(list(updates))
+        return ours
+    reference = db.collection.document(key)
+
+    @transactional
+    def update(transaction):
+        snapshot = reference.get(transaction=transaction)
+        _ours = matches(snapshot.to_dict() if snapshot.exists else None,
+                        expected)
+        if _ours:
+            for _db, _key, value in sets:
+                transaction.set(_db.collection.document(_key), value)
+            transaction.update(reference, fields)
+        for _db, _key, _fields in updates:
+            transaction.update(_db.collection.document(_key), _fields)
+        return _ours
+
+    count_firestore_call(db, 'transaction')
+    return update(client.transaction())
+
+
+class LeaseKeeper:
+    def __init__(self, jobs_db, instances_db, instance_id,
+                 renew_interval=LEASE_RENEW_INTERVAL,
+                 duration=LEASE_DURATION, clock_skew=LEASE_CLOCK_SKEW,
+                 on_lost=None):
+        """
+        Heartbeats for this worker's instance and running jobs, renewing
+        their `lease_expires_at` every renew_interval seconds from a
+        background thread. Jobs whose worker stopped renewing are requeued
+        by reclaim_expired(). Leases are only renewed while the job is
+        still running on this instance, so once one's been requeued, its
+        old worker finds out and stops it.
+
+        :param jobs_db: Job status, etc... in Firestore
+        :param instances_db: Instance status, etc... in Firestore
+        :param instance_id: This worker's instance
+        :param renew_interval: Seconds between renewals
+        :param duration: Seconds a lease lasts without renewal
+        :param clock_skew: Seconds other workers' clocks may be ahead of
+            ours, which leases are given before they're reclaimed
+        :param on_lost: Called with the id of a job we were holding the
+            lease of that's no longer ours
+        """
+        self.jobs_db = jobs_db
+        self.instances_db = instances_db
+        self.instance_id = instance_id
+        self.renew_interval = renew_interval
+        self.duration = duration
+        self.clock_skew = clock_skew
+        self.on_lost = on_lost
+        self.lock = threading.Lock()
+        self.job_ids = set()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.last_reclaim_time = 0
+
+    def get_expiry(self) -> float:
+        return time.time() + self.duration
+
+    def start(self):
+        if self.thread is None:
+            self.stopped.clear()
+            self.thread = threading.Thread(target=self.run, daemon=True,
+                                           name='lease-keeper')
+            self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def hold(self, job_id):
+        """Keep renewing the job's lease until released"""
+        with self.lock:
+            self.job_ids.add(job_id)
+
+    def release(self, job_id):
+        with self.lock:
+            self.job_ids.discard(job_id)
+
+    def run(self):
+        while not self.stopped.wait(self.renew_interval):
+            try:
+                self.renew()
+            except Exception:
+                log.exception('Error renewing leases')
+
+    def renew(self):
+        # Hold the lock so released jobs aren't renewed after they finish
+        with self.lock:
+            fields = dict(lease_expires_at=self.get_expiry(),
+                          heartbeat_at=SERVER_TIMESTAMP)
+            expected = dict(status=JOB_STATUS_RUNNING,
+                            instance_id=self.instance_id)
+            # The instance is renewed along with the first job
+            updates = [(self.instances_db, self.instance_id, fields)]
+            lost = []
+            for job_id in sorted(self.job_ids):
+                try:
+                    ours = update_if(self.jobs_db, job_id, expected, fields,
+                                     updates=updates)
+                except NotFound:
+                    self.warn_instance_missing()
+                    ours = update_if(self.jobs_db, job_id, expected, fields)
+                if not ours:
+                    lost.append(job_id)
+                updates = []
+            if updates:
+                try:
+                    batch_update(updates)
+                except NotFound:
+                    self.warn_instance_missing()
+            self.job_ids -= set(lost)
+        for job_id in lost:
+            log.warning(f'Job {job_id} is no longer running on this '
+                        f'instance, perhaps its lease expired')
+            if self.on_lost is not None:
+                self.on_lost(job_id)
+
+    def warn_instance_missing(self):
+        log.warning(f'Instance {self.instance_id} does not exist, '
+                    f'perhaps it was terminated.')
+
+    def maybe_reclaim(self) -> list:
+        """
+        Reclaims at most every LEASE_RECLAIM_INTERVAL seconds, with splay
+        so workers don't all query at once
+
+        :return: Ids of requeued jobs
+        """
+        now = time.time()
+        interval = LEASE_RECLAIM_INTERVAL * (0.5 + random())
+        if now - self.last_reclaim_time < interval:
+            return []
+        self.last_reclaim_time = now
+        try:
+            return self.reclaim_expired()
+        except Exception:
+            log.exception('Error reclaiming expired jobs')
+            return []
+
+    def reclaim_expired(self) -> list:
+        """
+        Requeue running jobs whose worker stopped renewing their lease, so
+        the coordinator assigns them to another instance
+
+        :return: Ids of requeued jobs
+        """
+        if not hasattr(self.jobs_db.collection, 'where'):
+            # Local test db, can't query
+            return []
+
+        # Finished jobs have their lease cleared, so this usually matches
+        # nothing and costs one read
+        count_firestore_call(self.jobs_db, 'query')
+        expired = self.jobs_db.collection.where(
+            'lease_expires_at', '<', time.time() - self.clock_skew).stream()
+        ret = []
+        for doc in expired:
+            old_job = Job.from_doc(doc)
+            if old_job.status != JOB_STATUS_RUNNING:
+                continue
+            reclaim_count = (old_job.reclaim_count or 0) + 1
+            if reclaim_count > LEASE_MAX_RECLAIMS:
+                changes = dict(
+                    status=JOB_STATUS_FINISHED, finished_at=SERVER_TIMESTAMP,
+                    worker_error=f'Job lease expired {reclaim_count} times, '
+                                 f'not retrying')
+            else:
+                changes = dict(status=JOB_STATUS_CREATED, instance_id=None)
+            job = old_job.replace(
+                reclaim_count=reclaim_count, lease_expires_at=None,
+                reclaimed_from_instance_id=old_job.instance_id, **changes)
+            if self.jobs_db.compare_and_swap(doc.id, doc.to_dict(),
+                                             job.to_dict()):
+                log.warning(f'Lease of job {doc.id} on instance '
+                            f'{old_job.instance_id} expired, set status '
+                            f'to {job.status}')
+                ret.append(doc.id)
+        return ret
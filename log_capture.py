@@ -0,0 +1,110 @@
+import os
+import threading
+import time
+from collections import deque
+
+from logs import log
+
+from constants import WORKER_STATE_DIR, JOB_LOG_MAX_CHARS, \
+    JOB_LOG_MAX_RECORD_CHARS, CONTAINER_LOG_FILE_MAX_AGE
+
+CONTAINER_LOG_DIR = f'{WORKER_STATE_DIR}/container_logs'
+ERROR_LEVEL_NO = log.level('ERROR').no
+
+
+class JobLogs:
+    def __init__(self, max_chars=JOB_LOG_MAX_CHARS,
+                 max_record_chars=JOB_LOG_MAX_RECORD_CHARS):
+        """
+        Loguru sink keeping the most recent log records of each job, i.e.
+        those logged within log.contextualize(job_id=...), in a ring buffer
+        of at most `max_chars`. Records longer than `max_record_chars`,
+        e.g. batches of container output, are cut short, unless they're
+        errors, so tracebacks are kept whole.
+        """
+        self.max_chars = max_chars
+        self.max_record_chars = max_record_chars
+        self.lock = threading.Lock()
+        self.records = {}  # job id => deque of records
+        self.sizes = {}  # job id => chars in records
+
+    def __call__(self, message):
+        job_id = message.record['extra']['job_id']
+        text = str(message)
+        if len(text) > self.max_record_chars and \
+                message.record['level'].no < ERROR_LEVEL_NO:
+            text = f'{text[:self.max_record_chars]}... ' \
+                f'{len(text) - self.max_record_chars} more characters\n'
+        with self.lock:
+            records = self.records.setdefault(job_id, deque())
+            records.append(text)
+            size = self.sizes.get(job_id, 0) + len(text)
+            while size > self.max_chars and len(records) > 1:
+                size -= len(records.popleft())
+            self.sizes[job_id] = size
+
+    def get(self, job_id) -> str:
+        with self.lock:
+            return ''.join(self.records.get(job_id, []))
+
+    def pop(self, job_id):
+        with self.lock:
+            self.records.pop(job_id, None)
+            self.sizes.pop(job_id, None)
+
+
+JOB_LOGS = JobLogs()
+log.add(JOB_LOGS, level='DEBUG',
+        filter=lambda record: 'job_id' in record['extra'],
+        format='{time:YYYY-MM-DD HH:mm:ss.SSS} | {level: <8} | {message}')
+
+
+class ContainerLogFile:
+    def __init__(self, path):
+        """
+        Line handler for LogFollower that writes a container's full log to
+        `path`, so it's on disk if the upload to GCS fails without all of
+        it going through the main log sinks
+
+        :param path: File to append to, made along with its directory
+        """
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.file = open(path, 'a', encoding='utf-8')
+
+    def __call__(self, line):
+        self.file.write(line + '\n')
+
+    def close(self):
+        self.file.close()
+
+    def read(self) -> str:
+        self.file.flush()
+        with open(self.path, encoding='utf-8') as f:
+            return f.read()
+
+    def remove(self):
+        self.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def get_container_log_path(log_dir, filename) -> str:
+    return f'{log_dir}/{filename.replace("/", "_")}'
+
+
+def remove_old_container_logs(log_dir, max_age=CONTAINER_LOG_FILE_MAX_AGE):
+    """Container logs are removed once uploaded, so these are from crashes"""
+    if not os.path.exists(log_dir):
+        return
+    now = time.time()
+    for filename in os.listdir(log_dir):
+        path = f'{log_dir}/{filename}'
+        try:
+            if now - os.path.getmtime(path) > max_age:
+                log.info(f'Removing old container log {path}')
+                os.remove(path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,280 @@
+import threading
+import time
+from datetime import datetime
+
+from logs import log
+
+from constants import CONTAINER_LOG_MAX_BATCH_LINES, \
+    CONTAINER_LOG_MAX_LINE_BYTES, CONTAINER_LOG_MAX_LOGGED_BYTES, \
+    CONTAINER_LOG_SAMPLE_EVERY, CONTAINER_LOG_MAX_RECONNECTS, \
+    CONTAINER_LOG_RECONNECT_DELAY
+
+JSON_OUT_DELIMITER = '|~__JSON_OUT_LINE_DELIMITER__~|'
+
+
+def get_timestamp(line: bytes):
+    """
+    :return: Sortable (seconds, nanoseconds) of the Docker timestamp the
+        line starts with, e.g. 2019-09-19T21:58:56.123456789Z, or None if
+        it doesn't start with one, e.g. it's the rest of a split line
+    """
+    timestamp = line[:40].split(b' ', 1)[0]
+    if len(timestamp) < 20 or timestamp[10:11] != b'T' or \
+            not timestamp.endswith(b'Z'):
+        return None
+    # Docker trims trailing zeros from the nanoseconds
+    return timestamp[:19], timestamp[20:-1].ljust(9, b'0')
+
+
+def split_line(line: bytes, max_bytes=CONTAINER_LOG_MAX_LINE_BYTES) -> list:
+    """
+    Splits lines longer than max_bytes, between UTF-8 characters so they
+    each decode cleanly
+    """
+    ret = []
+    while len(line) > max_bytes:
+        cut = max_bytes
+        # Back up over continuation bytes, 10xxxxxx
+        while cut > 0 and line[cut] & 0xC0 == 0x80:
+            cut -= 1
+        if cut == 0:
+            # Not UTF-8, so no boundary to find
+            cut = max_bytes
+        ret.append(line[:cut])
+        line = line[cut:]
+    ret.append(line)
+    return ret
+
+
+class LogFollower:
+    def __init__(self, container, line_handlers=None, level='CONTAINER',
+                 job_id=None, max_logged_bytes=CONTAINER_LOG_MAX_LOGGED_BYTES,
+                 sample_every=CONTAINER_LOG_SAMPLE_EVERY,
+                 reconnect_delay=CONTAINER_LOG_RECONNECT_DELAY):
+        """
+        Follows a container's log stream on its own thread, delivering each
+        line exactly once to each of `line_handlers`, and in batches to the
+        `level` log. Only the first `max_logged_bytes` are logged, then
+        every `sample_every`th line, so chatty containers don't flood the
+        log sinks.
+
+        Memory is bounded by CONTAINER_LOG_MAX_BATCH_LINES lines of at most
+        CONTAINER_LOG_MAX_LINE_BYTES bytes, longer lines are split.
+
+        If the stream drops while the container's still running, we
+        reconnect from the last line's timestamp, skipping lines that are
+        sent again.
+
+        :param container: Docker container to follow
+        :param line_handlers: Callables taking each line (with timestamp),
+            called from the reader thread
+        :param level: Log level for container output, None to not log
+        :param job_id: Bound to logged output, see log_capture.JobLogs
+        :param reconnect_delay: Seconds to wait before reconnecting
+        """
+        self.container = container
+        self.line_handlers = list(line_handlers or [])
+        self.level = level
+        self.log = log.bind(job_id=job_id) if job_id is not None else log
+        self.max_logged_bytes = max_logged_bytes
+        self.sample_every = sample_every
+        self.reconnect_delay = reconnect_delay
+        self.lock = threading.Lock()
+        self.batch = []
+        self.num_lines = 0
+        self.logged_bytes = 0
+        self.thread = None
+        self.stream = None
+        self.stopped = threading.Event()
+
+        # Timestamp of the last line delivered, and how many lines had it,
+        # to skip when reconnecting
+        self.last_timestamp = None
+        self.num_at_last_timestamp = 0
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self.run, daemon=True,
+            name=f'log-follower-{self.container.short_id}')
+        self.thread.start()
+
+    def join(self, timeout=None) -> bool:
+        """
+        Waits for the log stream to end, i.e. for the container to exit,
+        then flushes any remaining lines.
+
+        :return: Whether the stream ended before timeout
+        """
+        self.thread.join(timeout)
+        self.flush()
+        return not self.thread.is_alive()
+
+    def stop(self):
+        """
+        Closes the log stream, e.g. if it didn't end when the container
+        exited, so that join() returns and handlers aren't called again
+        """
+        self.stopped.set()
+        stream = self.stream
+        if stream is not None and hasattr(stream, 'close'):
+            try:
+                stream.close()
+            except Exception:
+                log.exception(f'Error closing log stream for '
+                              f'{self.container}')
+
+    def run(self):
+        reconnects = 0
+        while True:
+            try:
+                partial = self.follow()
+            except Exception:
+                if not self.stopped.is_set():
+                    log.exception(f'Error following logs for '
+                                  f'{self.container}')
+                # Sent again in full after reconnecting
+                partial = b''
+            if self.stopped.is_set() or \
+                    reconnects >= CONTAINER_LOG_MAX_RECONNECTS or \
+                    not self.is_running():
+                break
+            reconnects += 1
+            log.warning(f'Log stream for {self.container} ended while it '
+                        f'was running, reconnecting')
+            time.sleep(self.reconnect_delay)
+        if partial:
+            self.add_lines([partial])
+
+    def follow(self) -> bytes:
+        """
+        Delivers lines from the log stream until it ends
+
+        :return: The last line, if it didn't end with a newline
+        """
+        since = None
+        skip = None
+        if self.last_timestamp is not None:
+            # Docker only resumes from a whole second
+            since = datetime.strptime(self.last_timestamp[0].decode(),
+                                      '%Y-%m-%dT%H:%M:%S')
+            skip = [self.last_timestamp, self.num_at_last_timestamp]
+        stream = self.container.logs(stream=True, follow=True,
+                                     timestamps=True, since=since)
+        self.stream = stream
+        if self.stopped.is_set():
+            # Stopped while connecting
+            stream.close()
+            return b''
+        partial = b''
+        for chunk in stream:
+            partial += chunk
+            lines = partial.split(b'\n')
+            partial = lines.pop()
+            lines = [piece for line in lines for piece in split_line(line)]
+            if len(partial) > CONTAINER_LOG_MAX_LINE_BYTES:
+                pieces = split_line(partial)
+                partial = pieces.pop()
+                lines += pieces
+            if skip is not None:
+                lines = self.skip_sent(lines, skip)
+                if lines:
+                    skip = None
+            self.add_lines(lines)
+        return partial
+
+    @staticmethod
+    def skip_sent(lines, skip) -> list:
+        """
+        :param skip: [timestamp, count] of the last line(s) delivered before
+            reconnecting, whose count is decremented as they're skipped
+        :return: Lines from the first one we haven't delivered
+        """
+        for i, line in enumerate(lines):
+            timestamp = get_timestamp(line)
+            if timestamp is None or timestamp < skip[0]:
+                # Including the rest of a split line we've skipped
+                continue
+            if timestamp == skip[0] and skip[1] > 0:
+                skip[1] -= 1
+                continue
+            return lines[i:]
+        return []
+
+    def is_running(self) -> bool:
+        try:
+            self.container.reload()
+        except Exception:
+            # Removed
+            return False
+        return self.container.status == 'running'
+
+    def add_lines(self, lines):
+        if not lines:
+            return
+        self.track_timestamp(lines)
+        lines = [line.decode(errors='replace') for line in lines]
+        for handler in self.line_handlers:
+            for line in lines:
+                handler(line)
+        with self.lock:
+            for line in lines:
+                if self.logged_bytes < self.max_logged_bytes:
+                    self.logged_bytes += len(line)
+                    self.batch.append(line)
+                    if self.logged_bytes >= self.max_logged_bytes:
+                        self.batch.append(
+                            f'... logged {self.logged_bytes} bytes, only '
+                            f'logging every {self.sample_every}th line from '
+                            f'here on')
+                elif self.num_lines % self.sample_every == 0:
+                    self.batch.append(line)
+                self.num_lines += 1
+            full = len(self.batch) >= CONTAINER_LOG_MAX_BATCH_LINES
+        if full:
+            self.flush()
+
+    def track_timestamp(self, lines):
+        """Remembers where we got to, in case we need to reconnect"""
+        timestamp = None
+        count = 0
+        for line in reversed(lines):
+            line_timestamp = get_timestamp(line)
+            if line_timestamp is None:
+                continue
+            if timestamp is None:
+                timestamp = line_timestamp
+            elif line_timestamp != timestamp:
+                break
+            count += 1
+        if timestamp is None:
+            return
+        if timestamp == self.last_timestamp:
+            count += self.num_at_last_timestamp
+        self.last_timestamp, self.num_at_last_timestamp = timestamp, count
+
+    def flush(self):
+        """Log lines received since the last flush as one record"""
+        with self.lock:
+            # Log while holding the lock to keep batches in order
+            if self.batch and self.level is not None:
+                self.log.log(self.level, '\n'.join(self.batch))
+            self.batch = []
+
+
+class JsonOutScanner:
+    """
+    Line handler for LogFollower that picks out the first line
+    containing JSON_OUT_DELIMITER as lines stream in, so we never need a
+    container's full log in memory to find it.
+    """
+    def __init__(self):
+        self.json_out = ''
+
+    def __call__(self, line):
+        if self.json_out:
+            return
+        json_out_start = line.find(JSON_OUT_DELIMITER)
+        if json_out_start != -1:
+            json_out_start += len(JSON_OUT_DELIMITER)
+            self.json_out = line[json_out_start:].strip()
+            log.success(f'Found json out: {self.json_out}')
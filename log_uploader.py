@@ -0,0 +1,72 @@
+import gzip
+from typing import Optional
+
+from logs import log
+from problem_constants.constants import BOTLEAGUE_LOG_BUCKET, \
+    BOTLEAGUE_LOG_DIR
+
+from constants import LOG_UPLOAD_CHUNK_SIZE
+
+
+def get_log_url(key):
+    return f'https://storage.googleapis.com/{BOTLEAGUE_LOG_BUCKET}/{key}'
+
+
+def get_log_key(filename):
+    return f'{BOTLEAGUE_LOG_DIR}/{filename}'
+
+
+class LogUploader:
+    def __init__(self, bucket, filename):
+        """
+        LogFollower line handler that gzips container logs and streams them
+        to GCS with a resumable upload, one LOG_UPLOAD_CHUNK_SIZE part at a
+        time, while the container runs. So logs are mostly uploaded by the
+        time the job finishes and are never held in memory in full.
+
+        The object is stored with Content-Encoding: gzip, so it's served
+        decompressed from the same URL as before.
+
+        :param bucket: google.cloud.storage.Bucket for BOTLEAGUE_LOG_BUCKET
+        :param filename: Name of the log within BOTLEAGUE_LOG_DIR
+        """
+        self.key = get_log_key(filename)
+        self.url = get_log_url(self.key)
+        self.failed = False
+        self.writer = None
+        self.gzip = None
+        try:
+            blob = bucket.blob(self.key)
+            blob.content_type = 'text/plain; charset=utf-8'
+            blob.content_encoding = 'gzip'
+            self.writer = blob.open('wb', chunk_size=LOG_UPLOAD_CHUNK_SIZE,
+                                    ignore_flush=True)
+            self.gzip = gzip.GzipFile(fileobj=self.writer, mode='wb')
+        except Exception:
+            self.fail()
+
+    def __call__(self, line):
+        if self.failed:
+            return
+        try:
+            self.gzip.write(line.encode() + b'\n')
+        except Exception:
+            self.fail()
+
+    def close(self) -> Optional[str]:
+        """
+        Uploads the last part and finalizes the object
+
+        :return: The log's URL, or None if streaming the upload failed
+        """
+        if not self.failed:
+            try:
+                self.gzip.close()
+                self.writer.close()
+            except Exception:
+                self.fail()
+        return None if self.failed else self.url
+
+    def fail(self):
+        log.exception(f'Error streaming logs to {self.url}')
+        self.failed = True
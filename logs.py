@@ -1,4 +1,14 @@
+import threading
+
 from loguru import logger as log
-from botleague_helpers.logs import add_slack_error_sink
 
-add_slack_error_sink(log, '#deepdrive-alerts', log_name='Problem Worker')
+container_run_level = log.level('CONTAINER', no=10, color='<magenta>')
+
+
+def add_slack_sink():
+    from botleague_helpers.logs import add_slack_error_sink
+    add_slack_error_sink(log, '#deepdrive-alerts', log_name='Problem Worker')
+
+
+# In the background so importing this doesn't wait on Slack
+threading.Thread(target=add_slack_sink, daemon=True, name='slack-sink').start()
@@ -0,0 +1,272 @@
+import re
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from logs import log
+
+from constants import METRICS_PORT, METRICS_HOST
+
+# Seconds, from quick API calls up to hour long sim builds
+DEFAULT_BUCKETS = [0.005, 0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120,
+                   300, 600, 1800, 3600, 7200]
+
+
+def format_labels(labels) -> str:
+    if not labels:
+        return ''
+    pairs = [f'{k}="{escape(v)}"' for k, v in labels]
+    return '{' + ','.join(pairs) + '}'
+
+
+def escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+class Counter:
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.lock = threading.Lock()
+        self.values = {}  # sorted label items => count
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        with self.lock:
+            return self.values.get(tuple(sorted(labels.items())), 0)
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.description}',
+                 f'# TYPE {self.name} counter']
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f'{self.name}{format_labels(key)} {value}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, description, buckets=None):
+        self.name = name
+        self.description = description
+        self.buckets = sorted(buckets or DEFAULT_BUCKETS)
+        self.lock = threading.Lock()
+        self.values = {}  # sorted label items => [bucket counts, sum, count]
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = [[0] * len(self.buckets), 0., 0]
+            values = self.values[key]
+            i = bisect_left(self.buckets, value)
+            if i < len(self.buckets):
+                values[0][i] += 1
+            values[1] += value
+            values[2] += 1
+
+    def get_count(self, **labels) -> int:
+        with self.lock:
+            return self.values.get(tuple(sorted(labels.items())),
+                                   [None, 0, 0])[2]
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.description}',
+                 f'# TYPE {self.name} histogram']
+        with self.lock:
+            for key, (counts, total, count) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(
+                        f'{self.name}_bucket'
+                        f'{format_labels(key + (("le", bound),))} '
+                        f'{cumulative}')
+                lines.append(f'{self.name}_bucket'
+                             f'{format_labels(key + (("le", "+Inf"),))} '
+                             f'{count}')
+                lines.append(f'{self.name}_sum{format_labels(key)} {total}')
+                lines.append(f'{self.name}_count{format_labels(key)} {count}')
+        return lines
+
+
+class Gauge:
+    def __init__(self, name, description, get_value):
+        """
+        :param get_value: Called on each scrape for the current value
+        """
+        self.name = name
+        self.description = description
+        self.get_value = get_value
+
+    def render(self) -> list:
+        try:
+            value = self.get_value()
+        except Exception:
+            log.exception(f'Could not get {self.name}')
+            return []
+        return [f'# HELP {self.name} {self.description}',
+                f'# TYPE {self.name} gauge',
+                f'{self.name} {value}']
+
+
+class Registry:
+    def __init__(self):
+        """Metrics, rendered in the Prometheus text format"""
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def add(self, metric):
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, description) -> Counter:
+        return self.add(Counter(name, description))
+
+    def histogram(self, name, description, buckets=None) -> Histogram:
+        return self.add(Histogram(name, description, buckets))
+
+    def gauge(self, name, description, get_value) -> Gauge:
+        with self.lock:
+            # Replaced, so the latest worker's values are reported
+            self.metrics[name] = Gauge(name, description, get_value)
+            return self.metrics[name]
+
+    def render(self) -> str:
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines += metric.render()
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+PHASE_SECONDS = REGISTRY.histogram(
+    'worker_job_phase_seconds', 'Time spent in each phase of a job')
+LOOP_SECONDS = REGISTRY.histogram(
+    'worker_loop_iteration_seconds', 'Latency of worker loop iterations')
+DOCKER_CALLS = REGISTRY.counter(
+    'worker_docker_api_calls_total', 'Docker Engine API requests')
+FIRESTORE_CALLS = REGISTRY.counter(
+    'worker_firestore_calls_total', 'Firestore reads and writes')
+
+
+@contextmanager
+def span(phase, **labels):
+    """
+    Times the block as a job phase, e.g.
+        with span('get_image', tag=tag):
+            ...
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        PHASE_SECONDS.observe(time.time() - start, phase=phase, **labels)
+
+
+def count_docker_calls(docker_client):
+    """
+    Counts the client's requests to the Docker daemon by method and
+    resource, i.e. containers, images, events, ...
+    """
+    api = getattr(docker_client, 'api', None)
+    if api is None or not hasattr(api, 'hooks'):
+        # Not a real client
+        return docker_client
+
+    def on_response(resp, *_args, **_kwargs):
+        DOCKER_CALLS.inc(method=resp.request.method,
+                         resource=get_docker_resource(resp.request.path_url))
+
+    api.hooks['response'].append(on_response)
+    return docker_client
+
+
+def get_docker_resource(path) -> str:
+    """/v1.40/containers/abc/json?all=1 => containers"""
+    parts = [p for p in path.split('?')[0].split('/')
+             if p and not re.match(r'v\d+\.\d+$', p)]
+    return parts[0] if parts else ''
+
+
+def count_firestore_call(db, method):
+    FIRESTORE_CALLS.inc(collection=getattr(db, 'collection_name', ''),
+                        method=method)
+
+
+class CountedDB:
+    def __init__(self, db):
+        """
+        Counts calls to a botleague_helpers db's get, set, etc... by
+        collection and method
+        """
+        self.wrapped_db = db
+
+    def __getattr__(self, name):
+        attr = getattr(self.wrapped_db, name)
+        if name not in ['get', 'set', 'compare_and_swap']:
+            return attr
+
+        def counted(*args, **kwargs):
+            count_firestore_call(self.wrapped_db, name)
+            return attr(*args, **kwargs)
+
+        return counted
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *_args):
+        pass
+
+
+class MetricsServer:
+    def __init__(self, port=METRICS_PORT, registry=REGISTRY,
+                 host=METRICS_HOST):
+        """
+        Serves metrics for Prometheus to scrape at
+        http://<host>:<port>/metrics
+
+        :param port: 0 for any free port
+        :param host: Address to listen on, loopback by default
+        """
+        handler = type('Handler', (MetricsHandler,), dict(registry=registry))
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        self.host, self.port = self.server.server_address[:2]
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.server.serve_forever,
+                                           daemon=True, name='metrics')
+            self.thread.start()
+            log.info(f'Serving metrics on {self.host}:{self.port}')
+
+    def stop(self):
+        if self.thread is not None:
+            self.server.shutdown()
+            self.thread.join()
+            self.thread = None
+        self.server.server_close()
@@ -0,0 +1,221 @@
+import os
+import threading
+from typing import Optional
+
+from box import Box
+from docker.errors import NotFound
+
+from logs import log
+from problem_constants.constants import BOTLEAGUE_RESULTS_DIR, \
+    BOTLEAGUE_INNER_RESULTS_DIR_NAME
+from results_collector import make_writable
+from utils import is_docker, write_json_atomic, \
+    generate_rand_alphanumeric
+
+from constants import WARM_POOL_TAGS, WARM_POOL_SIZE
+
+DIR = os.path.dirname(os.path.realpath(__file__))
+CREDS_PATH = '/mnt/.gcpcreds/silken-impulse-217423-8fbe5bbb2a10.json'
+
+# Where problem containers find the eval spec
+EVAL_SPEC_DIR = '/mnt/botleague_eval_spec'
+EVAL_SPEC_FILEPATH = f'{EVAL_SPEC_DIR}/eval_spec.json'
+
+
+def get_results_mount_base():
+    if is_docker():
+        return '/mnt/botleague_results'
+    else:
+        # For local, native testing
+        return f'{DIR}/botleague_results'
+
+
+def make_mount_dir(path):
+    os.makedirs(path, exist_ok=True)
+    make_writable(path)
+    return path
+
+
+def get_static_env() -> Box:
+    """Env for problem containers that's the same for every eval"""
+    # TODO: Change FILEPATH to DIR in deepdrive
+    result_dir = f'{BOTLEAGUE_RESULTS_DIR}/' + \
+                 f'{BOTLEAGUE_INNER_RESULTS_DIR_NAME}'
+    return Box(
+        BOTLEAGUE_RESULT_FILEPATH=result_dir,
+        BOTLEAGUE_EVAL_SPEC_FILEPATH=EVAL_SPEC_FILEPATH,
+        DEEPDRIVE_UPLOAD='1',
+        GOOGLE_APPLICATION_CREDENTIALS=CREDS_PATH)
+
+
+def get_eval_env(eval_spec) -> Box:
+    """Env for problem containers specific to an eval"""
+    ret = Box(
+        BOTLEAGUE_EVAL_KEY=eval_spec.eval_key,
+        BOTLEAGUE_SEED=eval_spec.seed,
+        BOTLEAUGE_PROBLEM=eval_spec.problem)
+    sim_url = (eval_spec.problem_def or {}).get('problem_ci_replace_sim_url')
+    if sim_url:
+        ret.SIM_URL = sim_url
+    return ret
+
+
+def get_volumes(results_mount, spec_mount) -> dict:
+    return {
+        results_mount: {
+            'bind': BOTLEAGUE_RESULTS_DIR,
+            'mode': 'rw'
+        },
+        spec_mount: {
+            'bind': EVAL_SPEC_DIR,
+            'mode': 'ro'
+        },
+        '/root/.gcpcreds': {
+            'bind': '/mnt/.gcpcreds',
+            'mode': 'rw'
+        }
+    }
+
+
+def write_eval_spec(spec_mount, eval_spec):
+    """
+    The whole eval spec, along with the eval's env, for the container to
+    read from EVAL_SPEC_FILEPATH. Written atomically, as warm containers
+    start the eval as soon as it appears.
+    """
+    write_json_atomic(dict(env=get_eval_env(eval_spec).to_dict(),
+                           eval_spec=eval_spec.to_dict()),
+                      f'{spec_mount}/eval_spec.json')
+
+
+class WarmPool:
+    def __init__(self, docker_client, start_container, tags=WARM_POOL_TAGS,
+                 size=WARM_POOL_SIZE, mount_base=None):
+        """
+        Keeps `size` problem containers running for each of `tags`, with
+        the sim loaded and waiting for an eval spec to be written to
+        EVAL_SPEC_FILEPATH, so evals of those problems don't wait on sim
+        startup. Only for problem images that support this, i.e. which
+        wait for the spec when BOTLEAGUE_WARM_START is set.
+
+        :param docker_client: docker.DockerClient
+        :param start_container: Starts a container given docker_tag, env,
+            volumes and name, i.e. Worker.start_container
+        :param tags: Problem image tags to keep warm containers for
+        :param size: Warm containers per tag
+        :param mount_base: Where to make the containers' results and spec
+            dirs, defaults to get_results_mount_base()
+        """
+        self.docker = docker_client
+        self.start_container = start_container
+        self.tags = list(tags)
+        self.size = size
+        self.mount_base = mount_base
+        self.lock = threading.Lock()
+        self.entries = {tag: [] for tag in self.tags}
+
+    @property
+    def container_ids(self) -> set:
+        with self.lock:
+            return set(e.container.id for entries in self.entries.values()
+                       for e in entries)
+
+    def fill(self):
+        """
+        Replace warm containers that died or are for an old image, and
+        create any that are missing. Call while idle.
+        """
+        for tag in self.tags:
+            try:
+                image_id = self.docker.images.get(tag).id
+            except NotFound:
+                # Not pulled yet
+                continue
+            with self.lock:
+                entries = self.entries[tag]
+                self.entries[tag] = []
+            for entry in entries:
+                if entry.image_id == image_id and self.is_running(entry):
+                    with self.lock:
+                        self.entries[tag].append(entry)
+                else:
+                    log.info(f'Replacing warm container for {tag}')
+                    self.remove(entry)
+            while len(self.entries[tag]) < self.size:
+                entry = self.create(tag, image_id)
+                with self.lock:
+                    self.entries[tag].append(entry)
+
+    def create(self, tag, image_id) -> Box:
+        name = f'problem_warm_{generate_rand_alphanumeric(12)}'
+        base = f'{self.mount_base or get_results_mount_base()}/{name}'
+        results_mount = make_mount_dir(f'{base}/results')
+        spec_mount = make_mount_dir(f'{base}/spec')
+        env = get_static_env()
+        env.BOTLEAGUE_WARM_START = '1'
+        container = self.start_container(
+            docker_tag=tag, env=env.to_dict(), name=name,
+            volumes=get_volumes(results_mount, spec_mount))
+        log.info(f'Started warm container {name} for {tag}')
+        return Box(container=container, image_id=image_id,
+                   results_mount=results_mount, spec_mount=spec_mount)
+
+    def is_running(self, entry) -> bool:
+        try:
+            entry.container.reload()
+        except NotFound:
+            return False
+        return entry.container.status == 'running'
+
+    def claim(self, tag, name, eval_spec, image_id) -> Optional[Box]:
+        """
+        Start an eval in a warm container, if there is one
+
+        :param tag: Problem image tag
+        :param name: Name to give the container, as if it were started cold
+        :param eval_spec: The eval to run
+        :param image_id: Id of the problem image pulled for the eval. Warm
+            containers of other images, i.e. from before the tag was
+            updated, are removed, to be replaced by fill().
+        :return: The warm container's container, results_mount and
+            spec_mount, or None if there isn't one ready
+        """
+        if (eval_spec.problem_def or {}).get('problem_ci_replace_sim_url'):
+            # Needs a different sim than the warm one
+            return None
+        with self.lock:
+            entries = self.entries.get(tag) or []
+            stale = [e for e in entries if e.image_id != image_id]
+            entries[:] = [e for e in entries if e.image_id == image_id]
+            entry = entries.pop(0) if entries else None
+        for stale_entry in stale:
+            log.info(f'Removing warm container for old image of {tag}')
+            self.remove(stale_entry)
+        if entry is None or not self.is_running(entry):
+            if entry is not None:
+                self.remove(entry)
+            return None
+        write_eval_spec(entry.spec_mount, eval_spec)
+        try:
+            self.docker.containers.get(name).remove(force=True)
+        except NotFound:
+            pass
+        entry.container.rename(name)
+        entry.container.reload()
+        log.success(f'Running eval {eval_spec.eval_id} in warm container')
+        return entry
+
+    def remove(self, entry):
+        try:
+            entry.container.remove(force=True)
+        except NotFound:
+            pass
+        except Exception:
+            log.exception('Could not remove warm container')
+
+    def stop(self):
+        with self.lock:
+            entries = [e for es in self.entries.values() for e in es]
+            self.entries = {tag: [] for tag in self.tags}
+        for entry in entries:
+            self.remove(entry)
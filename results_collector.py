@@ -0,0 +1,255 @@
+import ctypes
+import ctypes.util
+import json
+import os
+import select
+import struct
+import threading
+
+from logs import log
+from problem_constants.constants import BOTLEAGUE_INNER_RESULTS_DIR_NAME, \
+    BOTLEAGUE_RESULTS_FILEPATH
+
+from constants import RESULTS_WATCH_POLL_INTERVAL, RESULTS_LOG_MAX_LIST_LEN
+
+RESULTS_FILENAME = 'results.json'
+
+# From sys/inotify.h
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+INOTIFY_EVENT = struct.Struct('iIII')  # wd, mask, cookie, len
+
+
+def make_writable(path):
+    """Like chmod -R 777, but without forking a shell"""
+    os.chmod(path, 0o777)
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            try:
+                os.chmod(os.path.join(root, name), 0o777)
+            except FileNotFoundError:
+                pass
+
+
+def get_results_path(results_dir) -> str:
+    return f'{results_dir}/{BOTLEAGUE_INNER_RESULTS_DIR_NAME}/' \
+        f'{RESULTS_FILENAME}'
+
+
+class NoResults:
+    def __init__(self, error):
+        """
+        Returned by read_results() when the results file is missing or
+        invalid, so it can't be mistaken for results with an `error` key
+
+        :param error: Why there are no results, for the liaison
+        """
+        self.error = error
+
+    def to_dict(self) -> dict:
+        return dict(error=self.error)
+
+
+def read_results(path):
+    """
+    Parses the results file once, straight from disk rather than via an
+    intermediate string
+
+    :return: The results dict, or NoResults if there aren't any
+    """
+    try:
+        with open(path) as f:
+            ret = json.load(f)
+    except FileNotFoundError:
+        return NoResults(f'No results file found at '
+                         f'{BOTLEAGUE_RESULTS_FILEPATH}')
+    except ValueError as e:
+        return NoResults(f'Results file at {BOTLEAGUE_RESULTS_FILEPATH} '
+                         f'is not valid JSON: {e}')
+    if not isinstance(ret, dict):
+        return NoResults(f'Results file at {BOTLEAGUE_RESULTS_FILEPATH} '
+                         f'is not a JSON object')
+    return ret
+
+
+def summarize(value, max_list_len=RESULTS_LOG_MAX_LIST_LEN):
+    """
+    Results with long lists, e.g. per-episode arrays, cut down for logging
+    """
+    if isinstance(value, dict):
+        return {k: summarize(v, max_list_len) for k, v in value.items()}
+    elif isinstance(value, list):
+        ret = [summarize(v, max_list_len) for v in value[:max_list_len]]
+        if len(value) > max_list_len:
+            ret.append(f'... {len(value) - max_list_len} more')
+        return ret
+    return value
+
+
+class Inotify:
+    def __init__(self):
+        """Just enough of inotify(7) to know when files are written"""
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.add_watch_fn = libc.inotify_add_watch
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+    def add_watch(self, path, mask) -> int:
+        wd = self.add_watch_fn(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f'Could not watch {path}')
+        return wd
+
+    def read(self, timeout, wake_fd=None) -> list:
+        """
+        :param wake_fd: Returns early once this is readable
+        :return: (wd, mask, name) of events, waiting up to timeout for some
+        """
+        fds = [self.fd] if wake_fd is None else [self.fd, wake_fd]
+        if self.fd not in select.select(fds, [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            events.append((wd, mask, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class ResultsCollector:
+    def __init__(self, results_dir, on_results=None,
+                 poll_interval=RESULTS_WATCH_POLL_INTERVAL):
+        """
+        Watches a problem container's results mount, parsing results.json
+        each time it's written, so partial results can be forwarded while
+        the container's still running. Uses inotify, or polls the file's
+        mtime where that's not available.
+
+        :param results_dir: Host side of the results mount
+        :param on_results: Called from the watcher thread with each new
+            version of the results
+        :param poll_interval: Seconds between checks when polling
+        """
+        self.results_dir = results_dir
+        self.path = get_results_path(results_dir)
+        self.on_results = on_results
+        self.poll_interval = poll_interval
+        self.lock = threading.Lock()
+        self.results = None
+        self.stat = None  # (mtime, size) of the file self.results is from
+        self.num_parses = 0
+        self.stopped = threading.Event()
+        self.thread = None
+        self.wake_fds = None
+
+    def start(self):
+        if self.thread is None:
+            self.stopped.clear()
+            # Written to on stop(), so the watcher isn't waited on
+            self.wake_fds = os.pipe()
+            self.thread = threading.Thread(target=self.run, daemon=True,
+                                           name='results-collector')
+            self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            os.write(self.wake_fds[1], b'x')
+            self.thread.join()
+            self.thread = None
+            for fd in self.wake_fds:
+                os.close(fd)
+            self.wake_fds = None
+
+    def run(self):
+        try:
+            inotify = Inotify()
+        except Exception:
+            log.warning('inotify not available, polling for results')
+            inotify = None
+        try:
+            if inotify is None:
+                self.poll()
+            else:
+                self.watch(inotify)
+        finally:
+            if inotify is not None:
+                inotify.close()
+
+    def poll(self):
+        while not self.stopped.wait(self.poll_interval):
+            self.collect()
+
+    def watch(self, inotify):
+        # The inner results dir is made by the container, so watch for it
+        # to be created before watching it for results
+        inner_dir = os.path.dirname(self.path)
+        inotify.add_watch(self.results_dir, IN_CREATE | IN_MOVED_TO)
+        inner_wd = None
+        while not self.stopped.is_set():
+            if inner_wd is None and os.path.isdir(inner_dir):
+                inner_wd = inotify.add_watch(
+                    inner_dir, IN_CLOSE_WRITE | IN_MOVED_TO)
+                # Could have been written before we were watching
+                self.collect()
+            for wd, _, name in inotify.read(
+                    timeout=self.poll_interval, wake_fd=self.wake_fds[0]):
+                if wd == inner_wd and name == RESULTS_FILENAME:
+                    self.collect()
+
+    def get_stat(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def collect(self, final=False):
+        """
+        Parses the results if they've changed since we last did
+
+        :param final: Whether the container has exited, in which case
+            results are returned even if they're missing or invalid
+        :return: The latest results, or None if there aren't any yet
+        """
+        with self.lock:
+            stat = self.get_stat()
+            if stat is not None and stat == self.stat:
+                return self.results
+            results = read_results(self.path)
+            self.num_parses += 1
+            if isinstance(results, NoResults):
+                if not final:
+                    # Not written yet, or still being written
+                    return None
+                results = results.to_dict()
+            changed = stat is not None
+            self.results, self.stat = results, stat
+        if changed and not final and self.on_results is not None:
+            try:
+                self.on_results(results)
+            except Exception:
+                log.exception('Error forwarding partial results')
+        return results
+
+    def get_results(self) -> dict:
+        """
+        Final results, once the container has exited. Only parsed again if
+        the file changed since the watcher last parsed it.
+        """
+        self.stop()
+        return self.collect(final=True)
@@ -0,0 +1,176 @@
+import json
+import os
+import threading
+import time
+from random import random
+
+import requests
+from box import Box
+
+from logs import log
+from metrics import span
+from results_collector import summarize
+from utils import read_json, write_json_atomic
+
+from constants import WORKER_STATE_DIR, RESULTS_RETRY_DELAY, \
+    RESULTS_RETRY_MAX_DELAY, RESULTS_MAX_AGE, RESULTS_POST_TIMEOUT
+
+RESULTS_OUTBOX_DIR = f'{WORKER_STATE_DIR}/results_outbox'
+
+# The liaison has handled the results, even if it errored, so don't retry
+DELIVERED_STATUS_CODES = [200, 400, 500]
+
+
+class ResultsOutbox:
+    def __init__(self, path=RESULTS_OUTBOX_DIR,
+                 retry_delay=RESULTS_RETRY_DELAY):
+        """
+        Results waiting to be posted to the liaison. Each is written to its
+        own file in `path` before put() returns, and posted by a background
+        sender which retries with exponential backoff until the liaison
+        responds. Undelivered results are sent again after a restart.
+
+        :param path: Directory to keep undelivered results in
+        :param retry_delay: Seconds before the first retry, doubling after
+            each failure
+        """
+        self.path = path
+        self.retry_delay = retry_delay
+        self.session = requests.Session()
+        self.cond = threading.Condition()
+        self.messages = self.load()
+        self.stopped = False
+        self.thread = None
+
+    def load(self) -> list:
+        if not os.path.exists(self.path):
+            return []
+        messages = []
+        for filename in sorted(os.listdir(self.path)):
+            if not filename.endswith('.json'):
+                continue
+            try:
+                messages.append(Box(read_json(f'{self.path}/{filename}'),
+                                    filename=filename))
+            except Exception:
+                log.exception(f'Could not load queued results {filename}')
+        if messages:
+            log.info(f'Resending {len(messages)} undelivered results')
+        return messages
+
+    def start(self):
+        if self.thread is None:
+            self.stopped = False
+            self.thread = threading.Thread(target=self.run, daemon=True,
+                                           name='results-outbox')
+            self.thread.start()
+
+    def stop(self, timeout=None):
+        """Stop sending, undelivered results are sent after a restart"""
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+        if self.thread is not None:
+            self.thread.join(timeout)
+            self.thread = None
+
+    def put(self, url, results_json, job_id):
+        """
+        Queue results to be posted, returning once they're on disk
+
+        :param url: Liaison results endpoint
+        :param results_json: JSON body to post
+        :param job_id: For logging
+        """
+        now = time.time()
+        message = Box(url=url, json=results_json, job_id=job_id,
+                      queued_at=now, attempts=0, next_attempt_at=now)
+        filename = f'{int(now * 1e6)}_{job_id}.json'
+        os.makedirs(self.path, exist_ok=True)
+        # Not indented, as results can be large
+        write_json_atomic(message.to_dict(), f'{self.path}/{filename}',
+                          indent=None)
+        message.filename = filename
+        with self.cond:
+            self.messages.append(message)
+            self.cond.notify_all()
+        log.info(f'Queued results for job {job_id}')
+
+    @property
+    def num_pending(self) -> int:
+        with self.cond:
+            return len(self.messages)
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.stopped:
+                    now = time.time()
+                    due = [m for m in self.messages
+                           if m.next_attempt_at <= now]
+                    if due:
+                        break
+                    next_at = min([m.next_attempt_at for m in self.messages],
+                                  default=now + 60)
+                    self.cond.wait(next_at - now)
+                if self.stopped:
+                    return
+            for message in due:
+                try:
+                    self.send(message)
+                except Exception as e:
+                    log.exception(f'Error sending results for job '
+                                  f'{message.job_id}')
+                    self.retry(message, repr(e))
+
+    def send(self, message):
+        log.info(f'Sending results for job {message.job_id}:\n'
+                 f'{json.dumps(summarize(message.json), indent=2)}')
+        try:
+            with span('post_results'):
+                resp = self.session.post(message.url, json=message.json,
+                                         timeout=RESULTS_POST_TIMEOUT)
+        except Exception as e:
+            error = repr(e)
+        else:
+            if resp.status_code in DELIVERED_STATUS_CODES:
+                if resp.ok:
+                    try:
+                        body = json.dumps(resp.json(), indent=2)
+                    except ValueError:
+                        body = resp.text
+                    log.success(f'Successfully posted to botleague! '
+                                f'response:\n{body}')
+                else:
+                    # TODO: Create an alert on this log message
+                    log.error(f'Error posting results back to botleague: '
+                              f'{resp}')
+                self.remove(message)
+                return
+            error = str(resp)
+        self.retry(message, error)
+
+    def retry(self, message, error):
+        """Sends the message again after a backoff, or gives up on it"""
+        message.attempts += 1
+        if time.time() - message.queued_at > RESULTS_MAX_AGE:
+            # TODO: Create an alert on this log message
+            log.error(f'Giving up sending results for job {message.job_id} '
+                      f'after {message.attempts} attempts, last error: '
+                      f'{error}')
+            self.remove(message)
+            return
+        delay = min(RESULTS_RETRY_MAX_DELAY,
+                    self.retry_delay * 2 ** (message.attempts - 1))
+        delay *= 1 + random() / 2  # Avoid workers retrying in lockstep
+        log.error(f'Failed posting results for job {message.job_id}, '
+                  f'{error}, retrying in {delay:.1f}s')
+        message.next_attempt_at = time.time() + delay
+
+    def remove(self, message):
+        with self.cond:
+            self.messages.remove(message)
+        try:
+            os.remove(f'{self.path}/{message.filename}')
+        except FileNotFoundError:
+            pass
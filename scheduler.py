@@ -0,0 +1,130 @@
+import os
+import subprocess
+import threading
+from typing import Optional, Tuple
+
+from box import Box
+
+from logs import log
+from problem_constants.constants import JOB_TYPE_EVAL, JOB_TYPE_SIM_BUILD, \
+    JOB_TYPE_DEEPDRIVE_BUILD
+
+RESOURCES = ['gpus', 'cpus', 'memory_gb']
+
+# What each job type needs by default. Jobs can override with a `resources`
+# field.
+JOB_RESOURCES = {
+    JOB_TYPE_EVAL: Box(gpus=1, cpus=4, memory_gb=16),
+    JOB_TYPE_SIM_BUILD: Box(gpus=0, cpus=8, memory_gb=16),
+    JOB_TYPE_DEEPDRIVE_BUILD: Box(gpus=0, cpus=4, memory_gb=8),
+}
+
+
+def detect_capacity() -> Box:
+    """
+    Resources available to jobs on this machine. Override with WORKER_GPUS,
+    WORKER_CPUS, and WORKER_MEMORY_GB.
+    """
+    if 'WORKER_GPUS' in os.environ:
+        gpus = int(os.environ['WORKER_GPUS'])
+    else:
+        try:
+            gpus = len(subprocess.check_output(
+                ['nvidia-smi', '-L']).decode().strip().splitlines())
+        except Exception:
+            log.warning('Could not list GPUs with nvidia-smi, assuming 0')
+            gpus = 0
+    cpus = float(os.environ.get('WORKER_CPUS', os.cpu_count()))
+    memory_gb = float(os.environ.get(
+        'WORKER_MEMORY_GB',
+        os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1024 ** 3))
+    return Box(gpus=gpus, cpus=cpus, memory_gb=memory_gb)
+
+
+class SlotScheduler:
+    def __init__(self, capacity: Box, max_jobs=1):
+        """
+        Hands out slots of GPUs, CPUs and memory to jobs so that several can
+        run on one instance.
+
+        :param capacity: Resources to split between jobs, see detect_capacity
+        :param max_jobs: Max jobs to run at once
+        """
+        self.capacity = capacity
+        self.max_jobs = max_jobs
+        self.lock = threading.Lock()
+        self.slots = {}  # job id => slot
+        self.free_gpu_ids = list(range(capacity.gpus))
+
+    @property
+    def free(self) -> Box:
+        with self.lock:
+            return self._free()
+
+    def _free(self, excluding=None) -> Box:
+        ret = Box(self.capacity)
+        for job_id, slot in self.slots.items():
+            if job_id == excluding:
+                continue
+            for resource in RESOURCES:
+                ret[resource] -= slot[resource]
+        return ret
+
+    @property
+    def running_job_ids(self) -> list:
+        with self.lock:
+            return list(self.slots)
+
+    def usage_without(self, job_id) -> Tuple[Box, list]:
+        """
+        :return: Free resources and running job ids as they'll be once the
+            job's slot is released
+        """
+        with self.lock:
+            return (self._free(excluding=job_id),
+                    [i for i in self.slots if i != job_id])
+
+    def requirements(self, job) -> Box:
+        needs = Box(JOB_RESOURCES.get(job.job_type, Box(gpus=0, cpus=1,
+                                                        memory_gb=1)))
+        needs.update(job.get('resources') or {})
+        needs.gpus = int(needs.gpus)
+
+        # Never ask for more than we have, so a lone job can always run
+        return Box({r: min(needs[r], self.capacity[r]) for r in RESOURCES})
+
+    def reserve(self, job) -> Optional[Box]:
+        """
+        :return: A slot for the job, or None if there's not room for it yet
+        """
+        needs = self.requirements(job)
+        with self.lock:
+            if len(self.slots) >= self.max_jobs:
+                return None
+            free = self._free()
+            if any(needs[r] > free[r] for r in RESOURCES):
+                return None
+            gpu_ids = self.free_gpu_ids[:needs.gpus]
+            self.free_gpu_ids = self.free_gpu_ids[needs.gpus:]
+            slot = Box(needs, job_id=job.id, gpu_ids=gpu_ids)
+            self.slots[job.id] = slot
+        log.info(f'Reserved {slot.to_dict()} for job {job.id}')
+        return slot
+
+    def release(self, slot):
+        with self.lock:
+            if self.slots.pop(slot.job_id, None) is None:
+                # Already released
+                return
+            self.free_gpu_ids = sorted(self.free_gpu_ids + slot.gpu_ids)
+        log.info(f'Released slot for job {slot.job_id}')
+
+    def container_options(self, slot) -> dict:
+        """
+        Docker run options that keep a job's containers to its slot. Only
+        needed when running more than one job at a time.
+        """
+        if self.max_jobs == 1:
+            return {}
+        return dict(nano_cpus=int(slot.cpus * 1e9),
+                    mem_limit=f'{int(slot.memory_gb * 1024)}m')
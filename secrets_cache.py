@@ -0,0 +1,91 @@
+import threading
+import time
+
+from box import Box
+
+from logs import log
+
+from constants import SECRETS_TTL, SECRETS_REFRESH_FRACTION
+
+
+class SecretsCache:
+    def __init__(self, ttl=SECRETS_TTL,
+                 refresh_fraction=SECRETS_REFRESH_FRACTION):
+        """
+        Decrypted secrets held in memory for up to `ttl` seconds, so jobs
+        don't wait on Firestore and KMS for them. Once a secret is
+        `refresh_fraction` of the way to expiring, it's fetched again in the
+        background. Secrets that turn out to be rejected should be
+        invalidate()d so the next get() fetches them again.
+
+        :param ttl: Seconds to keep a secret
+        :param refresh_fraction: How far through its ttl to refresh a secret
+        """
+        self.ttl = ttl
+        self.refresh_fraction = refresh_fraction
+        self.lock = threading.Lock()
+        self.fetchers = {}
+        self.entries = {}  # name => Box(value, fetched_at)
+        self.stopped = threading.Event()
+        self.thread = None
+        self.num_fetches = 0
+
+    def register(self, name, fetch):
+        """
+        :param name: Name to get() the secret by
+        :param fetch: Returns the decrypted secret
+        """
+        with self.lock:
+            self.fetchers[name] = fetch
+
+    def start(self):
+        """Fetch all secrets now, and refresh them in the background"""
+        if self.thread is None:
+            self.stopped.clear()
+            self.thread = threading.Thread(target=self.run, daemon=True,
+                                           name='secrets-cache')
+            self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def get(self, name):
+        with self.lock:
+            entry = self.entries.get(name)
+        if entry is not None and time.time() - entry.fetched_at < self.ttl:
+            return entry.value
+        return self.fetch(name)
+
+    def invalidate(self, name):
+        log.warning(f'Invalidating cached {name}')
+        with self.lock:
+            self.entries.pop(name, None)
+
+    def fetch(self, name):
+        with self.lock:
+            fetch = self.fetchers[name]
+        value = fetch()
+        with self.lock:
+            self.num_fetches += 1
+            self.entries[name] = Box(value=value, fetched_at=time.time())
+        return value
+
+    def run(self):
+        while True:
+            now = time.time()
+            with self.lock:
+                names = list(self.fetchers)
+                fetched_at = {n: e.fetched_at for n, e in self.entries.items()}
+            refresh_after = self.ttl * self.refresh_fraction
+            for name in names:
+                if now - fetched_at.get(name, 0) >= refresh_after:
+                    try:
+                        self.fetch(name)
+                    except Exception:
+                        # Tried again next time, or by get() once expired
+                        log.exception(f'Could not refresh {name}')
+            if self.stopped.wait(max(0.1, refresh_after / 10)):
+                return
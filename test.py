@@ -1,5 +1,13 @@
+import asyncio
+import gzip
 import os
+import subprocess
 import sys
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
 
 from loguru import logger as log
 
@@ -9,11 +17,49 @@ from box import Box
 import utils
 from problem_constants.constants import JOB_STATUS_FINISHED, \
     JOB_STATUS_ASSIGNED, JOB_TYPE_EVAL, JOB_TYPE_SIM_BUILD, \
-    JOB_TYPE_DEEPDRIVE_BUILD
+    JOB_TYPE_DEEPDRIVE_BUILD, JOB_STATUS_RUNNING, JOB_STATUS_CREATED, \
+    INSTANCE_STATUS_AVAILABLE, INSTANCE_STATUS_USED, \
+    BOTLEAGUE_INNER_RESULTS_DIR_NAME
 
+from async_runtime import AsyncRuntime
+from artifact_pusher import ArtifactPusher, ARTIFACT_REPO
+from auto_updater import AutoUpdater, pull_latest
 from common import get_worker_instances_db
+from constants import WORKER_CONTAINER_LABEL
+from container_monitor import ContainerMonitor, DockerEvents, \
+    WorkerContainers
+from fakes import FakeClient, FakeDB, FakeDocker, FakeGCSServer, \
+    FakeRegistryClient, FakeLiaisonServer, get_offline_worker
+from image_cache import ImageCache
+from image_index import ImageIndex, get_digest
+from image_puller import ImagePuller
+from job_checkpoint import JobCheckpoints, find_containers, \
+    JOB_STATE_STARTED, JOB_STATE_PULLED, JOB_STATE_REPORTED, \
+    JOB_STATE_RESULTS_SENT
+from job_intake import JobIntake
+from job_model import Job
+from job_store import JobStore
+from lease import LeaseKeeper
+from log_capture import JobLogs, ContainerLogFile, JOB_LOGS
+from log_follower import LogFollower, JsonOutScanner, split_line
+from log_uploader import LogUploader
+from metrics import MetricsServer, Registry, CountedDB, FIRESTORE_CALLS, \
+    PHASE_SECONDS, span, get_docker_resource
+from problem_containers import WarmPool
+from results_collector import ResultsCollector, get_results_path, \
+    make_writable, summarize
+from results_outbox import ResultsOutbox
+from scheduler import SlotScheduler
+from secrets_cache import SecretsCache
 from worker import Worker
 
+# Importing the worker is job pickup downtime after every auto update
+STARTUP_IMPORT_BUDGET_SECS = 2
+
+# Only imported once needed, not at startup
+LAZY_MODULES = ['git', 'google.cloud.storage', 'google.cloud.kms_v1',
+                'docker_gpu_patch']
+
 
 def test_build_sim():
     job = get_test_job(JOB_TYPE_SIM_BUILD)
@@ -62,7 +108,7 @@ def run_test_job(job, run_problem_only=False):
         assert job.results.logs
         assert not job.results.errors
         assert job.status.lower() == JOB_STATUS_FINISHED
-        assert not utils.dbox(job).coordinator_error
+        assert not job.get('coordinator_error')
         del os.environ['FORCE_FIRESTORE_DB']
         assert 'FORCE_FIRESTORE_DB' not in os.environ
     finally:
@@ -109,6 +155,957 @@ def test_dummy_container():
     run_problem_eval(problem='problem-worker-test', run_problem_only=True)
 
 
+def test_job_intake_watch():
+    jobs_db = FakeDB()
+    intake = JobIntake(jobs_db, 'test-instance')
+    intake.start()
+    assert intake.watching
+    assert not intake.check()
+    job = Box(id='test_job', instance_id='test-instance',
+              status=JOB_STATUS_ASSIGNED)
+    jobs_db.set(job.id, job)
+    assert intake.check().id == job.id
+
+    # Already handed out, so should not be returned again
+    assert not intake.check()
+
+    # Dropped watch should fall back to polling
+    intake.watch.drop()
+    job.status = JOB_STATUS_RUNNING
+    jobs_db.set(job.id, job)
+    job.id = 'test_job_2'
+    job.status = JOB_STATUS_ASSIGNED
+    jobs_db.set(job.id, job)
+    assert intake.check().id == job.id
+    assert not intake.watching
+    intake.stop()
+
+
+def test_job_intake_reassigned():
+    jobs_db = FakeDB()
+    instances_db = FakeDB()
+    for use_watch in [True, False]:
+        instance_id = f'test-instance-{use_watch}'
+        intake = JobIntake(jobs_db, instance_id, use_watch=use_watch)
+        intake.start()
+        job_id = f'test_job_{use_watch}'
+        jobs_db.set(job_id, dict(instance_id=instance_id,
+                                 status=JOB_STATUS_ASSIGNED))
+        assert intake.check().id == job_id
+        jobs_db.set(job_id, dict(instance_id=instance_id,
+                                 status=JOB_STATUS_RUNNING,
+                                 lease_expires_at=0))
+
+        # Requeued after its lease expired, then assigned to us again by
+        # the coordinator, so should be run again
+        reclaimer = LeaseKeeper(jobs_db, instances_db, 'other-instance',
+                                clock_skew=0)
+        assert reclaimer.reclaim_expired() == [job_id]
+        assert not intake.check()
+        job = jobs_db.get(job_id)
+        job.update(instance_id=instance_id, status=JOB_STATUS_ASSIGNED)
+        jobs_db.set(job_id, job)
+        job = intake.check()
+        assert job.id == job_id and job.reclaim_count == 1
+        assert not intake.check()
+        intake.stop()
+
+
+def test_container_monitor_events():
+    docker = FakeDocker()
+    docker.behaviors['test/fail'] = dict(duration=0.2, exit_code=1)
+    docker.behaviors['test/long'] = dict(duration=60)
+    events = DockerEvents(docker)
+    events.start()
+    containers = [docker.containers.run('test/fail'),
+                  docker.containers.run('test/long')]
+    containers, success = ContainerMonitor(docker, events).run(containers)
+    events.stop()
+    assert not success
+    assert containers[0].attrs['State']['ExitCode'] == 1
+
+    # Orphaned sibling should be stopped
+    assert containers[1].state == 'exited'
+
+
+def test_log_follower():
+    docker = FakeDocker()
+    docker.behaviors['test/chatty'] = dict(duration=0.5, lines_per_sec=10000)
+    container = docker.containers.run('test/chatty')
+    lines = []
+    follower = LogFollower(container, line_handlers=[lines.append])
+    follower.start()
+    assert follower.join(timeout=10)
+    assert lines == container.log_lines
+    assert not follower.batch
+
+    # Picks up where it left off when the stream drops
+    docker.behaviors['test/chatty'].update(log_stream_errors=2)
+    container = docker.containers.run('test/chatty')
+    lines = []
+    follower = LogFollower(container, line_handlers=[lines.append],
+                           reconnect_delay=0)
+    follower.start()
+    assert follower.join(timeout=10)
+    assert container.log_stream_errors == 0
+    assert lines == container.log_lines
+
+    # Stopped while the container's still running, e.g. its stream didn't
+    # end when it exited, so handlers can be closed
+    docker.behaviors['test/chatty'].update(duration=30, log_stream_errors=0)
+    container = docker.containers.run('test/chatty')
+    follower = LogFollower(container, line_handlers=[lines.append])
+    follower.start()
+    assert not follower.join(timeout=0.1)
+    follower.stop()
+    assert follower.join(timeout=5)
+    num_lines = len(lines)
+    time.sleep(0.05)
+    assert len(lines) == num_lines
+    container.stop()
+
+    # Long lines are split between characters
+    line = ('2019-09-19T21:58:56.1Z ' + 'é' * 100).encode()
+    pieces = split_line(line, max_bytes=50)
+    assert b''.join(pieces) == line
+    assert all(len(p) <= 50 and p.decode() for p in pieces)
+
+
+def test_json_out_scanner():
+    scanner = JsonOutScanner()
+    scanner('2019-09-19T21:58:56.123456789Z starting sim')
+    scanner('2019-09-19T21:58:57.123456789Z |~__JSON_OUT_LINE_DELIMITER__~|'
+            '{"score": 1} ')
+    scanner('2019-09-19T21:58:58.123456789Z |~__JSON_OUT_LINE_DELIMITER__~|'
+            '{"score": 2}')
+    assert scanner.json_out == '{"score": 1}'
+
+
+def test_log_uploader():
+    gcs = FakeGCSServer()
+    try:
+        bucket = gcs.client().bucket('test_bucket')
+        docker = FakeDocker()
+        docker.behaviors['test/chatty'] = dict(duration=0.5,
+                                               lines_per_sec=10000)
+        container = docker.containers.run('test/chatty')
+        uploader = LogUploader(bucket, 'test_log.txt')
+        follower = LogFollower(container, line_handlers=[uploader],
+                               level=None)
+        follower.start()
+        follower.join()
+        assert uploader.close() == uploader.url
+        uploaded = gcs.objects[('test_bucket', uploader.key)]
+        assert uploaded.metadata['contentEncoding'] == 'gzip'
+        assert gzip.decompress(uploaded.data).decode() == \
+            ''.join(line + '\n' for line in container.log_lines)
+    finally:
+        gcs.stop()
+
+
+def test_slot_scheduler():
+    scheduler = SlotScheduler(Box(gpus=2, cpus=16, memory_gb=64), max_jobs=4)
+    eval_jobs = [Box(id=f'eval_{i}', job_type=JOB_TYPE_EVAL)
+                 for i in range(3)]
+    slots = [scheduler.reserve(job) for job in eval_jobs]
+    assert slots[0].gpu_ids == [0]
+    assert slots[1].gpu_ids == [1]
+    assert slots[2] is None, 'Should be out of GPUs'
+    build_slot = scheduler.reserve(Box(id='build',
+                                       job_type=JOB_TYPE_SIM_BUILD))
+    assert build_slot.gpu_ids == []
+    assert scheduler.free.cpus == 0
+    free, running_job_ids = scheduler.usage_without('build')
+    assert free.cpus == 8 and 'build' not in running_job_ids
+    assert scheduler.free.cpus == 0, 'Slot should not be released yet'
+    scheduler.release(slots[0])
+    assert scheduler.reserve(eval_jobs[2]).gpu_ids == [0]
+    assert scheduler.container_options(build_slot)['nano_cpus'] == 8 * 10**9
+
+    # A lone job should always fit
+    small = SlotScheduler(Box(gpus=0, cpus=2, memory_gb=4))
+    assert small.reserve(eval_jobs[0]).cpus == 2
+
+
+def test_image_puller():
+    problem_tag = 'deepdriveio/deepdrive:problem_test'
+    bot_tag = 'deepdriveio/deepdrive:bot_test'
+    docker = FakeDocker()
+    docker.default_pull_secs = 0.2
+    docker.registry[problem_tag] = ('sha256:' + '1' * 64, 1024)
+    docker.registry[bot_tag] = ('sha256:' + '2' * 64, 1024)
+    with tempfile.TemporaryDirectory() as state_dir:
+        history_path = f'{state_dir}/image_history.json'
+        index = ImageIndex(f'{state_dir}/image_index.json')
+        puller = ImagePuller(docker, history_path=history_path, index=index)
+        start = time.time()
+        images = puller.get_images([problem_tag, bot_tag])
+        assert time.time() - start < 0.35, 'Pulls should be concurrent'
+        assert images[0].tags == [problem_tag]
+        assert docker.num_pulls == 2
+
+        # Unchanged bot digest and recently verified problem, so no pulls
+        checks = docker.registry_checks
+        puller.get_images([problem_tag, bot_tag])
+        assert docker.num_pulls == 2
+        assert docker.registry_checks == checks + 1
+
+        # Same tag should only be pulled once at a time
+        docker.registry[bot_tag] = ('sha256:' + '3' * 64, 1024)
+        futures = [puller.pull(bot_tag) for _ in range(3)]
+        assert len(set(futures)) == 1
+        futures[0].result()
+        assert docker.num_pulls == 3
+
+        # Bots aren't worth prefetching, history survives restarts
+        assert ImagePuller(docker, history_path=history_path,
+                           index=index).predict() == [problem_tag]
+
+
+def test_image_cache():
+    problem_tag = 'deepdriveio/deepdrive:problem_test'
+    bot_tags = [f'deepdriveio/deepdrive:bot_test{i}' for i in range(3)]
+    docker = FakeDocker()
+    docker.default_pull_secs = 0
+    docker.registry[problem_tag] = ('sha256:' + '1' * 64, 4)
+    for i, tag in enumerate(bot_tags):
+        docker.registry[tag] = (f'sha256:{i + 2}' + '0' * 63, 2)
+    # Not pulled by a job, so not ours to evict
+    host_tag = 'host/image:latest'
+    docker.registry[host_tag] = ('sha256:' + '9' * 64, 1)
+    docker.images.pull(host_tag)
+    now = [0.]
+    with tempfile.TemporaryDirectory() as state_dir:
+        cache = ImageCache(docker, path=f'{state_dir}/image_cache.json',
+                           disk_bytes=10, clock=lambda: now[0])
+        for tag in bot_tags + [problem_tag]:
+            docker.images.pull(tag)
+            cache.record_use([tag])
+            now[0] += 1
+        labels = {WORKER_CONTAINER_LABEL: 'inst'}
+        running = docker.containers.run(bot_tags[2], name='running',
+                                        labels=labels)
+        exited = docker.containers.run(bot_tags[0], name='exited',
+                                       labels=labels)
+        exited.stop()
+        # Not started by a worker, so not ours to remove
+        host_exited = docker.containers.run(host_tag, name='host')
+        host_exited.stop()
+        # Removed by someone else while evicting
+        gone = docker.containers.run(bot_tags[0], labels=labels)
+        gone.stop()
+        list_containers = docker.containers.list
+
+        def list_then_remove(**kwargs):
+            ret = list_containers(**kwargs)
+            if gone.id in docker.containers_by_id:
+                gone.remove()
+            return ret
+
+        docker.containers.list = list_then_remove
+
+        # Recently used images might be about to run
+        assert cache.evict() == []
+        docker.containers.list = list_containers
+        assert exited.id not in docker.containers_by_id
+        assert host_exited.id in docker.containers_by_id
+
+        # Disk is 100% full, so oldest bots not in use are evicted until
+        # under the low water mark. Problem images stay pinned.
+        now[0] += 24 * 60 * 60
+        assert cache.maybe_evict([running.id]) == bot_tags[:2]
+        assert sorted(docker.local_images) == sorted([problem_tag,
+                                                      bot_tags[2], host_tag])
+        assert cache.maybe_evict() == [], 'Should wait between checks'
+        running.stop()
+
+        # Docker root not mounted, so can't tell how full the disk is
+        docker.root_dir = f'{state_dir}/not_mounted'
+        cache = ImageCache(docker, path=f'{state_dir}/image_cache.json',
+                           disk_bytes=None, clock=lambda: now[0])
+        assert cache.evict() == [] and cache.evict() == []
+        assert cache.warned_unmeasured
+
+
+def test_artifact_pusher():
+    problem_tag = 'deepdriveio/deepdrive:problem_test'
+    docker = FakeDocker()
+    docker.default_pull_secs = 0
+    docker.registry[problem_tag] = ('sha256:' + '1' * 64, 1024)
+    image = docker.images.pull(problem_tag)
+    digest = get_digest(image, problem_tag)
+    registry = FakeRegistryClient(docker)
+    with tempfile.TemporaryDirectory() as state_dir:
+        path = f'{state_dir}/artifact_pushes.json'
+
+        def get_pusher(login=lambda: Box()):
+            return ArtifactPusher(docker, login=login, path=path,
+                                  registry=registry, retry_delay=0.05)
+
+        # Queued pushes survive restarts
+        get_pusher().push(image, 'problem-1')
+        assert f'{ARTIFACT_REPO}:problem-1' in docker.local_images
+        pusher = get_pusher()
+        assert pusher.pending_tags == [f'{ARTIFACT_REPO}:problem-1']
+        pusher.start()
+
+        # Already pushed, so just retag, with the digest it has in our repo
+        pusher.push(image, 'problem-2')
+        pusher.stop()
+        assert docker.num_pushes == 1
+        assert registry.num_retags == 1
+        pushed_digest = get_digest(image, ARTIFACT_REPO)
+        assert pushed_digest != digest
+        assert docker.registry[f'{ARTIFACT_REPO}:problem-2'][0] == \
+            pushed_digest
+        assert not get_pusher().pending
+        assert sorted(docker.local_images) == [problem_tag]
+        assert pusher.stats.push_lag_secs > 0
+
+        # Failed pushes are retried after a delay
+        logins = []
+
+        def flaky_login():
+            logins.append(time.time())
+            if len(logins) == 1:
+                raise ConnectionError('Docker Hub is down')
+            return Box()
+
+        pusher = get_pusher(login=flaky_login)
+        pusher.start()
+        pusher.push(image, 'problem-3')
+        start = time.time()
+        while pusher.pending and time.time() - start < 5:
+            time.sleep(0.01)
+        pusher.stop()
+        assert len(logins) == 2
+        assert logins[1] - logins[0] >= 0.1  # retry_delay * 2 ** attempts
+        assert registry.num_retags == 2
+
+
+def test_results_outbox():
+    liaison = FakeLiaisonServer(status_codes=[503, 409])
+    try:
+        with tempfile.TemporaryDirectory() as state_dir:
+            path = f'{state_dir}/results_outbox'
+            url = f'{liaison.url}/results'
+
+            # Queued results survive restarts
+            ResultsOutbox(path).put(url, dict(eval_key='a'), job_id='1')
+            outbox = ResultsOutbox(path, retry_delay=0.05)
+            assert outbox.num_pending == 1
+            outbox.start()
+
+            outbox.put(url, dict(eval_key='b'), job_id='2')
+            start = time.time()
+            while outbox.num_pending and time.time() - start < 5:
+                time.sleep(0.01)
+            assert liaison.requests == 4, 'Should retry 503 and 409'
+
+            # Responses that aren't JSON are still delivered
+            liaison.response_body = b'OK'
+            outbox.put(url, dict(eval_key='c'), job_id='3')
+            outbox.put(url, dict(eval_key='d'), job_id='4')
+            while outbox.num_pending and time.time() - start < 5:
+                time.sleep(0.01)
+            outbox.stop()
+            assert sorted(r['eval_key'] for r in liaison.results) == \
+                ['a', 'b', 'c', 'd']
+            assert not os.listdir(path)
+    finally:
+        liaison.stop()
+
+
+def test_lease_keeper():
+    client = FakeClient()
+    jobs_db = FakeDB(use_boxes=True, client=client)
+    instances_db = FakeDB(use_boxes=True, client=client)
+    for instance_id in ['inst-a', 'inst-b']:
+        instances_db.set(instance_id, dict(status='used'))
+    jobs_db.set('job-a', dict(status=JOB_STATUS_RUNNING, instance_id='inst-a',
+                              lease_expires_at=time.time() + 0.3))
+    keeper = LeaseKeeper(jobs_db, instances_db, 'inst-a',
+                         renew_interval=0.05, duration=0.3)
+    keeper.hold('job-a')
+    keeper.start()
+    time.sleep(0.5)
+
+    # Job and instance renewed together in one commit
+    assert jobs_db.get('job-a').lease_expires_at > time.time()
+    assert instances_db.get('inst-a').lease_expires_at > time.time()
+    assert client.commits >= 5
+    assert jobs_db.collection.writes == client.commits + 1
+    other = LeaseKeeper(jobs_db, instances_db, 'inst-b', clock_skew=0)
+    assert other.reclaim_expired() == []
+
+    # Worker dies, so its job is requeued after the lease expires
+    keeper.stop()
+    time.sleep(0.35)
+    assert other.reclaim_expired() == ['job-a']
+    job = jobs_db.get('job-a')
+    assert job.status == JOB_STATUS_CREATED and job.instance_id is None
+    assert job.reclaim_count == 1
+    assert other.reclaim_expired() == []
+
+
+def test_lost_lease():
+    client = FakeClient()
+    jobs_db = FakeDB(use_boxes=True, client=client)
+    instances_db = FakeDB(use_boxes=True, client=client)
+    instances_db.set('inst-a', dict(status='used'))
+    for job_id in ['job-a', 'job-b']:
+        jobs_db.set(job_id, dict(status=JOB_STATUS_RUNNING,
+                                 instance_id='inst-a', lease_expires_at=0))
+    lost = []
+    keeper = LeaseKeeper(jobs_db, instances_db, 'inst-a', on_lost=lost.append)
+    keeper.hold('job-a')
+    keeper.hold('job-b')
+
+    # Reclaimed while we weren't looking, e.g. our clock was behind
+    other = LeaseKeeper(jobs_db, instances_db, 'inst-b', clock_skew=0)
+    assert other.reclaim_expired() == ['job-a', 'job-b']
+    job_b = jobs_db.get('job-b')
+    job_b.update(status=JOB_STATUS_RUNNING, instance_id='inst-a')
+    jobs_db.set('job-b', job_b)
+    keeper.renew()
+    assert lost == ['job-a'] and keeper.job_ids == {'job-b'}
+    assert jobs_db.get('job-a').lease_expires_at is None
+    assert jobs_db.get('job-b').lease_expires_at > time.time()
+
+    # Reassigned jobs aren't overwritten by our results
+    store = JobStore(jobs_db, instances_db, FakeDB(), 'inst-a')
+    jobs_db.set('job-a', dict(jobs_db.get('job-a'), status='assigned',
+                              instance_id='inst-b'))
+    job = Job.from_dict(jobs_db.get('job-a'))
+    job.id = 'job-a'
+    job.results = Box(score=1)
+    assert not store.finish(job, dict(status='available'))
+    assert jobs_db.get('job-a').status == 'assigned'
+    assert instances_db.get('inst-a').status == 'available'
+    job_b = Job.from_dict(jobs_db.get('job-b'))
+    job_b.id = 'job-b'
+    job_b.results = Box(score=2)
+    assert store.finish(job_b)
+    assert jobs_db.get('job-b').status == JOB_STATUS_FINISHED
+
+    # The worker stops the lost job's containers
+    docker = FakeDocker()
+    docker.behaviors['test/problem'] = dict(duration=5)
+    with tempfile.TemporaryDirectory() as tmp:
+        worker = get_offline_worker(tmp, docker, jobs_db, instances_db,
+                                    'inst-a')
+        container = docker.containers.run('test/problem')
+        worker.job_containers['job-a'] = [container]
+        worker.on_lease_lost('job-a')
+        container.reload()
+        assert container.status == 'exited'
+        assert 'job-a' in worker.lost_job_ids
+        worker.stop()
+
+
+def test_job_checkpoints():
+    docker = FakeDocker()
+    docker.behaviors['test/problem'] = dict(duration=5)
+    with tempfile.TemporaryDirectory() as state_dir:
+        checkpoints = JobCheckpoints(f'{state_dir}/jobs')
+        checkpoints.save('job-1', JOB_STATE_PULLED)
+        assert find_containers(docker, checkpoints.get('job-1')) is None
+        problem = docker.containers.run('test/problem',
+                                        name='problem_eval_id_1')
+        bot = docker.containers.run('test/problem')
+        checkpoints.save('job-1', JOB_STATE_STARTED, [problem, bot])
+
+        # After a restart, containers are found by name, or id if unnamed
+        checkpoint, = JobCheckpoints(f'{state_dir}/jobs').load_all()
+        assert checkpoint.state == JOB_STATE_STARTED
+        assert find_containers(docker, checkpoint) == [problem, bot]
+        bot.stop()
+        bot.remove()
+        assert find_containers(docker, checkpoint) is None
+
+        checkpoints.save('job-1', JOB_STATE_REPORTED)
+        assert checkpoints.load_all() == []
+        problem.stop()
+
+
+def test_recover_jobs():
+    client = FakeClient()
+    jobs_db = FakeDB(use_boxes=True, client=client)
+    instances_db = FakeDB(use_boxes=True, client=client)
+    instances_db.set('test-instance', dict(status=INSTANCE_STATUS_USED))
+    docker = FakeDocker()
+    docker.behaviors['test/problem'] = dict(duration=0.1)
+    with tempfile.TemporaryDirectory() as tmp:
+        worker = get_offline_worker(tmp, docker, jobs_db, instances_db,
+                                    'test-instance')
+        for job_id in ['sent', 'started']:
+            jobs_db.set(job_id, dict(id=job_id, status=JOB_STATUS_RUNNING,
+                                     instance_id='test-instance',
+                                     job_type=JOB_TYPE_EVAL))
+            container = docker.containers.run('test/problem',
+                                              name=f'problem_{job_id}')
+            worker.job_checkpoints.save(job_id, JOB_STATE_STARTED,
+                                        [container])
+        worker.job_checkpoints.save('sent', JOB_STATE_RESULTS_SENT,
+                                    results=dict(score=1))
+        worker.recover_jobs()
+
+        # Results were already sent, so it's finished, not run again
+        assert jobs_db.get('sent').status == JOB_STATUS_FINISHED
+        assert jobs_db.get('sent').results.score == 1
+        assert [j.id for j in worker.pending_jobs] == ['started']
+        assert worker.job_checkpoints.get('sent') is None
+        assert worker.results_outbox.num_pending == 0
+        worker.stop()
+
+
+def test_auto_updater():
+    import git
+    with tempfile.TemporaryDirectory() as tmp:
+        remote = git.Repo.init(f'{tmp}/remote.git', bare=True)
+        dev = git.Repo.clone_from(remote.working_dir, f'{tmp}/dev')
+
+        def push_commit(message):
+            utils.write_file(message, f'{tmp}/dev/version.txt')
+            dev.index.add(['version.txt'])
+            dev.index.commit(message)
+            dev.git.push('origin', 'HEAD:production')
+
+        push_commit('v1')
+        worker_dir = f'{tmp}/worker'
+        git.Repo.clone_from(remote.working_dir, worker_dir,
+                            branch='production')
+        updater = AutoUpdater(is_on_gcp=True, repo_dir=worker_dir)
+        num_checks = 5
+        start = time.time()
+        for _ in range(num_checks):
+            assert not updater.check()
+        check_secs = (time.time() - start) / num_checks
+        start = time.time()
+        for _ in range(num_checks):
+            assert not pull_latest(repo_dir=worker_dir)
+        pull_secs = (time.time() - start) / num_checks
+        log.info(f'Check took {check_secs * 1000:.0f}ms, '
+                 f'pull took {pull_secs * 1000:.0f}ms')
+
+        # Local commits ahead of the remote aren't a reason to pull
+        worker = git.Repo(worker_dir)
+        with worker.config_writer() as config:
+            config.set_value('user', 'name', 'test')
+            config.set_value('user', 'email', 'test@example.com')
+        utils.write_file('local', f'{worker_dir}/local.txt')
+        worker.index.add(['local.txt'])
+        worker.index.commit('local')
+        assert not updater.check()
+        assert not pull_latest(check_first=True, repo_dir=worker_dir)
+
+        push_commit('v2')
+        start = time.time()
+        while not updater.updated() and time.time() - start < 5:
+            time.sleep(0.01)
+        updater.stop()
+        assert updater.updated()
+        assert utils.read_file(f'{worker_dir}/version.txt') == 'v2'
+
+        # Merged with our local commit, so up to date with the remote
+        assert not updater.check()
+
+
+def test_worker_containers():
+    docker = FakeDocker()
+    docker.behaviors['test/problem'] = dict(duration=0.2)
+    events = DockerEvents(docker)
+    events.start()
+    containers = WorkerContainers(docker, events)
+    try:
+        ours = docker.containers.run(
+            'test/problem', labels={WORKER_CONTAINER_LABEL: 'inst'})
+        docker.containers.run('test/problem')
+        assert containers.get_running_ids() == {ours.id}
+
+        # Kept up to date from events without listing again
+        api_calls = docker.api_calls
+        later = docker.containers.run(
+            'test/problem', labels={WORKER_CONTAINER_LABEL: 'inst'})
+        time.sleep(0.05)
+        assert containers.get_running_ids() == {ours.id, later.id}
+        time.sleep(0.3)
+        assert containers.get_running_ids() == set()
+        assert docker.api_calls == api_calls + 2  # Just the run
+    finally:
+        events.stop()
+
+
+def test_warm_pool():
+    tag = 'test/problem:warm'
+    docker = FakeDocker()
+    docker.registry[tag] = ('sha256:' + '1' * 64, 1024)
+    docker.images.pull(tag)
+    docker.behaviors[tag] = dict(startup_secs=0.1, duration=0.2)
+
+    def start_container(docker_tag, env, volumes, name):
+        return docker.containers.run(docker_tag, environment=env,
+                                     volumes=volumes, name=name)
+
+    eval_spec = Box(eval_id='1', eval_key='key', seed=1, problem='test',
+                    problem_def={})
+    with tempfile.TemporaryDirectory() as mount_base:
+        pool = WarmPool(docker, start_container, tags=[tag], size=1,
+                        mount_base=mount_base)
+        pool.fill()
+        warm_id, = pool.container_ids
+        image_id = docker.images.get(tag).id
+        eval_spec.problem_def.problem_ci_replace_sim_url = 'http://sim'
+        assert pool.claim(tag, 'problem_eval_id_1', eval_spec,
+                          image_id) is None
+        eval_spec.problem_def = {}
+
+        # Waits for the eval spec, then runs the eval
+        time.sleep(0.3)
+        entry = pool.claim(tag, 'problem_eval_id_1', eval_spec, image_id)
+        assert entry.container.id == warm_id
+        assert docker.containers.get('problem_eval_id_1').id == warm_id
+        assert pool.container_ids == set()
+        time.sleep(0.3)
+        entry.container.reload()
+        assert entry.container.status == 'exited'
+        assert entry.container.log_lines
+
+        # Dead warm containers are replaced
+        pool.fill()
+        replaced_id, = pool.container_ids
+        pool.stop()
+        assert pool.container_ids == set()
+        assert pool.claim(tag, 'problem_eval_id_2', eval_spec,
+                          image_id) is None
+        assert replaced_id not in docker.containers_by_id
+
+        # Image updated after filling, so the eval starts cold rather than
+        # in a container of the old image
+        docker.behaviors[tag]['duration'] = 5
+        pool.fill()
+        old_id, = pool.container_ids
+        docker.registry[tag] = ('sha256:' + '2' * 64, 1024)
+        new_image_id = docker.images.pull(tag).id
+        assert new_image_id != image_id
+        assert pool.claim(tag, 'problem_eval_id_3', eval_spec,
+                          new_image_id) is None
+        assert pool.container_ids == set()
+        assert old_id not in docker.containers_by_id
+        pool.fill()
+        entry, = pool.entries[tag]
+        assert entry.image_id == new_image_id
+        pool.stop()
+
+
+def test_metrics():
+    import requests
+    with span('test_phase', tag_class='bot'):
+        time.sleep(0.01)
+    assert PHASE_SECONDS.get_count(phase='test_phase', tag_class='bot') == 1
+    db = CountedDB(FakeDB())
+    db.set('a', 1)
+    assert db.get('a') == 1
+    assert FIRESTORE_CALLS.get(collection='', method='get') >= 1
+    assert get_docker_resource('/v1.40/containers/abc/json?all=1') == \
+        'containers'
+
+    registry = Registry()
+    histogram = registry.histogram('test_seconds', 'Test', buckets=[1, 10])
+    histogram.observe(5, phase='a"b')
+    registry.counter('test_total', 'Test').inc(method='GET')
+    server = MetricsServer(port=0, registry=registry)
+    server.start()
+    try:
+        # Not on public interfaces
+        assert server.host == '127.0.0.1'
+        resp = requests.get(f'http://127.0.0.1:{server.port}/metrics')
+        assert resp.ok
+        lines = resp.text.splitlines()
+        assert 'test_seconds_bucket{phase="a\\"b",le="1"} 0' in lines
+        assert 'test_seconds_bucket{phase="a\\"b",le="10"} 1' in lines
+        assert 'test_seconds_bucket{phase="a\\"b",le="+Inf"} 1' in lines
+        assert 'test_seconds_count{phase="a\\"b"} 1' in lines
+        assert 'test_total{method="GET"} 1' in lines
+        assert requests.get(
+            f'http://127.0.0.1:{server.port}/').status_code == 404
+    finally:
+        server.stop()
+
+
+def test_secrets_cache():
+    fetches = []
+
+    def fetch():
+        fetches.append(time.time())
+        return f'secret_{len(fetches)}'
+
+    secrets = SecretsCache(ttl=0.5, refresh_fraction=0.5)
+    secrets.register('creds', fetch)
+    assert secrets.get('creds') == 'secret_1'
+    assert secrets.get('creds') == 'secret_1'
+    secrets.invalidate('creds')
+    assert secrets.get('creds') == 'secret_2'
+
+    # Refreshed before expiring, so get() doesn't have to fetch
+    secrets.start()
+    try:
+        time.sleep(1)
+        num_fetches = len(fetches)
+        assert num_fetches >= 4
+        secrets.get('creds')
+        assert len(fetches) == num_fetches
+    finally:
+        secrets.stop()
+
+
+def test_results_collector():
+    with tempfile.TemporaryDirectory() as results_dir:
+        assert 'error' in ResultsCollector(results_dir).get_results()
+
+        partials = []
+        collector = ResultsCollector(results_dir, on_results=partials.append,
+                                     poll_interval=0.05)
+        collector.start()
+        try:
+            # Made by the problem container, after we start watching
+            os.makedirs(f'{results_dir}/{BOTLEAGUE_INNER_RESULTS_DIR_NAME}')
+            utils.write_json_atomic(dict(episodes=[1]),
+                                    get_results_path(results_dir))
+            start = time.time()
+            while not partials and time.time() - start < 5:
+                time.sleep(0.01)
+            utils.write_json_atomic(dict(episodes=list(range(100))),
+                                    get_results_path(results_dir))
+            while len(partials) < 2 and time.time() - start < 5:
+                time.sleep(0.01)
+        finally:
+            collector.stop()
+        assert partials[0] == dict(episodes=[1])
+        num_parses = collector.num_parses
+
+        # Already parsed by the watcher
+        assert collector.get_results() == dict(episodes=list(range(100)))
+        assert collector.num_parses == num_parses
+        assert len(summarize(partials[1])['episodes']) == 11
+
+        # Results that happen to have an error key are still results
+        utils.write_json_atomic(dict(error='bot crashed', score=0),
+                                get_results_path(results_dir))
+        collector = ResultsCollector(results_dir)
+        assert collector.collect() == dict(error='bot crashed', score=0)
+
+        make_writable(results_dir)
+        assert os.stat(get_results_path(results_dir)).st_mode & 0o777 == 0o777
+
+
+def test_job_logs():
+    job_logs = JobLogs(max_chars=1000, max_record_chars=100)
+    sink = log.add(job_logs, filter=lambda r: 'job_id' in r['extra'],
+                   format='{message}')
+    try:
+        with log.contextualize(job_id='job_1'):
+            for i in range(200):
+                log.info(f'line {i}')
+            log.info('x' * 1000)
+        log.info('Not from a job')
+    finally:
+        log.remove(sink)
+    captured = job_logs.get('job_1')
+    assert len(captured) <= 1000
+    assert 'line 199' in captured and 'line 0\n' not in captured
+    assert '901 more characters' in captured
+    assert 'Not from a job' not in captured
+    job_logs.pop('job_1')
+    assert job_logs.get('job_1') == ''
+
+    # Only the first max_logged_bytes of chatty containers are logged
+    docker = FakeDocker()
+    docker.behaviors['test/chatty'] = dict(duration=0.5, lines_per_sec=10000)
+    container = docker.containers.run('test/chatty')
+    with tempfile.TemporaryDirectory() as log_dir:
+        log_file = ContainerLogFile(f'{log_dir}/chatty.txt')
+        logged = []
+        sink = log.add(lambda m: logged.append(str(m)), level='CONTAINER',
+                       filter=lambda r: r['extra'].get('job_id') == 'job_2',
+                       format='{message}')
+        try:
+            follower = LogFollower(container, line_handlers=[log_file],
+                                   job_id='job_2', max_logged_bytes=1000,
+                                   sample_every=100)
+            follower.start()
+            assert follower.join(timeout=10)
+        finally:
+            log.remove(sink)
+        assert log_file.read().splitlines() == container.log_lines
+        num_logged = sum(len(m.splitlines()) for m in logged)
+        assert num_logged < len(container.log_lines) / 50
+        log_file.remove()
+        assert not os.listdir(log_dir)
+
+    # A job's error is just the exception, its log is kept separately
+    job = Job(id='job_3')
+    with log.contextualize(job_id=job.id):
+        log.info('Pulling images')
+        try:
+            raise ValueError('No such image')
+        except ValueError:
+            Worker.handle_job_exception(job)
+    assert job.worker_error.startswith('Traceback')
+    assert 'ValueError: No such image' in job.worker_error
+    assert 'Pulling images' not in job.worker_error
+    assert 'Pulling images' in job.worker_log
+    assert 'ValueError: No such image' in job.worker_log
+    JOB_LOGS.pop(job.id)
+
+
+def test_job_store():
+    client = FakeClient()
+    jobs_db = FakeDB(use_boxes=True, client=client)
+    instances_db = FakeDB(use_boxes=True, client=client)
+    results_db = FakeDB(use_boxes=True, client=client)
+    store = JobStore(jobs_db, instances_db, results_db, 'test-instance')
+    instances_db.set('test-instance', dict(status=INSTANCE_STATUS_USED))
+    job = Box(id='test_job', instance_id='test-instance',
+              status=JOB_STATUS_ASSIGNED, eval_spec=dict(problem='test'))
+    jobs_db.set(job.id, job)
+
+    store.mark_running(job, lease_expires_at=1)
+    assert jobs_db.get(job.id).status == JOB_STATUS_RUNNING
+    assert jobs_db.get(job.id).lease_expires_at == 1
+    try:
+        # No longer assigned
+        store.mark_running(Box(job, status=JOB_STATUS_ASSIGNED))
+        assert False, 'Should not run a job twice'
+    except RuntimeError:
+        pass
+
+    store.save_partial_results(job.id, dict(score=0.5))
+    assert jobs_db.get(job.id).partial_results.score == 0.5
+    results = dict(score=1, episodes=list(range(1000)))
+    job.results = Box(results)
+    commits = client.commits
+    store.finish(job, dict(status=INSTANCE_STATUS_AVAILABLE))
+    assert client.commits == commits + 1
+    finished = jobs_db.get(job.id)
+    assert finished.status == JOB_STATUS_FINISHED
+    assert finished.eval_spec.problem == 'test'
+    assert 'partial_results' not in finished
+    assert len(finished.results.episodes) < 1000
+    assert job.results.episodes == results['episodes']
+    assert store.get_results(finished) == results
+    assert instances_db.get('test-instance').status == \
+        INSTANCE_STATUS_AVAILABLE
+
+    # Instance gone, job should still be finished
+    instances_db.collection.document('test-instance').delete()
+    job = Job(id='test_job_2', instance_id='test-instance',
+              status=JOB_STATUS_RUNNING, results=dict(score=1))
+    jobs_db.set(job.id, job.to_dict())
+    store.finish(job, dict(status=INSTANCE_STATUS_AVAILABLE))
+    assert jobs_db.get(job.id).status == JOB_STATUS_FINISHED
+    assert job.status == JOB_STATUS_FINISHED and job.results.score == 1
+    assert store.get_results(jobs_db.get(job.id)) == dict(score=1)
+
+
+def test_job_model():
+    doc = dict(id='test_job', status=JOB_STATUS_ASSIGNED, coordinator_note='x',
+               eval_spec=dict(problem='test', problem_def=dict(a=1)))
+    job = Job.from_dict(doc)
+    assert job.eval_spec.problem == 'test'
+    assert job.eval_spec.problem_def['a'] == 1
+    assert job.results is None and 'results' not in job
+    assert job.coordinator_note == 'x' and 'coordinator_note' in job
+    assert job.to_dict() == doc
+
+    running = job.replace(status=JOB_STATUS_RUNNING)
+    assert running.status == JOB_STATUS_RUNNING
+    assert job.status == JOB_STATUS_ASSIGNED
+    assert running.eval_spec is job.eval_spec
+
+    job.update(dict(results=dict(episodes=list(range(1000)))))
+    assert len(job.to_json()) < 1000
+    assert len(job.results.episodes) == 1000
+    job.results.logs = Box()
+    assert job.to_dict()['results']['logs'] == {}
+    assert 'test_job' in repr(job)
+
+    class Doc:
+        id = 'doc_id'
+
+        @staticmethod
+        def to_dict():
+            return dict(status=JOB_STATUS_ASSIGNED)
+    assert Job.from_doc(Doc).id == 'doc_id'
+
+
+def test_async_runtime():
+    class SlowHousekeepingWorker:
+        # Just what AsyncRuntime uses of a Worker
+        def __init__(self):
+            self.jobs = deque(
+                Box(id=f'job_{i}', job_type=JOB_TYPE_DEEPDRIVE_BUILD)
+                for i in range(3))
+            self.pending_jobs = deque()
+            self.scheduler = SlotScheduler(
+                Box(gpus=0, cpus=12, memory_gb=24), max_jobs=3)
+            self.job_executor = ThreadPoolExecutor(max_workers=3)
+            self.job_intake = SimpleNamespace(watching=True)
+            self.lease_keeper = SimpleNamespace(reclaim_expired=self.slow)
+            self.evict_images = self.stop_old_containers_if_running = \
+                self.prepare_for_jobs = self.slow
+            self.finish_times = []
+            self.num_slow_calls = 0
+            self.stopped = False
+
+        def slow(self):
+            self.num_slow_calls += 1
+            time.sleep(1)
+
+        def start_services(self):
+            pass
+
+        def should_stop(self):
+            return False
+
+        def check_for_jobs(self):
+            return self.jobs.popleft() if self.jobs else None
+
+        def run_job(self, job, slot):
+            time.sleep(0.05)
+            self.scheduler.release(slot)
+            self.finish_times.append(time.time())
+
+        def stop(self):
+            self.job_executor.shutdown(wait=True)
+            self.stopped = True
+
+    worker = SlowHousekeepingWorker()
+    start = time.time()
+    job = asyncio.run(AsyncRuntime(worker).run(max_iters=3))
+    assert job.id == 'job_2'
+    assert worker.stopped
+    # Not held up by housekeeping
+    assert len(worker.finish_times) == 3
+    assert max(worker.finish_times) - start < 0.5
+    # Each housekeeping task once, then not until its interval's passed
+    assert worker.num_slow_calls == 3
+
+
+def test_startup():
+    out = subprocess.run(
+        [sys.executable, '-c',
+         'import sys, time; start = time.time(); import worker; '
+         'print(time.time() - start); '
+         f'print([m for m in {LAZY_MODULES} if m in sys.modules])'],
+        capture_output=True, text=True, check=True,
+        cwd=os.path.dirname(os.path.realpath(__file__)))
+    import_secs, eager_modules = out.stdout.strip().splitlines()[-2:]
+    log.info(f'Imported worker in {float(import_secs):.2f}s')
+    assert float(import_secs) < STARTUP_IMPORT_BUDGET_SECS
+    assert eager_modules == '[]', f'Imported at startup: {eager_modules}'
+
+
 def run_all(current_module):
     log.info('Running all tests')
     num = 0
@@ -23,6 +23,16 @@ def write_json(obj, path):
         json.dump(obj, f, indent=2)
 
 
+def write_json_atomic(obj, path, indent=2):
+    """Write so that path has either the old or new obj, even on a crash"""
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f, indent=indent)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
 def read_json(filename):
     with open(filename) as file:
         results = json.load(file)
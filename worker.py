@@ -1,154 +1,512 @@
-import json
+import gzip
 import os
-import sys
 
-from io import StringIO
-from retry import retry
-from typing import Optional
-
-import re
-
-from botleague_helpers.crypto import decrypt_symmetric, decrypt_db_key
-from botleague_helpers import docker_cleanup
-from botleague_helpers.db import get_db
 from botleague_helpers.utils import box2json
-from datetime import datetime
 
+import threading
 import time
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from copy import deepcopy
 from random import random
+from typing import Optional
 
-import requests
 import docker
 from box import Box, BoxList
-from docker.models.images import Image
+from google.api_core.exceptions import NotFound as DocumentNotFound
 from google.cloud.firestore_v1 import SERVER_TIMESTAMP
 from logs import log
 
 from botleague_helpers.config import in_test
 
+from artifact_pusher import ArtifactPusher, ARTIFACT_PUSH_QUEUE_PATH
 from auto_updater import AutoUpdater
-from common import is_json, get_jobs_db, fetch_instance_id, \
-    get_worker_instances_db, get_secrets_db
+from common import get_jobs_db, fetch_instance_id, \
+    get_worker_instances_db, get_job_results_db, get_secrets_db, \
+    get_storage_client
 from problem_constants.constants import JOB_STATUS_RUNNING, \
-    JOB_STATUS_FINISHED, \
-    BOTLEAGUE_RESULTS_FILEPATH, BOTLEAGUE_RESULTS_DIR, BOTLEAGUE_LOG_BUCKET, \
-    BOTLEAGUE_LOG_DIR, CONTAINER_RUN_OPTIONS, \
-    BOTLEAGUE_INNER_RESULTS_DIR_NAME, JOB_STATUS_ASSIGNED, JOB_TYPE_EVAL, \
+    BOTLEAGUE_LOG_BUCKET, \
+    CONTAINER_RUN_OPTIONS, \
+    JOB_TYPE_EVAL, \
     JOB_TYPE_SIM_BUILD, JOB_TYPE_DEEPDRIVE_BUILD
 from problem_constants import constants as prob_const
 
 from constants import SIM_PACKAGE_IMAGE_TAG, STACKDRIVER_LOG_NAME, \
-    DEEPDRIVE_BUILD_IMAGE_TAG
-from botleague_helpers.logs import add_stackdriver_sink
-from utils import is_docker, dbox
-
-container_run_level = log.level('CONTAINER', no=10, color='<magenta>')
+    DEEPDRIVE_BUILD_IMAGE_TAG, JOB_WATCH, CONTAINER_LOG_FLUSH_INTERVAL, \
+    WORKER_MAX_JOBS, WORKER_CONTAINER_LABEL, WARM_POOL_TAGS, METRICS_PORT, \
+    WORKER_STATE_DIR, PARTIAL_RESULTS_INTERVAL, WORKER_ASYNC
+from container_monitor import ContainerMonitor, DockerEvents, \
+    WorkerContainers
+from image_cache import ImageCache, IMAGE_CACHE_PATH
+from image_index import ImageIndex, IMAGE_INDEX_PATH
+from image_puller import ImagePuller, IMAGE_HISTORY_PATH
+from job_checkpoint import JobCheckpoints, JOB_CHECKPOINT_DIR, \
+    find_containers, \
+    remove_containers, JOB_STATE_PULLED, JOB_STATE_STARTED, \
+    JOB_STATE_RESULTS_SENT, JOB_STATE_REPORTED
+from job_intake import JobIntake
+from job_model import Job
+from job_store import JobStore
+from lease import LeaseKeeper, batch_update
+from log_capture import JOB_LOGS, CONTAINER_LOG_DIR, ContainerLogFile, \
+    get_container_log_path, remove_old_container_logs
+from log_follower import LogFollower, JsonOutScanner
+from log_uploader import LogUploader, get_log_key, get_log_url
+from metrics import MetricsServer, REGISTRY, LOOP_SECONDS, PHASE_SECONDS, \
+    CountedDB, span, count_docker_calls
+from problem_containers import WarmPool, get_static_env, get_eval_env, \
+    get_volumes, write_eval_spec, get_results_mount_base, make_mount_dir
+from results_collector import ResultsCollector
+from results_outbox import ResultsOutbox, RESULTS_OUTBOX_DIR
+from scheduler import SlotScheduler, detect_capacity
+from secrets_cache import SecretsCache
+from utils import dbox
 
 DIR = os.path.dirname(os.path.realpath(__file__))
 
 
-def safe_box_update(box_to_update, **fields):
-    # https://github.com/cdgriffith/Box/issues/98
-    box_to_update = box_to_update.to_dict()
-    box_to_update.update(**fields)
-    box_to_update = Box(box_to_update)
-    return box_to_update
-
-
 class Worker:
-    def __init__(self, jobs_db=None, instances_db=None, run_problem_only=False):
+    def __init__(self, jobs_db=None, instances_db=None, run_problem_only=False,
+                 docker_client=None, instance_id=None, log_bucket=None,
+                 state_dir=WORKER_STATE_DIR, results_mount_base=None,
+                 job_results_db=None):
         """
         :param jobs_db: Job status, etc... in Firestore
         :param instances_db: Instance status, etc... in Firestore
         :param run_problem_only: If True, will not run the bot container. This
             is not relevant to sim-build jobs.
+        :param docker_client: docker.DockerClient, from the env by default
+        :param instance_id: Our instance, by default fetched from the GCP
+            metadata server or INSTANCE_ID
+        :param log_bucket: GCS bucket to upload container logs to
+        :param state_dir: Where to keep local state that should survive
+            restarts
+        :param results_mount_base: Where to make problem containers'
+            results dirs, by default get_results_mount_base()
+        :param job_results_db: Full results of jobs whose results are
+            summarized in the job, see JobStore
         """
-        self.instance_id, self.is_on_gcp = fetch_instance_id()
-        self.docker = docker.from_env()
-        self.jobs_db = jobs_db or get_jobs_db()
+        if instance_id is None:
+            self.instance_id, self.is_on_gcp = fetch_instance_id()
+        else:
+            self.instance_id, self.is_on_gcp = instance_id, False
+        self.docker = count_docker_calls(docker_client or docker.from_env())
+        self.docker_events = DockerEvents(self.docker)
+        self.worker_containers = WorkerContainers(self.docker,
+                                                  self.docker_events)
+        self.stopped_unlabelled_containers = False
+        self.old_container_ids = set()  # Not ours as of the last check
+
+        def in_state_dir(path):
+            return os.path.join(state_dir,
+                                os.path.relpath(path, WORKER_STATE_DIR))
+
+        self.image_puller = ImagePuller(
+            self.docker, history_path=in_state_dir(IMAGE_HISTORY_PATH),
+            index=ImageIndex(in_state_dir(IMAGE_INDEX_PATH)))
+        self.image_cache = ImageCache(self.docker,
+                                      path=in_state_dir(IMAGE_CACHE_PATH),
+                                      index=self.image_puller.index)
+        self.artifact_pusher = ArtifactPusher(
+            self.docker, login=self.login_to_docker,
+            path=in_state_dir(ARTIFACT_PUSH_QUEUE_PATH))
+        self.results_outbox = ResultsOutbox(in_state_dir(RESULTS_OUTBOX_DIR))
+        self.results_mount_base = results_mount_base or \
+            get_results_mount_base()
+        self.log_streams = {}
+        self.container_log_dir = in_state_dir(CONTAINER_LOG_DIR)
+        remove_old_container_logs(self.container_log_dir)
+        self.log_bucket = log_bucket
+        self.jobs_db = CountedDB(jobs_db or get_jobs_db())
 
         # Use this sparingly. Event loop should do most of the management
         # of instances so as to avoid race conditions.
-        self.instances_db = instances_db or get_worker_instances_db()
-
+        self.instances_db = CountedDB(
+            instances_db or get_worker_instances_db())
+
+        self.job_store = JobStore(
+            self.jobs_db, self.instances_db,
+            CountedDB(job_results_db or get_job_results_db()),
+            self.instance_id)
+        self.lease_keeper = LeaseKeeper(self.jobs_db, self.instances_db,
+                                        self.instance_id,
+                                        on_lost=self.on_lease_lost)
+        self.job_intake = JobIntake(self.jobs_db, self.instance_id,
+                                    use_watch=JOB_WATCH,
+                                    max_jobs=WORKER_MAX_JOBS)
+        self.scheduler = SlotScheduler(detect_capacity(),
+                                       max_jobs=WORKER_MAX_JOBS)
+        self.job_executor = ThreadPoolExecutor(max_workers=WORKER_MAX_JOBS)
+        self.job_futures = {}
+        self.pending_jobs = deque()
+
+        # Containers of running jobs, which must not be stopped as old
+        self.active_container_ids = set()
+        self.job_containers = {}  # job id => containers
+
+        # Jobs requeued or reassigned while we were running them
+        self.lost_job_ids = set()
+
+        # Where jobs have got to, so we can pick them up after a restart
+        self.job_checkpoints = JobCheckpoints(in_state_dir(JOB_CHECKPOINT_DIR))
+        self.recovered_containers = {}  # job id => containers to re-attach
+
+        # Per worker, as the nvidia runtime fallback changes them
+        self.container_run_options = deepcopy(CONTAINER_RUN_OPTIONS)
+        self.container_run_options_lock = threading.Lock()
+
+        # Warm containers aren't limited to a job's slot, so only when
+        # running one job at a time
+        self.warm_pool = WarmPool(
+            self.docker, self.start_container,
+            tags=WARM_POOL_TAGS if WORKER_MAX_JOBS == 1 else [],
+            mount_base=self.results_mount_base)
+        self.instance_lock = threading.Lock()
         self.auto_updater = AutoUpdater(self.is_on_gcp)
         self.run_problem_only = run_problem_only
-        self.loggedin_to_docker = False
-        add_stackdriver_sink(log, f'{STACKDRIVER_LOG_NAME}-inst-{self.instance_id}')
+        self.docker_login_lock = threading.Lock()
+
+        # Decrypted ahead of jobs needing them
+        self.secrets = SecretsCache()
+        self.secrets.register('docker_creds', self.get_docker_creds)
+        self.secrets.register('aws_creds', self.get_aws_creds)
+        self.add_log_sinks()
         self.docker_creds = None
+        self.metrics_server = None
+
+        # Set to end the loop after the current iteration
+        self.stop_requested = threading.Event()
+
+    def add_log_sinks(self):
+        # In the background, as connecting to Stackdriver would otherwise
+        # hold up picking up jobs after a restart
+        def add():
+            from botleague_helpers.logs import add_stackdriver_sink
+            add_stackdriver_sink(
+                log, f'{STACKDRIVER_LOG_NAME}-inst-{self.instance_id}')
+
+        threading.Thread(target=add, daemon=True, name='log-sinks').start()
 
     @log.catch(reraise=True)
     def loop(self, max_iters=None):
+        """
+        Runs jobs one iteration at a time on this thread. See run_async()
+        for running the worker's I/O concurrently instead.
+
+        :param max_iters: Iterations to run before stopping, for tests
+        :return: The last job checked for
+        """
         iters = 0
         log.info('Worker started, checking for jobs ...')
+        self.start_services()
         while True:
-            docker_cleanup.prune()
+            iter_start = time.time()
 
-            # TODO: Pull in containers that we'll likely need
+            # Evicts old images when disk is getting full
+            self.evict_images()
 
-            if self.auto_updater.updated():
-                # We will be auto restarted by systemd with new code
-                log.success('Ending loop, so that we are restarted with '
-                            'changes')
+            if self.should_stop():
+                self.stop()
                 return
 
-            # TODO: Allow more than one job to run at a time.
             self.stop_old_containers_if_running()
-            job = self.check_for_jobs()
-            if job:
-                self.run_job(job)
+            if self.pending_jobs:
+                job = self.pending_jobs.popleft()
+            else:
+                job = self.check_for_jobs()
+            if job and not self.start_job(job):
+                # Wait for a running job to free up resources
+                self.pending_jobs.appendleft(job)
+                wait(list(self.job_futures.values()), timeout=1,
+                     return_when=FIRST_COMPLETED)
+            elif not job and not self.job_futures:
+                self.prepare_for_jobs()
 
-            # TODO: Send heartbeat every minute. Even with idle, a job without
-            #  a timeout can be stuck forever if the worker process is down.
-            #
+            # Requeue jobs of workers that died
+            self.lease_keeper.maybe_reclaim()
 
-            # TODO: Clean up containers and images with LRU and depending on
-            #  disk space. Shouldn't matter until more problems and providers
-            #  are added.
+            # Includes running the job when we only run one at a time
+            LOOP_SECONDS.observe(time.time() - iter_start)
 
             # TODO: Use preemptible
             #  instances after docker caching is worked out.
             iters += 1
             if max_iters is not None and iters >= max_iters:
                 # Used for testing
+                self.stop()
                 return job
 
-            # Sleep with random splay to avoid thundering herd
-            time.sleep(0.5 + random())
+            if not self.job_intake.watching:
+                # Sleep with random splay to avoid thundering herd
+                time.sleep(0.5 + random())
 
-    def run_job(self, job):
-        log.success(f'Running job: '
-                    f'{box2json(job)}')
-        self.login_to_docker()
-        self.mark_job_running(job)
-        job.results = Box(logs=Box(), errors=Box(),)
+    @log.catch(reraise=True)
+    def run_async(self, max_iters=None):
+        """
+        Runs the worker on an asyncio event loop, so that checking for jobs,
+        housekeeping like reclaiming leases and evicting images, and
+        running jobs don't wait on each other. See async_runtime.py
+
+        :param max_iters: Checks for jobs before stopping, for tests
+        :return: The last job checked for
+        """
+        import asyncio
+        from async_runtime import AsyncRuntime
+        log.info('Worker started, checking for jobs ...')
+        return asyncio.run(AsyncRuntime(self).run(max_iters))
+
+    def start_services(self):
+        self.job_intake.start()
+        self.secrets.start()
+        self.lease_keeper.start()
+        self.docker_events.start()
+        self.recover_jobs()
+
+        # Resumes results and pushes that were pending when we last stopped
+        self.results_outbox.start()
+        self.artifact_pusher.start()
+        self.start_metrics_server()
+        if self.scheduler.max_jobs > 1:
+            self.advertise_capacity()
+
+    def should_stop(self) -> bool:
+        if self.auto_updater.updated():
+            # We will be auto restarted by systemd with new code
+            log.success('Ending loop, so that we are restarted with '
+                        'changes')
+            return True
+        if self.stop_requested.is_set():
+            log.info('Ending loop, stop requested')
+            return True
+        return False
+
+    def evict_images(self):
+        self.image_cache.maybe_evict(
+            self.active_container_ids,
+            keep_tags=self.artifact_pusher.pending_tags)
+
+    def stop(self):
+        """Stop taking jobs and wait for running ones to finish"""
+        self.auto_updater.stop()
+        self.job_intake.stop()
+        self.job_executor.shutdown(wait=True)
+        self.warm_pool.stop()
+        self.lease_keeper.stop()
+        self.secrets.stop()
+
+        # Undelivered results and unfinished pushes are resumed on restart
+        self.results_outbox.stop(timeout=10)
+        self.artifact_pusher.stop(timeout=10)
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+            self.metrics_server = None
+
+    def start_metrics_server(self):
+        """Serves job phase timings, API call counts, etc... on /metrics"""
+        REGISTRY.gauge('worker_running_jobs', 'Jobs running on this worker',
+                       lambda: len(self.scheduler.slots))
+        REGISTRY.gauge('worker_results_pending',
+                       'Results waiting to be posted to the liaison',
+                       lambda: self.results_outbox.num_pending)
+        REGISTRY.gauge('worker_pushes_pending',
+                       'Bot and problem images waiting to be pushed',
+                       lambda: len(self.artifact_pusher.pending_tags))
+        REGISTRY.gauge('worker_push_lag_seconds',
+                       'Seconds from queueing to finishing the last push',
+                       lambda: self.artifact_pusher.stats.push_lag_secs)
+        if not METRICS_PORT or self.metrics_server is not None:
+            return
         try:
-            if job.job_type == JOB_TYPE_EVAL:
-                self.run_eval_job(job)
-            elif job.job_type == JOB_TYPE_SIM_BUILD:
-                self.run_build_job(job)
-            elif job.job_type == JOB_TYPE_DEEPDRIVE_BUILD:
-                self.run_deepdrive_build_job(job)
+            self.metrics_server = MetricsServer(METRICS_PORT)
+        except OSError:
+            log.exception(f'Could not serve metrics on port {METRICS_PORT}')
+            return
+        self.metrics_server.start()
+
+    def start_job(self, job) -> bool:
+        """
+        Runs the job if there are enough free resources, in the background
+        if we can run more than one job at a time.
+
+        :return: Whether the job was started
+        """
+        slot = self.scheduler.reserve(job)
+        if slot is None:
+            return False
+        if self.scheduler.max_jobs == 1:
+            self.run_job(job, slot)
+        else:
+            future = self.job_executor.submit(self.run_job, job, slot)
+            self.job_futures[job.id] = future
+
+            def on_done(_future):
+                self.job_futures.pop(job.id, None)
+                if _future.exception() is not None:
+                    log.opt(exception=_future.exception()).error(
+                        f'Error running job {job.id}')
+
+            future.add_done_callback(on_done)
+        return True
+
+    def run_job(self, job, slot=None):
+        # Records logged for the job are kept in JOB_LOGS until it's done
+        with log.contextualize(job_id=job.id):
+            try:
+                self.run_job_with_logs(job, slot)
+            finally:
+                JOB_LOGS.pop(job.id)
+
+    def run_job_with_logs(self, job, slot=None):
+        slot = slot or self.scheduler.reserve(job)
+        job_start = time.time()
+        try:
+            log.success(f'Running job: {job.to_json()}')
+            self.login_to_docker()
+            if job.id in self.recovered_containers:
+                # Already marked running before we restarted
+                self.lease_keeper.hold(job.id)
+            else:
+                self.mark_job_running(job)
+            job.results = Box(logs=Box(), errors=Box(),)
+            try:
+                if job.job_type == JOB_TYPE_EVAL:
+                    self.run_eval_job(job)
+                elif job.job_type == JOB_TYPE_SIM_BUILD:
+                    self.run_build_job(job)
+                elif job.job_type == JOB_TYPE_DEEPDRIVE_BUILD:
+                    self.run_deepdrive_build_job(job)
+            except Exception:
+                self.handle_job_exception(job)
+            self.finish_job(job)
+            self.job_checkpoints.save(job.id, JOB_STATE_REPORTED)
+            log.success(f'Finished job: {job.to_json()}')
+        finally:
+            PHASE_SECONDS.observe(time.time() - job_start, phase='job',
+                                  job_type=job.job_type)
+            self.lease_keeper.release(job.id)
+            self.lost_job_ids.discard(job.id)
+            if slot is not None:
+                self.scheduler.release(slot)
+            for container in self.recovered_containers.pop(job.id, []):
+                # Job failed before re-attaching
+                container.stop(timeout=1)
+                self.active_container_ids.discard(container.id)
+
+    def recover_jobs(self):
+        """
+        Queues jobs we were running when the worker last stopped, re-attaching
+        to their containers if they were started, so that work isn't lost.
+        """
+        for checkpoint in self.job_checkpoints.load_all():
+            value = self.jobs_db.get(checkpoint.job_id)
+            job = Job.from_dict(value) if value else None
+            if not job or job.status != JOB_STATUS_RUNNING or \
+                    job.instance_id != self.instance_id:
+                log.warning(f'Not recovering job {checkpoint.job_id}, it is '
+                            f'no longer running on this instance')
+                remove_containers(self.docker, checkpoint)
+                self.job_checkpoints.remove(checkpoint.job_id)
+                continue
+            job.id = checkpoint.job_id
+            if checkpoint.state == JOB_STATE_RESULTS_SENT:
+                self.finish_recovered_job(job, checkpoint)
+                continue
+            containers = find_containers(self.docker, checkpoint)
+            if containers is None:
+                log.warning(f'Running job {job.id} again from the start')
+                remove_containers(self.docker, checkpoint)
+                containers = []
+            else:
+                log.success(f'Re-attaching to containers of job {job.id}')
+                self.active_container_ids |= set(c.id for c in containers)
+            self.recovered_containers[job.id] = containers
+            self.pending_jobs.append(job)
+
+    def finish_recovered_job(self, job, checkpoint):
+        """
+        Finishes a job whose results were sent before we stopped, rather
+        than running it again and sending them twice
+        """
+        log.warning(f'Finishing job {job.id}, its results were already sent')
+        job.results = Box(checkpoint.get('results') or {})
+        try:
+            self.finish_job(job)
         except Exception:
-            self.handle_job_exception(job)
-        self.make_instance_available(self.instances_db, job.instance_id)
-        self.mark_job_finished(job)
-        log.success(f'Finished job: '
-                    f'{box2json(job)}')
+            # Left checkpointed, so we try again after the next restart
+            log.exception(f'Could not finish recovered job {job.id}')
+            return
+        remove_containers(self.docker, checkpoint)
+        self.job_checkpoints.save(job.id, JOB_STATE_REPORTED)
+
+    def finish_job(self, job):
+        """
+        Marks the job finished, and lets the coordinator know we have room
+        for another, in one commit. The job's slot is released afterwards.
+        """
+        with self.instance_lock:
+            return self.job_store.finish(
+                job, self.get_instance_fields(finishing_job_id=job.id))
+
+    def on_lease_lost(self, job_id):
+        """
+        Stops a job that's no longer ours, e.g. it was requeued after its
+        lease expired, so it isn't run twice at once
+        """
+        self.lost_job_ids.add(job_id)
+        for container in list(self.job_containers.get(job_id, [])):
+            log.warning(f'Stopping container {container.id} of lost job '
+                        f'{job_id}')
+            try:
+                container.stop(timeout=1)
+            except Exception:
+                log.exception(f'Could not stop container {container.id}')
+
+    def get_instance_fields(self, finishing_job_id=None) -> dict:
+        """
+        :param finishing_job_id: Job whose slot should be counted as free
+        :return: Instance fields telling the coordinator how much room we
+            have for more jobs
+        """
+        available = dict(status=prob_const.INSTANCE_STATUS_AVAILABLE,
+                         time_last_available=SERVER_TIMESTAMP)
+        if self.scheduler.max_jobs == 1:
+            return available
+        free, running_job_ids = self.scheduler.usage_without(
+            finishing_job_id)
+        ret = dict(capacity=self.scheduler.capacity.to_dict(),
+                   free_capacity=free.to_dict(),
+                   max_jobs=self.scheduler.max_jobs,
+                   running_job_ids=running_job_ids)
+        if len(ret['running_job_ids']) < self.scheduler.max_jobs:
+            ret.update(available)
+        return ret
+
+    def advertise_capacity(self):
+        """
+        Lets the coordinator know how much room we have for more jobs
+        """
+        with self.instance_lock:
+            fields = self.get_instance_fields()
+            try:
+                batch_update([(self.instances_db, self.instance_id, fields)])
+            except DocumentNotFound:
+                log.warning('Instance does not exist, perhaps it was '
+                            'terminated.')
+                return
+            log.info(f'Instance {self.instance_id} has free capacity '
+                     f'{fields["free_capacity"]}')
 
     @staticmethod
     def handle_job_exception(job):
         """Exceptions that happen outside of the containers are handled here.
         These are likely "our" fault and should be investigated.
+        The job's worker_error is the exception, and its worker_log is its
+        recent log leading up to it.
         """
-        exception_sink = StringIO()
-        exception_sink_ref = log.add(exception_sink)
-        log.exception(f'Error running job '
-                      f'{box2json(job)}')
-        job.worker_error = exception_sink.getvalue()
-        log.remove(exception_sink_ref)
-        exception_sink.close()
+        log.exception(f'Error running job {job.to_json()}')
+        job.worker_error = traceback.format_exc()
+        job.worker_log = JOB_LOGS.get(job.id)
         # TODO: Some form of retry if it's a network or other
         #   transient error
 
@@ -167,55 +525,20 @@ class Worker:
         else:
             log.warning(f'Instance {instance_id} already available')
 
-    def check_for_jobs(self) -> Box:
-        # TODO: Avoid polling by creating a Firestore watch and using a
-        #   mutex to avoid multiple threads processing the watch.
-        job_query = self.jobs_db.collection.where(
-            'instance_id', '==', self.instance_id).where(
-            'status', '==', JOB_STATUS_ASSIGNED)
-        jobs = list(job_query.stream())
-        ret = Box()
-        if len(jobs) > 1:
-            # We currently only support one job per instance
-            raise RuntimeError('Got more than one job for instance')
-        elif not jobs:
-            log.debug('No job for instance in db')
-        else:
-            ret = Box(jobs[0].to_dict())
-        return ret
-
-    def mark_job_finished(self, job):
-        # We've added results to the job so don't compare_and_swap
-        # The initial check to mark running will be enough to
-        # to prevent multiple runners.
-        job.status = JOB_STATUS_FINISHED
-        job.finished_at = SERVER_TIMESTAMP
-        self.jobs_db.set(job.id, job)
+    def check_for_jobs(self) -> Optional[Job]:
+        # When watching, block on pushed jobs for about as long as we'd
+        # otherwise sleep between polls
+        return self.job_intake.check(timeout=0.5 + random())
 
     def mark_job_running(self, job):
-        self.set_job_atomic(job,
-                            status=JOB_STATUS_RUNNING,
-                            started_at=SERVER_TIMESTAMP)
-
-    def set_job_atomic(self, job, **fields):
-        old_job = deepcopy(job)
-        job = safe_box_update(job, **fields)
-        if not self.jobs_db.compare_and_swap(job.id, old_job, job):
-            new_job = self.jobs_db.get(job.id)
-            raise RuntimeError(
-                f'Job status transaction failed, '
-                f'expected '
-                f'{box2json(old_job)}\n'
-                f'got '
-                f'{box2json(new_job)}')
+        self.job_store.mark_running(
+            job, lease_expires_at=self.lease_keeper.get_expiry())
+        self.lease_keeper.hold(job.id)
 
     def run_build_job(self, job):
         results = job.results
-        secrets = get_secrets_db()
         build_image = self.get_image(SIM_PACKAGE_IMAGE_TAG)
-        aws_creds = secrets.get('DEEPDRIVE_AWS_CREDS_encrypted')
-        aws_key_id = decrypt_symmetric(aws_creds['AWS_ACCESS_KEY_ID'])
-        aws_secret = decrypt_symmetric(aws_creds['AWS_SECRET_ACCESS_KEY'])
+        aws_key_id, aws_secret = self.secrets.get('aws_creds')
         creds_path = '/mnt/.gcpcreds/silken-impulse-217423-8fbe5bbb2a10.json'
         container_args = dict(docker_tag=SIM_PACKAGE_IMAGE_TAG,
                               name=f'sim_build_{job.id}',
@@ -230,7 +553,7 @@ class Worker:
                                   AWS_SECRET_ACCESS_KEY=aws_secret,
                                   GOOGLE_APPLICATION_CREDENTIALS=creds_path,))
 
-        containers, success = self.run_containers([container_args])
+        containers, success = self.run_containers([container_args], job)
 
         results.sim_base_docker_digest = build_image.attrs['RepoDigests'][0]
 
@@ -238,32 +561,39 @@ class Worker:
                                            results=results, job=job)
         job.results = results  # These are saved when the job is marked finished
 
+    @staticmethod
+    def get_aws_creds():
+        """:return: AWS key id and secret for uploading sim builds"""
+        from botleague_helpers.crypto import decrypt_symmetric
+        aws_creds = get_secrets_db().get('DEEPDRIVE_AWS_CREDS_encrypted')
+        return decrypt_symmetric(aws_creds['AWS_ACCESS_KEY_ID']), \
+            decrypt_symmetric(aws_creds['AWS_SECRET_ACCESS_KEY'])
+
     def run_eval_job(self, job):
         results = job.results
         # TODO: Support N bot and N problem containers
         eval_spec = job.eval_spec
 
-        if dbox(eval_spec.problem_def).container_postfix:
-            container_postfix = eval_spec.problem_def.container_postfix
-        else:
-            container_postfix = ''
+        container_postfix = \
+            (eval_spec.problem_def or {}).get('container_postfix') or ''
 
         problem_tag = f'deepdriveio/deepdrive:problem_{eval_spec.problem}' \
             f'{container_postfix}'
         bot_tag = f'{job.eval_spec.docker_tag}{container_postfix}'
 
-        problem_image = self.get_image(problem_tag)
+        problem_image, bot_image = self.get_images([problem_tag, bot_tag])
         if problem_image is None:
             results.errors.problem_pull = 'Could not pull problem image'
 
-        bot_image = self.get_image(bot_tag)
         if bot_image is None:
             results.errors.bot_pull = 'Could not pull bot image'
 
         if None not in [problem_image, bot_image]:
             problem_container_args, results_mount = \
-                self.get_problem_container_args(problem_tag, eval_spec)
-            bot_container_args = dict(docker_tag=bot_tag)
+                self.get_problem_container_args(problem_tag, eval_spec,
+                                                problem_image)
+            bot_container_args = dict(
+                docker_tag=bot_tag, name=f'bot_eval_id_{eval_spec.eval_id}')
 
             results.problem_docker_digest = \
                 problem_image.attrs['RepoDigests'][0]
@@ -272,34 +602,35 @@ class Worker:
             containers = [problem_container_args]
             if not self.run_problem_only:
                 containers.append(bot_container_args)
-            containers, success = self.run_containers(containers)
+            collector = ResultsCollector(
+                results_mount, on_results=self.forward_partial_results(job))
+            collector.start()
+            try:
+                containers, success = self.run_containers(containers, job)
+            finally:
+                collector.stop()
             self.set_container_logs_and_errors(containers=containers,
                                                results=results, job=job)
             if success:
                 # Fetch eval results stored on the host by the problem container
-                results.update(self.get_results(results_dir=results_mount))
+                results.update(self.get_results(results_dir=results_mount,
+                                                collector=collector))
+
+        self.send_results(job)
 
+        if None not in [problem_image, bot_image]:
+            # Pushed in the background, so we're available for the next job
             eval_data = job.eval_spec.full_eval_request
-            problem_owner, problem_name = eval_data.problem_id.split('/')
-            artifact_repo = 'deepdriveio/botleague'
+            problem_owner, problem_name = eval_data['problem_id'].split('/')
             if not self.run_problem_only:
                 # deepdriveio/botleague:bot-crizcraig-deepdrive-domain_randomization-2019-09-19_09-58-56PM_TXDIT35OK9UE8D7VY4M63DWZ1
-                saved_bot_tag = f'bot-{eval_data.username}-{eval_data.botname}-{problem_owner}_' \
+                saved_bot_tag = f'bot-{eval_data["username"]}-{eval_data["botname"]}-{problem_owner}_' \
                     f'{problem_name}-{job.id}'
-                bot_image.tag(artifact_repo, saved_bot_tag)
-                log.info(f'Pushing {problem_tag} to {saved_bot_tag} ...')
-                self.docker.images.push(artifact_repo, saved_bot_tag)
-                log.info(f'Done pushing {problem_tag}')
+                self.artifact_pusher.push(bot_image, saved_bot_tag)
 
             # deepdriveio/botleague:problem-deepdrive-domain_randomization-2019-09-19_09-58-56PM_TXDIT35OK9UE8D7VY4M63DWZ1
             saved_problem_tag = f'problem-{problem_owner}_{problem_name}-{job.id}'
-            log.info(f'Pushing {problem_tag} to {saved_problem_tag} ...')
-            problem_image.tag(artifact_repo, saved_problem_tag)
-            self.docker.images.push(artifact_repo, saved_problem_tag)
-            log.info(f'Done pushing {problem_tag}')
-
-
-        self.send_results(job)
+            self.artifact_pusher.push(problem_image, saved_problem_tag)
 
     def run_deepdrive_build_job(self, job):
         results = job.results
@@ -315,183 +646,196 @@ class Worker:
                                   DOCKER_USER=self.docker_creds.username,
                                   DOCKER_PASS=self.docker_creds.password,))
 
-        containers, success = self.run_containers([container_args])
+        containers, success = self.run_containers([container_args], job)
         results.deepdrive_ci_image_digest = build_image.attrs['RepoDigests'][0]
         self.set_container_logs_and_errors(containers=containers,
                                            results=results, job=job)
         job.results = results  # These are saved when the job is marked finished
 
     def set_container_logs_and_errors(self, containers, results, job):
+        results.setdefault('json_results_from_logs', '')
+        results.json_results_from_logs_by_container = Box()
         for container in containers:
             image_name = container.attrs["Config"]["Image"]
             container_id = \
                 f'{image_name}_{container.short_id}'
-            run_logs = container.logs(timestamps=True).decode()
-            results.json_results_from_logs = self.get_json_out(run_logs)
-            log.log('CONTAINER', f'{container_id} logs begin \n' + ('-' * 80))
-            log.log('CONTAINER', run_logs)
-            log.log('CONTAINER', f'{container_id} logs end \n' + ('-' * 80))
-            log_url = self.upload_logs(
-                run_logs, filename=f'{image_name}_job-{job.id}.txt')
+            log_stream = self.log_streams.pop(container.id)
+            json_out = log_stream.json_out_scanner.json_out
+            results.json_results_from_logs_by_container[container_id] = \
+                json_out
+            if json_out and not results.json_results_from_logs:
+                results.json_results_from_logs = json_out
+            with span('upload_logs'):
+                log_url = log_stream.uploader.close()
+                if log_url is None:
+                    log.warning('Streaming logs failed, uploading all at '
+                                'once')
+                    run_logs = log_stream.log_file.read() or \
+                        container.logs(timestamps=True).decode()
+                    log_url = self.upload_logs(
+                        run_logs,
+                        filename=self.get_log_filename(container, job))
+            # Only needed until uploaded
+            log_stream.log_file.remove()
 
             exit_code = container.attrs['State']['ExitCode']
             if exit_code != 0:
                 results.errors[container_id] = f'Container failed with' \
                     f' exit code {exit_code}'
                 log.error(f'Container {container_id} failed with {exit_code}'
-                          f' for job {box2json(job)}, logs: {log_url}')
+                          f' for job {job!r}, logs: {log_url}')
             elif container.status == 'dead':
                 results.errors[container_id] = f'Container died, please retry.'
                 log.error(f'Container {container_id} died'
-                          f' for job {box2json(job)}, logs: {log_url}')
+                          f' for job {job!r}, logs: {log_url}')
 
             log.info(f'Uploaded logs for {container_id} to {log_url}')
             results.logs[container_id] = log_url
 
-    @staticmethod
-    def get_json_out(run_logs) -> str:
-        json_out_delimiter = '|~__JSON_OUT_LINE_DELIMITER__~|'
-        json_out_start = run_logs.find(json_out_delimiter)
-        if json_out_start == -1:
-            return ''
-        else:
-            json_out_end = run_logs.find('\n', json_out_start)
-            json_out_start += len(json_out_delimiter)
-            json_out = run_logs[json_out_start:json_out_end].strip()
-            log.success(f'Found json out: {json_out}')
-            return json_out
-
     def get_image(self, tag):
-        log.info('Pulling docker image %s ...' % tag)
-        try:
-            result = self.docker.images.pull(tag)
-        except:
-            log.exception(f'Could not pull {tag}')
-            ret = None
-        else:
-            log.info('Finished pulling docker image %s' % tag)
-            if isinstance(result, list):
-                ret = self.get_latest_docker_image(result)
-                if ret is None:
-                    raise RuntimeError(
-                        f'Could not get pull latest image for {tag}. '
-                        f'tags found were: {result}')
-            elif isinstance(result, Image):
-                ret = result
-            else:
-                log.warning(f'Got unexpected result when pulling {tag} '
-                            f'of {result}')
-                ret = result
-        return ret
+        return self.get_images([tag])[0]
+
+    def get_images(self, tags) -> list:
+        # Recorded before running so they're not evicted in the meantime
+        self.image_cache.record_use(tags)
+        return self.image_puller.get_images(tags)
+
+    def prepare_for_jobs(self):
+        """Pull in containers that we'll likely need. Call while idle."""
+        self.prefetch_images()
+        self.warm_pool.fill()
+
+    def prefetch_images(self):
+        if self.image_puller.history:
+            self.login_to_docker()
+            self.image_puller.prefetch()
 
     def login_to_docker(self):
-        if not self.loggedin_to_docker:
-            creds = decrypt_db_key('DEEPDRIVE_DOCKER_CREDS')
-            self.docker.login(username=creds.username,
-                              password=creds.password)
-            self.loggedin_to_docker = True
-            self.docker_creds = creds
+        """Logs in again if the creds have changed since we last did"""
+        creds = self.secrets.get('docker_creds')
+        with self.docker_login_lock:
+            if creds != self.docker_creds:
+                with span('docker_login'):
+                    try:
+                        self.docker.login(username=creds.username,
+                                          password=creds.password)
+                    except docker.errors.APIError:
+                        # Perhaps rotated, so fetch them again next time
+                        self.secrets.invalidate('docker_creds')
+                        raise
+                self.docker_creds = creds
+        return self.docker_creds
 
     @staticmethod
-    def get_latest_docker_image(images):
-        for image in images:
-            for tag in image.attrs['RepoTags']:
-                if tag.endswith(':latest'):
-                    return image
-        return None
-
-    def get_problem_container_args(self, tag, eval_spec):
-        # TODO: Change FILEPATH to DIR in deepdrive
-        result_dir = f'{BOTLEAGUE_RESULTS_DIR}/' + \
-                     f'{BOTLEAGUE_INNER_RESULTS_DIR_NAME}'
-        creds_path = '/mnt/.gcpcreds/silken-impulse-217423-8fbe5bbb2a10.json'
-        container_env = Box(
-            BOTLEAGUE_EVAL_KEY=eval_spec.eval_key,
-            BOTLEAGUE_SEED=eval_spec.seed,
-            BOTLEAUGE_PROBLEM=eval_spec.problem,
-            BOTLEAGUE_RESULT_FILEPATH=result_dir,
-            DEEPDRIVE_UPLOAD='1',
-            GOOGLE_APPLICATION_CREDENTIALS=creds_path)
-        if dbox(eval_spec.problem_def).problem_ci_replace_sim_url:
-            container_env.SIM_URL = \
-                eval_spec.problem_def.problem_ci_replace_sim_url
-
-        # TODO: Just pass the whole eval_spec by copying/mounting a json file
-        #  into the container
+    def get_docker_creds() -> Box:
+        from botleague_helpers.crypto import decrypt_db_key
+        return decrypt_db_key('DEEPDRIVE_DOCKER_CREDS')
 
+    def get_problem_container_args(self, tag, eval_spec, image):
+        """
+        :param image: The problem image pulled for the eval
+        """
+        name = f'problem_eval_id_{eval_spec.eval_id}'
+        warm = self.warm_pool.claim(tag, name, eval_spec, image.id)
+        if warm is not None:
+            # Already running, see run_containers
+            return dict(docker_tag=tag, name=name, container=warm.container), \
+                warm.results_mount
+
+        # Eval spec is passed in the env, and in full as a json file
+        container_env = get_static_env()
+        container_env.update(get_eval_env(eval_spec))
         results_mount = self.get_results_mount(eval_spec)
+        spec_mount = make_mount_dir(f'{results_mount}_spec')
+        write_eval_spec(spec_mount, eval_spec)
         container = dict(docker_tag=tag,
                          env=container_env.to_dict(),
-                         name=f'problem_eval_id_{eval_spec.eval_id}',
-                         volumes={
-                             results_mount: {
-                                 'bind': BOTLEAGUE_RESULTS_DIR,
-                                 'mode': 'rw'
-                             },
-                             '/root/.gcpcreds': {
-                                 'bind': '/mnt/.gcpcreds',
-                                 'mode': 'rw'
-                             }
-                         })
+                         name=name,
+                         volumes=get_volumes(results_mount, spec_mount))
         return container, results_mount
 
-    @staticmethod
-    def get_results_mount(eval_spec):
-        if is_docker():
-            results_mount_base = '/mnt/botleague_results'
-        else:
-            # For local, native testing
-            results_mount_base = f'{DIR}/botleague_results'
-        results_mount = f'{results_mount_base}/{eval_spec.eval_id}'
-        os.makedirs(results_mount, exist_ok=True)
-        os.system(f'chmod -R 777 {results_mount}')
+    def get_results_mount(self, eval_spec):
+        results_mount = make_mount_dir(
+            f'{self.results_mount_base}/{eval_spec.eval_id}')
         log.info(f'results mount {results_mount}')
         return results_mount
 
-    @staticmethod
-    @retry(tries=5, jitter=(0, 1), logger=log)
-    def send_results(job):
+    def send_results(self, job):
+        """
+        Queues results to be posted to the liaison in the background,
+        returning once they're safely on disk
+        """
         if in_test():
             return
-        else:
-            try:
-                log.info(f'Sending results for job \n'
-                         f'{box2json(job)}')
-                # Nested custom retry to deal with 409's
-                results_resp = post_results_with_retries(
-                    url=f'{job.botleague_liaison_host}/results',
-                    json=dict(eval_key=job.eval_spec.eval_key,
-                              results=job.results))
-                if not results_resp.ok:
-                    log.error(
-                        f'Error posting results back to botleague: '
-                        f'{results_resp}')
-                else:
-                    json_resp = results_resp.json()
-                    log.success(f'Successfully posted to botleague! response:\n'
-                                f'{json.dumps(json_resp, indent=2)}')
-            except Exception:
-                # TODO: Create an alert on this log message
-                log.exception('Possible problem sending results back to '
-                              'liaison.')
+        if job.id in self.lost_job_ids:
+            log.warning(f'Not sending results of job {job.id}, it is no '
+                        f'longer running on this instance')
+            return
+        results = job.results.to_dict()
+        with span('send_results'):
+            self.results_outbox.put(
+                url=f'{job.botleague_liaison_host}/results',
+                results_json=dict(eval_key=job.eval_spec.eval_key,
+                                  results=results),
+                job_id=job.id)
+        # So they're not sent again if we stop before the job's finished
+        self.checkpoint(job, JOB_STATE_RESULTS_SENT, results=results)
 
     @staticmethod
-    def get_results(results_dir) -> dict:
-        results = {}
-        directory = f'{results_dir}/{BOTLEAGUE_INNER_RESULTS_DIR_NAME}'
-        result_str = open(f'{directory}/results.json').read()
-        if is_json(result_str):
-            results.update(json.loads(result_str))
-        else:
-            results['error'] = \
-                f'No results file found at {BOTLEAGUE_RESULTS_FILEPATH}'
-        return results
+    def get_results(results_dir, collector=None) -> dict:
+        """
+        :param collector: ResultsCollector that watched results_dir while
+            the container ran, so results it's parsed aren't parsed again
+        """
+        collector = collector or ResultsCollector(results_dir)
+        with span('get_results'):
+            return collector.get_results()
+
+    def forward_partial_results(self, job):
+        """
+        :return: on_results for a ResultsCollector which saves the latest
+            results, summarized, to the job as they're written, at most
+            every PARTIAL_RESULTS_INTERVAL seconds
+        """
+        last_forwarded_at = [0.]
 
-    def run_containers(self, containers_args: list = None):
+        def on_results(results):
+            if time.time() - last_forwarded_at[0] < PARTIAL_RESULTS_INTERVAL:
+                return
+            last_forwarded_at[0] = time.time()
+            self.job_store.save_partial_results(job.id, results)
+
+        return on_results
+
+    def run_containers(self, containers_args: list = None, job=None):
         log.info('Running containers %s ...' % containers_args)
-        containers = [self.start_container(**c) for c in containers_args]
+        slot = self.scheduler.slots.get(job.id) if job else None
+        self.image_cache.record_use([a['docker_tag'] for a in containers_args])
+        containers = []
         try:
-            containers, success = self.monitor_containers(containers)
+            recovered = self.recovered_containers.pop(job.id, None) \
+                if job else None
+            if recovered:
+                containers = recovered
+            else:
+                self.checkpoint(job, JOB_STATE_PULLED)
+                for container_args in containers_args:
+                    container_args = dict(container_args)
+                    container = container_args.pop('container', None)
+                    if container is None:
+                        with span('start_container'):
+                            container = self.start_container(
+                                **container_args, slot=slot)
+                    self.active_container_ids.add(container.id)
+                    containers.append(container)
+                self.checkpoint(job, JOB_STATE_STARTED, containers)
+            if job:
+                self.job_containers[job.id] = containers
+            self.raise_if_lost(job)
+            with span('monitor_containers'):
+                containers, success = self.monitor_containers(containers,
+                                                              job)
+            self.raise_if_lost(job)
         except Exception as e:
             log.error(f'Exception encountered while running '
                       f'containers: '
@@ -500,94 +844,86 @@ class Worker:
             for container in containers:
                 log.error(f'Stopping orphaned container: {container}')
                 container.stop(timeout=1)
+                log_stream = self.log_streams.pop(container.id, None)
+                if log_stream is not None:
+                    # Kept on disk for debugging
+                    log_stream.log_file.close()
             raise e
+        finally:
+            self.active_container_ids -= set(c.id for c in containers)
+            if job:
+                self.job_containers.pop(job.id, None)
         return containers, success
 
-    def monitor_containers(self, containers):
-        success = True
-        running = True
-        failed = False
-        dead = False
-        last_timestamps = [None] * len(containers)
-        last_loglines = [None] * len(containers)
-        while running and not (failed or dead):
-            # Refresh container status
-            containers = [self.docker.containers.get(c.short_id)
-                          for c in containers]
-
-            running = [c for c in containers if c.status in
-                       ['created', 'running']]
-
-            for container_idx, container in enumerate(containers):
-                # TODO: logger.add("special.log", level='CONTAINER')
-                #  then use frontail to stream it from the server
-                last_timestamp = last_timestamps[container_idx]
-                if last_timestamp is None:
-                    log_lines = container.logs(timestamps=True).decode()
-                    log_lines = re.split('\n', log_lines.strip())
-                    last_timestamp = self.get_last_timestamp(log_lines)
-                else:
-                    log_lines = container.\
-                        logs(timestamps=True, since=last_timestamp).decode()
-                    log_lines = re.split('\n', log_lines.strip())
-                    last_logline = last_loglines[container_idx]
-                    if last_logline is not None:
-                        try:
-                            # noinspection PyTypeChecker
-                            dupe_index = log_lines.index(last_logline)
-                            log_lines = log_lines[dupe_index+1:]
-                        except ValueError:
-                            pass
-
-                    last_timestamp = (self.get_last_timestamp(log_lines) or
-                                      last_timestamp)
-
-                if log_lines:
-                    # noinspection PyTypeChecker
-                    last_loglines[container_idx] = log_lines[-1]
-                    log.log('CONTAINER', '\n'.join(log_lines))
-                last_timestamps[container_idx] = last_timestamp
-
-            # TODO: Do a container.logs(since=last, timestamps=True) and
-            #   log those in real time.
-
-            # TODO: For N bots or N problems, we probably want to make a best
-            #  effort so long as at least 1 bot and one problem are still alive.
-            dead = [c for c in containers if c.status == 'dead']
-            failed = [c for c in containers if c.attrs['State']['ExitCode'] > 0]
-
-            if dead:
-                success = False
-                log.error(f'Dead container(s) found: {dead}')
-
-            if failed:
-                success = False
-                log.error(f'Containers failed: {failed}')
-
-            time.sleep(0.1)
-        for container in running:
-            log.error(f'Stopping orphaned container: {container}')
-            container.stop(timeout=1)
-        log.info('Finished running containers %s' % containers)
+    def raise_if_lost(self, job):
+        if job and job.id in self.lost_job_ids:
+            raise RuntimeError(f'Job {job.id} is no longer running on this '
+                               f'instance, perhaps its lease expired')
+
+    def monitor_containers(self, containers, job):
+        followers = []
+        for container in containers:
+            # Picked up in set_container_logs_and_errors
+            filename = self.get_log_filename(container, job)
+            log_stream = Box(
+                json_out_scanner=JsonOutScanner(),
+                uploader=LogUploader(self.get_log_bucket(),
+                                     filename=filename),
+                log_file=ContainerLogFile(get_container_log_path(
+                    self.container_log_dir, filename)))
+            self.log_streams[container.id] = log_stream
+            followers.append(LogFollower(
+                container, line_handlers=[log_stream.json_out_scanner,
+                                          log_stream.uploader,
+                                          log_stream.log_file],
+                job_id=job.id))
+        for follower in followers:
+            follower.start()
+
+        def flush_logs(_containers):
+            for _follower in followers:
+                _follower.flush()
+
+        self.docker_events.start()
+        monitor = ContainerMonitor(self.docker, self.docker_events)
+        containers, success = monitor.run(
+            containers, on_wake=flush_logs,
+            wake_interval=CONTAINER_LOG_FLUSH_INTERVAL)
+        for follower in followers:
+            if not follower.join(timeout=10):
+                log.warning(f'Log stream for {follower.container} did not '
+                            f'end after container exited, closing it')
+                # Its handlers, e.g. the log uploader, are closed next, so
+                # wait for it to stop writing to them
+                follower.stop()
+                follower.join()
         return containers, success
 
-    @staticmethod
-    def get_last_timestamp(logs) -> Optional[datetime]:
-        if not (logs and logs[0]):
-            return None
-        try:
-            last_timestamp = \
-                logs[-1].split(' ')[0]
-            last_timestamp = datetime.strptime(last_timestamp[:-4],
-                                               '%Y-%m-%dT%H:%M:%S.%f')
-        except:
-            log.exception(f'Could not parse time stamp from log line: {logs[-1]}')
-            last_timestamp = None
-        return last_timestamp
+    def checkpoint(self, job, state, containers=None, results=None):
+        if job is not None:
+            self.job_checkpoints.save(job.id, state, containers, results)
 
     def start_container(self, docker_tag, cmd=None, env=None, volumes=None,
-                        name=None):
+                        name=None, slot=None):
+        """
+        :param slot: Scheduler slot of the job, which the container's GPUs,
+            CPUs and memory are limited to when running more than one job
+        """
+        if name is not None:
+            self.remove_container_named(name)
+        isolate = slot is not None and self.scheduler.max_jobs > 1
+        if isolate:
+            env = dict(env or {}, NVIDIA_VISIBLE_DEVICES=','.join(
+                str(i) for i in slot.gpu_ids) or 'none')
+
         def start(**options):
+            if isolate:
+                options.update(self.scheduler.container_options(slot))
+                if 'device_requests' in options:
+                    from docker_gpu_patch import DeviceRequest
+                    options['device_requests'] = [DeviceRequest(
+                        device_ids=[str(i) for i in slot.gpu_ids],
+                        capabilities=[['gpu']])] if slot.gpu_ids else []
             return self.docker.containers.run(docker_tag,
                                                    command=cmd,
                                                    detach=True,
@@ -595,9 +931,13 @@ class Worker:
                                                    stderr=False,
                                                    environment=env,
                                                    volumes=volumes,
+                                                   name=name,
+                                                   labels={
+                                                       WORKER_CONTAINER_LABEL:
+                                                           self.instance_id},
                                                    **options)
         try:
-            container = start(**CONTAINER_RUN_OPTIONS)
+            container = start(**self.container_run_options)
         except Exception as e:
             if '"nvidia-container-runtime": executable file not found' in str(e):
                 # TODO: Remove patch when
@@ -605,35 +945,67 @@ class Worker:
                 from docker_gpu_patch import DeviceRequest
                 log.warning('nvidia docker runtime not found, trying gpus=all')
 
-                self.docker = docker.from_env(version='1.40')
-
-                # Danger! Mutating global - okay for now as single threaded and
-                # fallback is to just change again after exception
-                del CONTAINER_RUN_OPTIONS['runtime']
-
-                CONTAINER_RUN_OPTIONS['device_requests'] = [
-                    DeviceRequest(count=-1, capabilities=[['gpu']])
-                ]
+                with self.container_run_options_lock:
+                    self.docker = count_docker_calls(
+                        docker.from_env(version='1.40'))
+                    self.image_puller.docker = self.docker
+                    self.container_run_options.pop('runtime', None)
+                    self.container_run_options['device_requests'] = [
+                        DeviceRequest(count=-1, capabilities=[['gpu']])
+                    ]
 
-                container = start(**CONTAINER_RUN_OPTIONS)
+                container = start(**self.container_run_options)
             else:
                 raise e
         return container
 
+    def remove_container_named(self, name):
+        """Remove a leftover container from a previous run of the job"""
+        try:
+            container = self.docker.containers.get(name)
+        except docker.errors.NotFound:
+            return
+        log.warning(f'Removing old container {name}')
+        container.remove(force=True)
+
+    def upload_logs(self, logs, filename):
+        key = get_log_key(filename)
+        blob = self.get_log_bucket().blob(key)
+        blob.content_encoding = 'gzip'
+        blob.upload_from_string(gzip.compress(logs.encode()),
+                                content_type='text/plain; charset=utf-8')
+        return get_log_url(key)
+
+    def get_log_bucket(self):
+        if self.log_bucket is None:
+            self.log_bucket = get_storage_client().bucket(BOTLEAGUE_LOG_BUCKET)
+        return self.log_bucket
+
     @staticmethod
-    def upload_logs(logs, filename):
-        # Upload the logs, auth is by virtue of VM access level
-
-        from google.cloud import storage
-        key = f'{BOTLEAGUE_LOG_DIR}/{filename}'
-        bucket = storage.Client().get_bucket(BOTLEAGUE_LOG_BUCKET)
-        blob = bucket.get_blob(key)
-        blob = blob if blob is not None else bucket.blob(key)
-        blob.upload_from_string(logs)
-        url = f'https://storage.googleapis.com/{BOTLEAGUE_LOG_BUCKET}/{key}'
-        return url
+    def get_log_filename(container, job):
+        image_name = container.attrs["Config"]["Image"]
+        return f'{image_name}_job-{job.id}.txt'
 
     def stop_old_containers_if_running(self):
+        if in_test():
+            return
+        if not self.stopped_unlabelled_containers:
+            # From workers that didn't label their containers
+            self.stop_unlabelled_containers()
+            self.stopped_unlabelled_containers = True
+        # Listed before checking which to keep, and only stopped once seen
+        # twice, as jobs and the warm pool start containers concurrently
+        # and only then add them to the containers we keep
+        running_ids = self.worker_containers.get_running_ids()
+        keep_ids = set(self.active_container_ids) | \
+            self.warm_pool.container_ids
+        old_ids = running_ids - keep_ids
+        for container_id in old_ids & self.old_container_ids:
+            log.warning(f'Stopping old container {container_id}')
+            self.docker.containers.get(container_id).stop()
+        self.old_container_ids = old_ids
+
+    def stop_unlabelled_containers(self):
         containers = self.docker.containers.list()
 
         def is_botleague(_container):
@@ -650,50 +1022,21 @@ class Worker:
             return False
 
         for container in containers:
-            if container.status == 'running' and is_botleague(container) and \
-                    not in_test():
+            if container.status == 'running' and \
+                    WORKER_CONTAINER_LABEL not in container.labels and \
+                    is_botleague(container) and \
+                    container.id not in self.active_container_ids:
                 container.stop()
 
 
-def post_results_with_retries(max_attempts=5, **kwargs):
-    done = False
-    valid_results_codes = [200, 400, 500]
-    attempts = 0
-    resp = None
-    while not done:
-        resp = requests.post(**kwargs)
-        if resp.status_code in valid_results_codes:
-            done = True
-        elif attempts < max_attempts:
-            log.error(f'Failed posting results, response {resp}, retrying')
-            time.sleep(1)
-        else:
-            done = True
-        attempts += 1
-
-    return resp
-
-
 @log.catch(reraise=True)
 def main():
     worker = Worker()
-    worker.loop()
-
-
-def play():
-    # sink = StringIO()
-    # sink_ref = log.add(sink)
-    # log.info('asdf')
-    # log.remove(sink_ref)
-    # print(sink.getvalue())
-    print(post_results_with_retries(url='http://127.0.0.1:5000/'))
-    pass
-    # encrypt_db_key(get_db('secrets'), 'DEEPDRIVE_DOCKER_CREDS')
+    if WORKER_ASYNC:
+        worker.run_async()
+    else:
+        worker.loop()
 
 
 if __name__ == '__main__':
-    if 'play' in sys.argv:
-        play()
-    else:
-        main()
-
+    main()